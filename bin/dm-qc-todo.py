@@ -10,6 +10,10 @@ Options:
     --root PATH      Path to parent folder to all study folders.
                      [default: /archive/data-2.0]
     --study=<study>  Process a singe study
+    --index          Read each project's nii and qc folders from its file
+                     index (metadata/file_index.sqlite, see datman.index)
+                     instead of listing and checking every file. The index
+                     is brought up to date first.
 
 Expects to be run in the parent folder to all study folders. Looks for the file
 checklist.csv in subfolders, and prints out any QC pdf from those that haven't
@@ -22,6 +26,7 @@ import os
 import os.path
 import re
 import datman.config as config
+import datman.index
 
 def read_checklist(checklist_file):
     checklist_dict = {}
@@ -84,6 +89,51 @@ def get_mtime(path):
             # Something went very wrong, reraise the OSError! :(
             raise
 
+def get_project_index(projectdir):
+    db_path = os.path.join(projectdir, 'metadata', datman.index.INDEX_NAME)
+    roots = {'nii': os.path.join(projectdir, 'data', 'nii'),
+             'qc': os.path.join(projectdir, 'qc')}
+    index = datman.index.ProjectIndex(db_path, roots)
+    index.refresh()
+    return index
+
+def report_from_index(projectdir, checklistdict, show_newer):
+    """
+    Prints the same report as main() using the project's file index.
+    """
+    with get_project_index(projectdir) as index:
+        qc_docs = dict((item.path, item.mtime) for item in index.find('qc'))
+        newer_sessions = dict((session, qc_mtime) for session, _, qc_mtime in
+                index.get_newer_than_qc())
+
+        for timepoint in index.get_sessions('nii'):
+            if '_PHA_' in timepoint:
+                continue
+
+            timepointdir = os.path.join(index.roots['nii'], timepoint)
+            qcdocname = 'qc_' + timepoint
+            qcdoc = os.path.join(index.roots['qc'], timepoint,
+                    qcdocname + '.html')
+
+            if qcdocname not in checklistdict:
+                print('No checklist entry for {}'.format(timepointdir))
+                continue
+            elif qcdoc not in qc_docs:
+                print('No QC doc generated for {}'.format(timepointdir))
+                continue
+
+            if show_newer and timepoint in newer_sessions:
+                qc_mtime = qc_docs[qcdoc]
+                newer = [item.path for item in index.find('nii',
+                        folder=timepointdir) if item.mtime > qc_mtime]
+                if newer:
+                    print('{}: QC doc is older than data in folder {}'.format(
+                            qcdoc, timepointdir))
+                    print('\t' + '\n\t'.join(newer))
+
+            if not checklistdict[qcdocname]:
+                print('{}: QC doc not signed off on'.format(qcdoc))
+
 def main():
     arguments = docopt.docopt(__doc__)
     rootdir = arguments['--root']
@@ -96,6 +146,11 @@ def main():
 
         checklistdict = read_checklist(checklist)
 
+        if arguments['--index']:
+            report_from_index(projectdir, checklistdict,
+                    arguments['--show-newer'])
+            continue
+
         for timepointdir in sorted(glob.glob(projectdir + '/data/nii/*')):
             if '_PHA_' in timepointdir:
                 continue
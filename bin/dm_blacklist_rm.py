@@ -5,6 +5,10 @@ and deletes them. WARNING: This will not remove lines from output CSVs
 that apply to blacklisted subjects. It is not a replacement for making sure that
 pipeline scripts respect the blacklist!
 
+Each search path is walked only once, with every file name checked against
+the whole blacklist. Use --verbose to see what was removed, the number of files
+searched and the time taken.
+
 Usage:
     dm_blacklist_rm.py [options] [--ignore-path=KEY]... <project>
     dm_blacklist_rm.py [options] [--ignore-path=KEY]... <project> <series>
@@ -22,6 +26,7 @@ Options:
                         given.
     --ignore-path KEY   A value from the configuration file 'path' field to
                         not search through. [default: qc meta]
+    --threads N         The number of files to delete at once. [default: 4]
     -v --verbose
     -d --debug
     -q --quiet
@@ -29,11 +34,24 @@ Options:
 
 """
 import os
-import re
 import sys
+import stat
+import time
+import heapq
+import bisect
 import logging
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 import datman.config
+import datman.metadata
 import datman.utils
 from datman.docopt import docopt
 
@@ -54,6 +72,7 @@ def main():
     debug = arguments['--debug']
     quiet = arguments['--quiet']
     DRYRUN = arguments['--dry-run']
+    threads = int(arguments['--threads'])
 
     if verbose:
         logger.setLevel(logging.INFO)
@@ -67,14 +86,14 @@ def main():
     blacklist = get_blacklist(arguments['--blacklist'], series, config)
     logger.debug("Found blacklist data: {}".format(blacklist))
 
-    remove_blacklisted_items(blacklist, config, ignored_paths)
+    remove_blacklisted_items(blacklist, config, ignored_paths, threads=threads)
 
 def get_blacklist(blacklist_file, series, config):
     if series:
         return [series]
 
     if blacklist_file is None:
-        blacklist_file = os.path.join(config.get_path('meta'), 'blacklist.csv')
+        blacklist_file = config.get_metadata_file('blacklist')
 
     if not os.path.exists(blacklist_file):
         logger.error("Blacklist {} does not exist. " \
@@ -82,43 +101,52 @@ def get_blacklist(blacklist_file, series, config):
         sys.exit(1)
 
     logger.debug("Reading blacklist file {}".format(blacklist_file))
-    blacklist = []
-    with open(blacklist_file, 'r') as blacklist_data:
-        for line in blacklist_data:
-            series = get_series(line)
-            if not series:
-                continue
-            blacklist.append(series)
+    return list(datman.metadata.get_blacklist(blacklist_file).entries)
 
-    return blacklist
+def remove_blacklisted_items(blacklist, config, ignored_paths, threads=1):
+    start = time.time()
+    search_roots = get_search_roots(config, ignored_paths)
+    matcher = PrefixMatcher(blacklist)
 
-def get_series(line):
-    regex = ',|\s'
-    fields = re.split(regex, line)
-    if not fields or fields[0] == 'series':
-        return ''
-    return fields[0]
+    found_items = []
+    visited = 0
+    for root in search_roots:
+        matches, count = find_files(root, matcher)
+        found_items.extend(matches)
+        visited += count
 
-def remove_blacklisted_items(blacklist, config, ignored_paths):
-    found_items = collect_blacklisted_items(blacklist, config, ignored_paths)
+    if threads > 1:
+        pool = ThreadPool(threads)
+        try:
+            pool.map(remove_item, found_items)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for item in found_items:
+            remove_item(item)
 
-    for item in found_items:
-        remove_item(item)
-        remove_parent_dir_if_empty(item)
+    prune_empty_dirs(found_items, search_roots)
 
-def collect_blacklisted_items(blacklist, config, ignored_paths):
-    search_paths = get_search_paths(config, ignored_paths)
+    logger.info("Removed {} blacklisted items. Searched {} files in {} "
+            "folders in {:.2f}s".format(len(found_items), visited,
+            len(search_roots), time.time() - start))
 
-    file_list = []
-    for path in search_paths:
+def get_search_roots(config, ignored_paths):
+    search_roots = []
+    for path in get_search_paths(config, ignored_paths):
         full_path = config.get_path(path)
         if not os.path.exists(full_path):
             continue
-        for item in blacklist:
-            found_files = find_files(full_path, item)
-            if found_files:
-                file_list.extend(found_files)
-    return file_list
+        search_roots.append(os.path.normpath(os.path.abspath(full_path)))
+
+    # Skip any path that is inside another, so no folder is walked twice
+    unique_roots = []
+    for root in sorted(set(search_roots)):
+        if is_root_child(root, unique_roots):
+            continue
+        unique_roots.append(root)
+    return unique_roots
 
 def get_search_paths(config, ignored_paths):
     paths = config.get_key('paths')
@@ -130,14 +158,79 @@ def get_search_paths(config, ignored_paths):
     search_paths = [path for path in path_keys if path not in ignored_paths]
     return search_paths
 
-def find_files(search_path, item):
-    command = 'find {} -name \"{}*\"'.format(search_path, item)
-    return_code, out = datman.utils.run(command)
+class PrefixMatcher(object):
+    """
+    Matches file names against a whole list of prefixes with a single binary
+    search.
 
-    if not out:
-        return []
-    found_files = out.strip().split('\n')
-    return found_files
+    Any prefix that starts with a shorter prefix from the list is dropped, so
+    that the only prefix that can match a name is the largest one that sorts
+    before it.
+    """
+
+    def __init__(self, prefixes):
+        self.prefixes = []
+        for prefix in sorted(set(prefixes)):
+            if not prefix:
+                continue
+            if self.prefixes and prefix.startswith(self.prefixes[-1]):
+                continue
+            self.prefixes.append(prefix)
+
+    def match(self, name):
+        """Returns the prefix that name starts with or None"""
+        position = bisect.bisect_right(self.prefixes, name)
+        if not position:
+            return None
+        candidate = self.prefixes[position - 1]
+        if name.startswith(candidate):
+            return candidate
+        return None
+
+def find_files(search_path, matcher):
+    """
+    Walks search_path once and returns a list of all files (and symlinks)
+    whose names match a blacklist entry, along with the number of files
+    visited. Symlinked directories are not followed.
+    """
+    found_files = []
+    visited = 0
+    folders = [search_path]
+    while folders:
+        folder = folders.pop()
+        try:
+            entries = list_dir(folder)
+        except OSError as e:
+            logger.error("Cannot search {}, reason: {}".format(folder,
+                    e.strerror))
+            continue
+        for name, is_dir in entries:
+            path = os.path.join(folder, name)
+            if is_dir:
+                folders.append(path)
+                continue
+            visited += 1
+            if matcher.match(name):
+                found_files.append(path)
+    return found_files, visited
+
+def list_dir(path):
+    """
+    Returns a list of (name, is_dir) tuples for the contents of path, where
+    is_dir is False for symlinks.
+    """
+    if scandir is not None:
+        return [(entry.name, entry.is_dir(follow_symlinks=False))
+                for entry in scandir(path)]
+    return [(name, is_real_dir(os.path.join(path, name)))
+            for name in os.listdir(path)]
+
+def is_real_dir(path):
+    try:
+        mode = os.lstat(path).st_mode
+    except OSError:
+        return False
+    return stat.S_ISDIR(mode)
 
 def remove_item(item):
     logger.info('Removing blacklisted item {}'.format(item))
@@ -151,13 +244,42 @@ def remove_item(item):
         else:
             logger.debug("Cannot remove file {}".format(item))
 
-def remove_parent_dir_if_empty(item):
-    parent_dir = os.path.dirname(item)
-    if not os.listdir(parent_dir):
-        logger.debug('Removing empty directory {}'.format(parent_dir))
+def prune_empty_dirs(removed_items, search_roots):
+    """
+    Deletes any folders left empty by removing items, deepest first, so that
+    a folder that only held empty folders is removed as well. The search roots
+    themselves are never removed.
+    """
+    roots = set(search_roots)
+    # A heap ordered deepest first, so children are pruned before parents
+    candidates = [(-folder.count(os.sep), folder) for folder in
+            set(os.path.dirname(item) for item in removed_items)]
+    heapq.heapify(candidates)
+    checked = set()
+    while candidates:
+        _, folder = heapq.heappop(candidates)
+        if folder in checked or not is_root_child(folder, roots):
+            continue
+        checked.add(folder)
+        try:
+            if os.listdir(folder):
+                continue
+        except OSError:
+            continue
+        logger.debug('Removing empty directory {}'.format(folder))
         if DRYRUN:
-            return
-        os.rmdir(parent_dir)
+            continue
+        try:
+            os.rmdir(folder)
+        except OSError as e:
+            logger.debug("Cannot remove directory {}, reason: {}".format(
+                    folder, e.strerror))
+            continue
+        parent = os.path.dirname(folder)
+        heapq.heappush(candidates, (-parent.count(os.sep), parent))
+
+def is_root_child(folder, roots):
+    return any(folder.startswith(root + os.sep) for root in roots)
 
 if __name__ == "__main__":
     main()
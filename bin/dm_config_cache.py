@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Rebuilds (or clears) the snapshots of the parsed site and project config files
+that datman.config uses to avoid re-parsing yaml in every process.
+
+Snapshots are refreshed automatically whenever a config file changes, so this
+only needs to be run to warm the cache (e.g. before submitting many jobs to the
+queue) or to get rid of it.
+
+Usage:
+    dm_config_cache.py [options]
+
+Options:
+    --site-config FILE  The path to a site configuration file. If not set, the
+                        default defined for datman.config.config() is used.
+    --system NAME       The system to read CONFIG_DIR from. If not set, the
+                        default defined for datman.config.config() is used.
+    --clear             Delete all existing snapshots instead of rebuilding them
+    -v --verbose
+    -d --debug
+    -q --quiet
+
+Details:
+    Snapshots are stored in the folder set by the DM_CONFIG_CACHE environment
+    variable (default: ~/.cache/datman/config). Setting DM_CONFIG_CACHE to an
+    empty string disables them entirely.
+
+    With --verbose the time taken to parse each file and to load its snapshot
+    is reported.
+"""
+import os
+import sys
+import time
+import logging
+
+import datman.config
+from datman.docopt import docopt
+
+logging.basicConfig(level=logging.WARN,
+        format="[%(name)s] %(levelname)s: %(message)s")
+logger = logging.getLogger(os.path.basename(__file__))
+
+def main():
+    arguments = docopt(__doc__)
+    site_config = arguments['--site-config']
+    system = arguments['--system']
+    clear = arguments['--clear']
+    verbose = arguments['--verbose']
+    debug = arguments['--debug']
+    quiet = arguments['--quiet']
+
+    if verbose:
+        logger.setLevel(logging.INFO)
+    if debug:
+        logger.setLevel(logging.DEBUG)
+    if quiet:
+        logger.setLevel(logging.ERROR)
+
+    if not datman.config.get_snapshot_dir():
+        logger.error("Config snapshots are disabled (DM_CONFIG_CACHE is empty)")
+        sys.exit(1)
+
+    if clear:
+        deleted = datman.config.clear_snapshots()
+        logger.info("Deleted {} snapshots from {}".format(deleted,
+                datman.config.get_snapshot_dir()))
+        return
+
+    config = datman.config.config(filename=site_config, system=system)
+    for config_file in get_config_files(config):
+        rebuild(config_file)
+
+def get_config_files(config):
+    config_dir = config.system_config['CONFIG_DIR']
+    config_files = [config.site_config_file]
+    for project, settings_file in config.site_config['Projects'].items():
+        settings_path = os.path.join(config_dir, settings_file)
+        if not os.path.isfile(settings_path):
+            logger.warning("Settings file {} for project {} does not "
+                    "exist".format(settings_path, project))
+            continue
+        config_files.append(settings_path)
+    return config_files
+
+def rebuild(config_file):
+    start = time.time()
+    try:
+        datman.config.rebuild_snapshot(config_file)
+    except Exception as e:
+        logger.error("Failed to rebuild snapshot for {}. Reason: {}".format(
+                config_file, str(e)))
+        return
+    parse_time = time.time() - start
+
+    start = time.time()
+    datman.config.read_snapshot(config_file)
+    load_time = time.time() - start
+
+    logger.info("{}: parsed in {:.4f}s, snapshot loaded in {:.4f}s".format(
+            config_file, parse_time, load_time))
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,11 @@ Options:
     -d --debug                  Debug logging
     -q --quiet             Less debuggering
     --dry-run             Dry run
+    --jobs N              Number of archives to read dicom headers from at
+                          once. Linking itself is always done one archive at
+                          a time [default: 1]
+    --no-header-cache     Read the headers of every archive instead of using
+                          the headers cached from earlier runs
 
 
 DETAILS
@@ -73,16 +78,34 @@ IGNORING EXAM ARCHIVES
 from datman.docopt import docopt
 import sys
 import os
-import glob
+import collections
 import pandas as pd
 import datman.config
 import datman.utils
 import datman.scanid
+import datman.header_cache
 import logging
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 logger = logging.getLogger(os.path.basename(__file__))
+
+# A row of the lookup table. dicom_fields holds a (header field, expected
+# value) pair for each dicom_* column.
+LookupEntry = collections.namedtuple('LookupEntry', ['target_name',
+                                                     'dicom_fields'])
+
 already_linked = {}
+real_folders = {}
 lookup = None
+header_cache = None
+headers_read = {}
 DRYRUN = None
 
 
@@ -90,6 +113,8 @@ def main():
     # make the already_linked dict global as we are going to use it a lot
     global already_linked
     global lookup
+    global header_cache
+    global headers_read
     global DRYRUN
 
     arguments = docopt(__doc__)
@@ -101,6 +126,8 @@ def main():
     lookup_path = arguments['--lookup']
     scanid_field = arguments['--scanid-field']
     zipfile = arguments['<zipfile>']
+    use_cache = not arguments['--no-header-cache']
+    jobs = int(arguments['--jobs'])
 
     # setup logging
     ch = logging.StreamHandler(sys.stdout)
@@ -144,16 +171,17 @@ def main():
         return
 
     try:
-        lookup = pd.read_table(lookup_path, sep='\s+', dtype=str)
+        lookup_table = pd.read_table(lookup_path, sep='\s+', dtype=str)
     except IOError:
         logger.error('Lookup file:{} not found'.format(lookup_path))
         return
+    lookup = read_lookup_table(lookup_table)
+
+    if use_cache:
+        header_cache = open_header_cache(cfg, scanid_field, lookup_table)
 
     # identify which zip files have already been linked
-    already_linked = {os.path.realpath(f): f
-                      for f
-                      in glob.glob(os.path.join(dicom_path, '*'))
-                      if os.path.islink(f)}
+    already_linked = get_linked_archives(dicom_path)
 
     if zipfile:
         if isinstance(zipfile, basestring):
@@ -166,9 +194,103 @@ def main():
                     if os.path.splitext(archive)[1] == '.zip']
 
     logger.info('Found {} archives'.format(len(archives)))
+    if jobs > 1:
+        to_read = [archive for archive in archives
+                   if get_real_path(archive) not in already_linked]
+        headers_read = datman.utils.get_archive_headers_many(
+            to_read, stop_after_first=True, cache=header_cache, jobs=jobs)
+
     for archive in archives:
         link_archive(archive, dicom_path, scanid_field, cfg)
 
+    if header_cache:
+        header_cache.close()
+
+
+def read_lookup_table(lookup_table):
+    """
+    Returns a dictionary that maps each source_name in the lookup table
+    (a pandas dataframe) to a LookupEntry. If a source_name is listed more
+    than once, its first row is used.
+    """
+    dicom_cols = [c for c in lookup_table.columns if c.startswith('dicom_')]
+    fields = tuple(c.split("_")[1] for c in dicom_cols)
+    rows = zip(lookup_table['source_name'], lookup_table['target_name'],
+               *[lookup_table[c] for c in dicom_cols])
+
+    lookup = {}
+    for row in rows:
+        source_name = row[0]
+        if source_name in lookup:
+            continue
+        expected = tuple(str(value) for value in row[2:])
+        lookup[source_name] = LookupEntry(row[1], tuple(zip(fields,
+                                                            expected)))
+    return lookup
+
+
+def get_linked_archives(dicom_path):
+    """
+    Returns a dictionary that maps the path of each archive linked from
+    dicom_path to the link pointing at it.
+
+    Link targets are read with readlink, and only the folder they point into
+    is resolved, so a folder of links all pointing into the zips folder costs
+    one realpath call rather than one per link.
+    """
+    linked = {}
+    for name, is_link in list_links(dicom_path):
+        if name.startswith('.') or not is_link:
+            continue
+        link = os.path.join(dicom_path, name)
+        try:
+            target = os.readlink(link)
+        except OSError:
+            continue
+        linked[get_real_path(os.path.join(dicom_path, target))] = link
+    return linked
+
+
+def list_links(path):
+    """
+    Returns a (name, is_link) tuple for everything in path.
+    """
+    if scandir is not None:
+        return [(entry.name, entry.is_symlink()) for entry in scandir(path)]
+    return [(name, os.path.islink(os.path.join(path, name)))
+            for name in os.listdir(path)]
+
+
+def get_real_path(path):
+    """
+    Returns path with any links in its parent folders resolved. Unlike
+    os.path.realpath, a link at path itself is not followed.
+    """
+    folder, name = os.path.split(os.path.abspath(path))
+    try:
+        real_folder = real_folders[folder]
+    except KeyError:
+        real_folder = real_folders[folder] = os.path.realpath(folder)
+    return os.path.join(real_folder, name)
+
+
+def open_header_cache(config, scanid_field, lookup_table):
+    """
+    Opens the study's dicom header cache, making sure it holds the scanid
+    field and any dicom_* fields in the lookup table. Returns None if the
+    cache can't be opened.
+    """
+    fields = datman.header_cache.HEADER_FIELDS + [scanid_field]
+    fields.extend(c.split("_")[1] for c in lookup_table.columns
+                  if c.startswith('dicom_'))
+    try:
+        return datman.header_cache.HeaderCache.from_config(config,
+                                                           fields=fields)
+    except Exception as e:
+        logger.warning('Cannot open dicom header cache, reading headers from '
+                       'every archive. Reason: {}'.format(e))
+        return None
+
 
 def link_archive(archive_path, dicom_path, scanid_field, config):
     if not os.path.isfile(archive_path):
@@ -176,7 +298,7 @@ def link_archive(archive_path, dicom_path, scanid_field, config):
         return
 
     try:
-        linked_path = already_linked[os.path.realpath(archive_path)]
+        linked_path = already_linked[get_real_path(archive_path)]
     except KeyError:
         linked_path = ""
 
@@ -231,32 +353,34 @@ def link_archive(archive_path, dicom_path, scanid_field, config):
 
 def get_scanid_from_lookup_table(archive_path):
     """
-    Gets the scanid from the lookup table (pandas dataframe)
+    Gets the scanid from the lookup table (see read_lookup_table)
 
-    Returns the scanid and the rest of the lookup table information (e.g.
-    expected dicom header matches). If no match is found, both the scan id and
-    lookup table info is None.
+    Returns the scanid and the expected dicom header matches as a tuple of
+    (field, value) pairs. If no match is found, returns None.
     """
     global lookup
     basename = os.path.basename(os.path.normpath(archive_path))
     source_name = basename[:-len(datman.utils.get_extension(basename))]
-    lookupinfo = lookup[lookup['source_name'] == source_name]
 
-    if len(lookupinfo) == 0:
+    try:
+        entry = lookup[source_name]
+    except KeyError:
         logger.debug("{} not found in source_name column."
                      .format(source_name))
         return
-    else:
-        scanid = lookupinfo['target_name'].tolist()[0]
-        return (scanid, lookupinfo)
+    return (entry.target_name, entry.dicom_fields)
 
 
 def get_archive_headers(archive_path):
     # get some DICOM headers from the archive
     header = None
     try:
-        header = datman.utils.get_archive_headers(archive_path,
-                                                  stop_after_first=True)
+        if archive_path in headers_read:
+            header = headers_read[archive_path]
+        else:
+            header = datman.utils.get_archive_headers(archive_path,
+                                                      stop_after_first=True,
+                                                      cache=header_cache)
         header = header.values()[0]
     except:
         logger.warn("Archive:{} contains no DICOMs".format(archive_path))
@@ -293,25 +417,21 @@ def validate_headers(archive_path, lookupinfo, scanid_field):
     """
     Validates an exam archive against the lookup table
 
-    Checks that all dicom_* dicom header fields match the lookup table
+    Checks that all dicom_* dicom header fields match the lookup table.
+    lookupinfo is the tuple of (field, expected value) pairs returned by
+    get_scanid_from_lookup_table
     """
     header = get_archive_headers(archive_path)
     if not header:
         return False
 
-    columns = lookupinfo.columns.values.tolist()
-    dicom_cols = [c for c in columns if c.startswith('dicom_')]
-
-    for c in dicom_cols:
-        f = c.split("_")[1]
-
+    for f, expected in lookupinfo:
         if f not in header:
             logger.error("{} field is not in {} dicom headers"
                          .format(scanid_field, archive_path))
             return False
 
         actual = str(header.get(f))
-        expected = str(lookupinfo[c].tolist()[0])
 
         if actual != expected:
             logger.error("{}: dicom field '{}' = '{}', expected '{}'"
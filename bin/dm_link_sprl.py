@@ -108,7 +108,7 @@ def process_session(cfg, db, dir_nii, dir_res, session):
         # Resources folders now require timepoint and session number. If user only
         # gives the first, check with a default session number before giving up.
         if not ident.session:
-            ident.session = '01'
+            ident = ident.replace(session='01')
             session_res = os.path.join(dir_res, str(ident))
         if os.path.isdir(session_res):
             subject_res = session_res
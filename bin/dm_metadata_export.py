@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Regenerates metadata/checklist.csv and metadata/blacklist.csv from the
+metadata database of a study that uses the sqlite backend
+(METADATA_BACKEND: sqlite in the study or site config).
+
+Datman itself reads the database directly, so this only needs to be run to
+keep the csv files current for people and tools that still read them.
+
+Usage:
+    dm_metadata_export.py [options] <study>
+
+Arguments:
+    <study>             The name of a study defined in the site config file
+
+Options:
+    --site-config FILE  The path to a site configuration file. If not set, the
+                        default defined for datman.config.config() is used.
+    --import            Add any entries found in the csv files to the database
+                        before exporting (e.g. ones added by hand)
+    --wal               Switch the database to write-ahead logging, so that
+                        reads don't wait on writers. The database keeps this
+                        setting. Don't use it if the metadata folder is on a
+                        network file system
+    -v --verbose
+    -d --debug
+    -q --quiet
+"""
+import os
+import sys
+import logging
+
+import datman.config
+import datman.metadata
+from datman.docopt import docopt
+
+logging.basicConfig(level=logging.WARN,
+        format="[%(name)s] %(levelname)s: %(message)s")
+logger = logging.getLogger(os.path.basename(__file__))
+
+def main():
+    arguments = docopt(__doc__)
+    study = arguments['<study>']
+    site_config = arguments['--site-config']
+    import_csv = arguments['--import']
+    wal = arguments['--wal']
+    verbose = arguments['--verbose']
+    debug = arguments['--debug']
+    quiet = arguments['--quiet']
+
+    if verbose:
+        logger.setLevel(logging.INFO)
+    if debug:
+        logger.setLevel(logging.DEBUG)
+    if quiet:
+        logger.setLevel(logging.ERROR)
+
+    config = datman.config.config(filename=site_config, study=study)
+
+    if config.get_metadata_backend() != 'sqlite':
+        logger.error("{} does not use the sqlite metadata backend. Nothing to "
+                "export".format(study))
+        sys.exit(1)
+
+    database_path = config.get_metadata_file('checklist')
+    meta_dir = config.get_path('meta')
+
+    with datman.metadata.MetadataDatabase(database_path,
+            wal=wal) as database:
+        for table in ['checklist', 'blacklist']:
+            csv_file = os.path.join(meta_dir, '{}.csv'.format(table))
+            if import_csv and os.path.exists(csv_file):
+                logger.info("Importing {}".format(csv_file))
+                database.import_csv(table, csv_file)
+            logger.info("Exporting {} to {}".format(table, csv_file))
+            database.export(table, csv_file)
+
+if __name__ == '__main__':
+    main()
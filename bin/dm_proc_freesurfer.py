@@ -111,12 +111,18 @@ def get_halted_subjects(fs_path, subjects):
     return halted
 
 def get_new_subjects(config, qc_subjects):
+    freesurfer_dir = utils.define_folder(config.get_path('freesurfer'))
+    # List the output folder once instead of checking every subject
+    existing_outputs = set(os.listdir(freesurfer_dir))
+
     fs_subjects = []
     for subject in qc_subjects:
         if sid.is_phantom(subject):
             logger.debug("Subject {} is a phantom. Skipping.".format(subject))
             continue
-        freesurfer_dir = utils.define_folder(config.get_path('freesurfer'))
+        if subject not in existing_outputs:
+            fs_subjects.append(subject)
+            continue
         fs_subject_dir = os.path.join(freesurfer_dir, subject)
         if not outputs_exist(fs_subject_dir):
             fs_subjects.append(subject)
@@ -168,12 +174,14 @@ def get_anatomical_images(key, cmd_line_arg, subject, blacklist, config, error_l
         input_tags = [input_tags]
 
     site_info = get_site_exportinfo(config, subject.site)
+    # Blacklist entries are series names without path or extension
+    blacklist = set(blacklist)
 
     inputs = []
     for tag in input_tags:
         n_expected = site_info.get(tag, 'Count')
-        candidates = filter(lambda nii: utils.splitext(nii.path)[0] not in blacklist,
-                subject.get_tagged_nii(tag))
+        candidates = filter(lambda nii: utils.splitext(nii.file_name)[0]
+                not in blacklist, subject.get_tagged_nii(tag))
 
         # fail if the wrong number of inputs for any tag is found (implies
         # blacklisting is required)
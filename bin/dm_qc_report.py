@@ -17,6 +17,7 @@ Options:
     -q --quiet         Only report errors
     -v --verbose       Be chatty
     -d --debug         Be extra chatty
+    --trace FILE       Write a Chrome trace of where the run spends its time to FILE (see datman.trace)
 
 Details:
     This program QCs the data contained in <NiftiDir> and <DicomDir>, and
@@ -96,9 +97,11 @@ import pandas as pd
 import nibabel as nib
 
 import datman.config
+import datman.metadata
 import datman.utils
 import datman.scanid
 import datman.scan
+import datman.trace
 
 from datman.docopt import docopt
 
@@ -352,6 +355,13 @@ def add_report_to_checklist(qc_report, checklist_path, retry=3):
     report_file_name = os.path.basename(qc_report)
     report_name, report_ext = os.path.splitext(report_file_name)
 
+    if datman.metadata.is_database(checklist_path):
+        # The database ignores duplicates and serializes concurrent writers
+        # itself, so there's no need to read the checklist first or retry
+        with datman.metadata.MetadataDatabase(checklist_path) as database:
+            database.add_checklist_entry(report_file_name)
+        return
+
     try:
         found_reports = find_existing_reports(checklist_path)
     except IOError:
@@ -796,7 +806,7 @@ def qc_subject(subject, config):
 
     try:
         # Update checklist even if report generation fails
-        checklist_path = os.path.join(config.get_path('meta'), 'checklist.csv')
+        checklist_path = config.get_metadata_file('checklist')
         add_report_to_checklist(report_name, checklist_path)
     except:
         logger.error("Error adding {} to checklist.".format(subject.full_id))
@@ -831,6 +841,10 @@ def qc_phantom(subject, config):
         logger.debug('qc {}'.format(nifti.path))
         handlers[nifti.tag](nifti.path, subject.qc_path)
 
+@datman.trace.traced('dm_qc_report.qc_single_scan',
+                     category='session',
+                     args=lambda subject, config: {
+                         'session': str(subject)})
 def qc_single_scan(subject, config):
     """
     Perform QC for a single subject or phantom. Return the report name if one
@@ -901,6 +915,10 @@ def prepare_scan(subject_id, config):
     """
     try:
         subject = datman.scan.Scan(subject_id, config)
+        # Scan reads its series folders lazily, so load them here where a
+        # misnamed file can still stop the run before any QC is done
+        subject.niftis
+        subject.dicoms
     except datman.scanid.ParseException as e:
         logger.error(e, exc_info=True)
         sys.exit(1)
@@ -957,6 +975,10 @@ def main():
     study = arguments['<study>']
     session = arguments['<session>']
     REWRITE = arguments['--rewrite']
+    trace_file = arguments['--trace']
+
+    if trace_file:
+        datman.trace.enable(trace_file)
 
     config = get_config(study)
 
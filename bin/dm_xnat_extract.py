@@ -20,6 +20,12 @@ Options:
     -c --credfile FILE       File containing XNAT username and password. The username should be on the first line, and password on the next. Overrides the credfile in the project metadata
     -u --username USER       XNAT username. If specified then the credentials file is ignored and you are prompted for password.
     --dont-update-dashboard  Dont update the dashboard database
+    --trace FILE             Write a Chrome trace of where the run spends its time to FILE (see datman.trace)
+    --workers N              Number of sessions to process at once [default: 1]
+    --prefetch N             Number of series to download ahead while the current one is converted. Each takes a temp folder the size of the series. 0 downloads each series only once the previous one is converted [default: 1]
+    --max-connections N      The most requests made to the xnat server at once, however many workers there are [default: 4]
+    --mirror                 Read xnat metadata from the local mirror (see datman.xnat_mirror), after syncing it with the server, so only sessions that changed are queried
+    --no-ledger              Don't use the export ledger (see datman.export_ledger). Series are skipped if files named like them exist in each export folder, and aren't re-exported when they change on xnat
 
 OUTPUT FOLDERS
     Each dicom series will be converted and placed into a subfolder of the
@@ -66,20 +72,26 @@ import logging
 import sys
 import datman.config
 import datman.xnat
+import datman.xnat_mirror
+import datman.export_ledger
 import datman.utils
 import datman.scanid
 import datman.dashboard
 import datman.exceptions
+import datman.trace
 import getpass
 import os
+import time
+import threading
+import collections
 import glob
 import tempfile
 import zipfile
 import fnmatch
 import platform
 import shutil
-import dicom
 import hashlib
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger(os.path.basename(__file__))
 
@@ -88,14 +100,36 @@ cfg = None
 dashboard = None
 excluded_studies = ['testing']
 DRYRUN = False
+PREFETCH = 1
+ledger = None
 db_ignore = False   # if true dont update the dashboard db
 
+# Sessions may be processed on several threads at once. The dashboard is
+# only used by one at a time, and each thread records which session it's
+# working on for the log
+dashboard_lock = threading.Lock()
+current = threading.local()
+
+# The version of each exporter recorded in the export ledger. Changing one
+# makes every series already exported in that format be exported again
+EXPORTER_VERSIONS = {
+    "mnc": "dcm2mnc/1",
+    "nii": "dcm2niix/1",
+    "nrrd": "DWIConvert/1",
+    "dcm": "cp/1"
+}
+
+# Totals for the run summary, see count()
+stats = collections.Counter()
+stats_lock = threading.Lock()
+
 def main():
     global xnat
     global cfg
     global excluded_studies
     global DRYRUN
-    global dashboard
+    global PREFETCH
+    global ledger
 
     arguments = docopt(__doc__)
     verbose = arguments['--verbose']
@@ -107,6 +141,14 @@ def main():
     username = arguments['--username']
     session = arguments['<session>']
     db_ignore = arguments['--dont-update-dashboard']
+    trace_file = arguments['--trace']
+    use_mirror = arguments['--mirror']
+    workers = int(arguments['--workers'])
+    max_connections = int(arguments['--max-connections'])
+    PREFETCH = int(arguments['--prefetch'])
+
+    if trace_file:
+        datman.trace.enable(trace_file)
 
     if arguments['--dry-run']:
         DRYRUN = True
@@ -126,9 +168,14 @@ def main():
         logger.setLevel(logging.DEBUG)
         ch.setLevel(logging.DEBUG)
 
-    formatter = logging.Formatter('%(asctime)s - %(name)s - {study} - '
-                                  '%(levelname)s - %(message)s'.format(
-                                      study=study))
+    log_format = '%(asctime)s - %(name)s - {study} - %(levelname)s - ' \
+                 '%(message)s'
+    if workers > 1:
+        # messages from different sessions are interleaved
+        log_format = log_format.replace('{study} - ',
+                                        '{study} - %(session)s - ')
+        ch.addFilter(SessionFilter())
+    formatter = logging.Formatter(log_format.format(study=study))
     ch.setFormatter(formatter)
 
     logger.addHandler(ch)
@@ -164,7 +211,31 @@ def main():
         username = os.environ["XNAT_USER"]
         password = os.environ["XNAT_PASS"]
 
-    xnat = datman.xnat.xnat(server, username, password)
+    xnat = datman.xnat.xnat(server, username, password,
+                            max_connections=max_connections)
+
+    # get the list of xnat projects linked to the datman study
+    xnat_projects = cfg.get_xnat_projects(study)
+
+    connection = xnat
+    if use_mirror:
+        xnat = open_mirror(cfg, connection, xnat_projects)
+
+    if not arguments['--no-ledger'] and not DRYRUN:
+        ledger = open_ledger(cfg)
+
+    try:
+        process_sessions(study, session, xnat_projects, workers, db_ignore)
+    finally:
+        if ledger is not None:
+            ledger.close()
+        if xnat is not connection:
+            xnat.close()
+
+def process_sessions(study, session, xnat_projects, workers, db_ignore):
+    """Exports the session given on the command line, or every session in
+    the study's xnat projects"""
+    global dashboard
 
     # setup the dashboard object
     if not db_ignore:
@@ -173,9 +244,6 @@ def main():
         except datman.dashboard.DashboardException as e:
             logger.error('Failed to initialise dashboard')
 
-    # get the list of xnat projects linked to the datman study
-    xnat_projects = cfg.get_xnat_projects(study)
-
     if session:
         # if session has been provided on the command line, identify which
         # project it is in
@@ -197,8 +265,84 @@ def main():
     logger.info('Found {} sessions for study: {}'
                 .format(len(sessions), study))
 
-    for session in sessions:
+    start = time.time()
+    if workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            pool.map(run_session, sessions, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for session in sessions:
+            run_session(session)
+
+    report_stats(time.time() - start)
+
+class SessionFilter(logging.Filter):
+    """Adds the session the current thread is working on to log records"""
+    def filter(self, record):
+        record.session = getattr(current, 'session', '-')
+        return True
+
+def count(name, amount=1):
+    """Adds amount to one of the totals reported at the end of the run"""
+    with stats_lock:
+        stats[name] += amount
+
+def report_stats(elapsed):
+    minutes = elapsed / 60
+    logger.info('Processed {} sessions in {:.1f} minutes ({:.1f} sessions/min)'
+                ', {} failed. Downloaded {:.1f} MB in {} series, ran {} '
+                'conversions'.format(stats['sessions'], minutes,
+                                     stats['sessions'] / minutes
+                                     if minutes else 0,
+                                     stats['failed'],
+                                     stats['bytes'] / 1e6,
+                                     stats['downloads'],
+                                     stats['conversions']))
+
+def run_session(session):
+    """Processes a session, so that an error only stops that session"""
+    current.session = session[1]
+    try:
         process_session(session)
+    except Exception as e:
+        logger.error('Failed processing session:{} with reason:{}'
+                     .format(session[1], e), exc_info=True)
+        count('failed')
+    finally:
+        count('sessions')
+        current.session = '-'
+
+def open_mirror(config, connection, xnat_projects):
+    """Syncs the study's xnat mirror and returns it to use in place of
+    the connection. Falls back to the connection if the mirror can't be
+    opened"""
+    try:
+        mirror = datman.xnat_mirror.XnatMirror.from_config(config, connection)
+    except Exception as e:
+        logger.warning('Cannot open xnat mirror, querying the server for '
+                       'everything. Reason: {}'.format(e))
+        return connection
+    try:
+        refreshed = mirror.sync(xnat_projects)
+    except:
+        mirror.close()
+        raise
+    logger.info('{} sessions changed on xnat since the last sync'
+                .format(len(refreshed)))
+    return mirror
+
+def open_ledger(config):
+    """Opens the study's export ledger, or returns None if it can't be
+    opened so that exports are checked for on disk instead"""
+    try:
+        return datman.export_ledger.ExportLedger.from_config(config)
+    except Exception as e:
+        logger.warning('Cannot open export ledger, checking for exported '
+                       'files on disk instead. Reason: {}'.format(e))
+        return None
 
 def collect_sessions(xnat_projects, config):
     sessions = []
@@ -222,6 +366,9 @@ def collect_sessions(xnat_projects, config):
             sessions.append((project, session['label']))
     return sessions
 
+@datman.trace.traced('dm_xnat_extract.process_session',
+                     category='session',
+                     args=lambda session: {'session': session[1]})
 def process_session(session):
     xnat_project = session[0]
     session_label = session[1]
@@ -231,31 +378,40 @@ def process_session(session):
 
     # check the session is valid on xnat
     try:
-        xnat.get_session(xnat_project, session_label)
+        xnat_session = xnat.get_session(xnat_project, session_label)
     except Exception as e:
         return
-
-    try:
-        experiments = xnat.get_experiments(xnat_project, session_label)
-    except Exception as e:
-        logger.warning('Failed getting experiments for:{} in project:{}'
-                       ' with reason:{}'
-                       .format(session_label, xnat_project, e))
+    if isinstance(xnat_session, Exception):
         return
 
-    if len(experiments) > 1:
+    # the session's document normally holds its experiments, but can be
+    # missing them, in which case they're listed separately
+    experiments = datman.xnat.get_session_experiments(xnat_session)
+    if experiments is not None:
+        experiment_labels = [e['data_fields']['label'] for e in experiments]
+    else:
+        try:
+            experiments = xnat.get_experiments(xnat_project, session_label)
+        except Exception as e:
+            logger.warning('Failed getting experiments for:{} in project:{}'
+                           ' with reason:{}'
+                           .format(session_label, xnat_project, e))
+            return
+        experiment_labels = [e['label'] for e in experiments or []]
+
+    if len(experiment_labels) > 1:
         logger.error('Found more than one experiment for session:{}'
                        'in study:{} Skipping'
                        .format(session_label, xnat_project))
         return
 
-    if not experiments:
+    if not experiment_labels:
         logger.error('Session:{} in study:{} has no experiments'
                      .format(session_label, xnat_project))
         return
 
 
-    experiment_label = experiments[0]['label']
+    experiment_label = experiment_labels[0]
     # sesssion_label should be a valid datman scanid
     try:
         ident = datman.scanid.parse(session_label)
@@ -270,9 +426,12 @@ def process_session(session):
                                session_label))
 
     try:
-        experiment = xnat.get_experiment(xnat_project,
-                                         session_label,
-                                         experiment_label)
+        if experiments[0].get('children'):
+            experiment = experiments[0]
+        else:
+            experiment = xnat.get_experiment(xnat_project,
+                                             session_label,
+                                             experiment_label)
     except Exception as e:
         logger.error('Failed getting experiment for session:{} with reason'
                      .format(session_label, e))
@@ -287,12 +446,13 @@ def process_session(session):
         logger.debug('Adding session:{} to db'.format(session_label))
         try:
             db_session_name = ident.get_full_subjectid_with_timepoint()
-            db_session = dashboard.get_add_session(db_session_name,
-                                                   date=experiment['data_fields']['date'],
-                                                   create=True)
-            if ident.session and int(ident.session) > 1:
-                db_session.is_repeated = True
-                db_session.repeat_count = int(ident.session)
+            with dashboard_lock:
+                db_session = dashboard.get_add_session(db_session_name,
+                                                       date=experiment['data_fields']['date'],
+                                                       create=True)
+                if ident.session and int(ident.session) > 1:
+                    db_session.is_repeated = True
+                    db_session.repeat_count = int(ident.session)
 
         except datman.dashboard.DashboardException as e:
                 logger.error('Failed adding session:{} to dashboard'
@@ -556,13 +716,24 @@ def process_scans(xnat_project, session_label, experiment_label, scans):
     # need to keep a list of scans added to dashboard
     # so we can delete any scans that no longer exist
     scans_added = []
+    series_to_export = []
 
+    scan_infos = None
     for scan in scans['items']:
         series_id = scan['data_fields']['ID']
-        scan_info = xnat.get_scan_info(xnat_project,
-                                       session_label,
-                                       experiment_label,
-                                       series_id)
+        # the experiment's document normally has the file info for each scan
+        if datman.xnat.has_file_info(scan):
+            scan_info = scan
+        else:
+            if scan_infos is None:
+                scan_infos = get_scan_infos(xnat_project, session_label,
+                                            experiment_label)
+            scan_info = scan_infos.get(series_id)
+        if scan_info is None:
+            scan_info = xnat.get_scan_info(xnat_project,
+                                           session_label,
+                                           experiment_label,
+                                           series_id)
 
         file_stem, tag = create_scan_name(exportinfo, scan_info, session_label)
         if not file_stem:
@@ -584,20 +755,32 @@ def process_scans(xnat_project, session_label, experiment_label, scans):
         if dashboard:
             logger.info('Adding scan:{} to dashboard'.format(file_stem))
             try:
-                dashboard.get_add_scan(file_stem, create=True)
+                with dashboard_lock:
+                    dashboard.get_add_scan(file_stem, create=True)
                 scans_added.append(file_stem)
             except datman.dashboard.DashboardException as e:
                 logger.error('Failed adding scan:{} to dashboard with error:{}'
                              .format(file_stem, str(e)))
 
-        # check the blacklist
-        logger.debug('Checking blacklist for file:{}'.format(file_stem))
+        series_to_export.append((series_id, file_stem, tag,
+                                 get_source(scan_info)))
+
+    # check the whole session against the blacklist at once
+    logger.debug('Checking blacklist for session:{}'.format(session_label))
+    blacklist = datman.utils.check_blacklist_many(
+            [series[1] for series in series_to_export],
+            study=cfg.study_name)
+
+    # what has been exported is looked up in the ledger, and its outputs in
+    # one listing of each export folder
+    exported = ledger.get_session(session_label) if ledger else {}
+    listing = datman.export_ledger.OutputListing()
 
-        blacklist = datman.utils.check_blacklist(file_stem,
-                                                 study=cfg.study_name)
-        if blacklist:
+    series_to_get = []
+    for series_id, file_stem, tag, source in series_to_export:
+        if blacklist[file_stem] is not None:
             logger.warning('Excluding scan:{} due to blacklist:{}'
-                           .format(file_stem, blacklist))
+                           .format(file_stem, blacklist[file_stem]))
             continue
 
         # first check if the scan has already been processed
@@ -607,60 +790,116 @@ def process_scans(xnat_project, session_label, experiment_label, scans):
             logger.error('Export settings for tag:{} not found for study:{}'
                          .format(tag, cfg.study_name))
             continue
-        if check_if_dicom_is_processed(ident,
-                                       file_stem,
-                                       export_formats):
+        if ledger:
+            export_formats = get_formats_to_export(ident, session_label,
+                    file_stem, export_formats, source, exported, listing)
+            if not export_formats:
+                logger.info('Scan:{} has been processed, skipping'
+                            .format(file_stem))
+                continue
+        elif check_if_dicom_is_processed(ident,
+                                         file_stem,
+                                         export_formats):
             logger.info('Scan:{} has been processed, skipping'
                         .format(file_stem))
             continue
 
-        logger.debug('Getting scan from xnat')
-        # scan hasn't been completely processed, get it from xnat
-        with datman.utils.make_temp_directory(prefix='dm2_xnat_extract_') as temp_dir:
-            src_dir = get_dicom_archive_from_xnat(xnat_project, session_label,
-                    experiment_label, series_id, temp_dir)
+        series_to_get.append((series_id, file_stem, export_formats, source))
+
+    # scans that haven't been completely processed are fetched from xnat.
+    # The next PREFETCH series download while the current one is converted
+    def download(series):
+        current.session = session_label
+        return download_series(xnat_project, session_label, experiment_label,
+                               series[0])
+
+    downloads = datman.utils.prefetch(series_to_get, download, depth=PREFETCH,
+                                      release=remove_download)
+    for (series_id, file_stem, export_formats, source), (temp_dir, src_dir) \
+            in downloads:
+        if not src_dir:
+            logger.error('Failed getting series:{}, session:{} from xnat'
+                         .format(series_id, session_label))
+            continue
 
-            if not src_dir:
-                logger.error('Failed getting series:{}, session:{} from xnat'
-                             .format(series_id, session_label))
+        for export_format in export_formats:
+            target_base_dir = cfg.get_path(export_format)
+            target_dir = os.path.join(target_base_dir,
+                                      ident.get_full_subjectid_with_timepoint())
+            try:
+                target_dir = datman.utils.define_folder(target_dir)
+            except OSError as e:
+                logger.error('Failed creating target folder:{}'
+                             .format(target_dir))
                 continue
 
-            for export_format in export_formats:
-                target_base_dir = cfg.get_path(export_format)
-                target_dir = os.path.join(target_base_dir,
-                                          ident.get_full_subjectid_with_timepoint())
-                try:
-                    target_dir = datman.utils.define_folder(target_dir)
-                except OSError as e:
-                    logger.error('Failed creating target folder:{}'
-                                 .format(target_dir))
-                    continue
-                
-                try:
-                    exporter = xporters[export_format]
-                except KeyError:
-                    logger.error("Export format {} not defined.".format(export_format))
-
-                logger.info('Exporting scan {} to format {}'.format(file_stem,
-                        export_format))
-                try:
+            try:
+                exporter = xporters[export_format]
+            except KeyError:
+                logger.error("Export format {} not defined.".format(export_format))
+
+            logger.info('Exporting scan {} to format {}'.format(file_stem,
+                    export_format))
+            try:
+                with datman.trace.span('export', category='convert',
+                                       scan=file_stem, format=export_format):
                     exporter(src_dir, target_dir, file_stem)
-                except:
-                    logger.error("An error happened exporting {} from scan: {} "
-                            "in session: {}".format(export_format, series_id,
-                            session_label), exc_info=True)
+                count('conversions')
+            except:
+                logger.error("An error happened exporting {} from scan: {} "
+                        "in session: {}".format(export_format, series_id,
+                        session_label), exc_info=True)
+                continue
+
+            if ledger:
+                record_export(session_label, file_stem, export_format, source,
+                              target_dir)
 
         logger.debug('Completed exports')
 
     # finally delete any extra scans that exist in the dashboard
     if dashboard:
         try:
-            dashboard.delete_extra_scans(session_label, scans_added)
+            with dashboard_lock:
+                dashboard.delete_extra_scans(session_label, scans_added)
         except Exception as e:
             logger.error('Failed deleting extra scans from session:{} with excuse:{}'
                          .format(session_label, e))
 
 
+def get_scan_infos(xnat_project, session_label, experiment_label):
+    """Gets the info for every scan in an experiment in one query. Returns a
+    dictionary of series ID to scan info, holding only the scans that
+    include their file info"""
+    try:
+        scans = xnat.get_scans(xnat_project, session_label, experiment_label)
+    except Exception as e:
+        logger.warning('Failed getting scans for session:{} with reason:{}'
+                       .format(session_label, e))
+        return {}
+    return dict((scan['data_fields']['ID'], scan) for scan in scans or []
+                if datman.xnat.has_file_info(scan))
+
+
+def download_series(xnat_project, session_label, experiment_label, series):
+    """Downloads a series into a new temp folder. Returns the temp folder
+    and the folder of dicoms in it, which is None if the download failed"""
+    logger.debug('Getting scan from xnat')
+    temp_dir = tempfile.mkdtemp(prefix='dm2_xnat_extract_')
+    try:
+        src_dir = get_dicom_archive_from_xnat(xnat_project, session_label,
+                experiment_label, series, temp_dir)
+    except Exception as e:
+        logger.error('Failed getting series:{}, session:{} with reason:{}'
+                     .format(series, session_label, e))
+        src_dir = None
+    return temp_dir, src_dir
+
+
+def remove_download(download):
+    shutil.rmtree(download[0], ignore_errors=True)
+
+
 def get_dicom_archive_from_xnat(xnat_project, session_label, experiment_label,
                                 series, tempdir):
     """Downloads and extracts a dicom archive from xnat to a local temp folder
@@ -685,38 +924,36 @@ def get_dicom_archive_from_xnat(xnat_project, session_label, experiment_label,
     try:
         with zipfile.ZipFile(dicom_archive[1], 'r') as myzip:
             myzip.extractall(tempdir)
+            base_dir = find_dicom_folder(myzip, tempdir)
     except:
         logger.error('An error occurred unpacking dicom archive for:{}'
                      ' skipping'.format(session_label))
         os.remove(dicom_archive[1])
         return None
 
+    count('downloads')
+    count('bytes', os.path.getsize(dicom_archive[1]))
     logger.debug('Deleting archive file')
     os.remove(dicom_archive[1])
-    # get the root dir for the extracted files
-    archive_files = []
-    for root, dirname, filenames in os.walk(tempdir):
-        for filename in filenames:
-            f = os.path.join(root, filename)
-            if is_valid_dicom(f):
-                archive_files.append(f)
 
-    try:
-        base_dir = os.path.dirname(archive_files[0])
-    except IndexError:
+    if not base_dir:
         logger.warning('There were no valid dicom files in xnat session:{}, series:{}'
                        .format(session_label, series))
         return None
     return base_dir
 
-def is_valid_dicom(filename):
-    try:
-        dicom.read_file(filename)
-    except IOError:
-        return
-    except dicom.errors.InvalidDicomError:
-        return
-    return True
+def find_dicom_folder(archive, tempdir):
+    """Returns the folder an archive extracted into tempdir put its first
+    valid dicom in, or None if it held no dicoms. The files are taken from
+    the zip's central directory, so the extracted tree isn't walked, and
+    each is checked by its magic number and header only"""
+    for member in archive.infolist():
+        if member.filename.endswith('/'):
+            continue
+        path = os.path.join(tempdir, *member.filename.split('/'))
+        if datman.utils.is_dicom_file(path):
+            return os.path.dirname(path)
+    return None
 
 
 def get_resource_archive_from_xnat(xnat_project, session, resourceid):
@@ -754,6 +991,81 @@ def check_if_dicom_is_processed(ident, file_stem, export_formats):
     return True
 
 
+def get_source(scan_info):
+    """Returns what the ledger records about a scan on xnat to tell whether
+    it changed since it was exported: its UID, and the number and total size
+    of its raw dicom files"""
+    file_count = None
+    file_size = None
+    for child in scan_info.get('children', []):
+        for item in child['items']:
+            fields = item['data_fields']
+            if fields.get('content') != 'RAW':
+                continue
+            if 'file_count' in fields:
+                file_count = (file_count or 0) + int(fields['file_count'])
+            if 'file_size' in fields:
+                file_size = (file_size or 0) + int(fields['file_size'])
+    return datman.export_ledger.Source(scan_info['data_fields'].get('UID'),
+                                       file_count, file_size)
+
+
+def get_formats_to_export(ident, session_label, file_stem, export_formats,
+                          source, exported, listing):
+    """Returns the formats a series needs exporting to, according to the
+    export ledger. Outputs of a series that changed on xnat or only
+    partly exist are removed, so it's exported again from scratch"""
+    formats = []
+    for export_format in export_formats:
+        export = exported.get((file_stem, export_format))
+        version = EXPORTER_VERSIONS.get(export_format)
+        if datman.export_ledger.is_current(export, source, version, listing):
+            continue
+
+        if export is None:
+            # exported before the ledger was kept. Trust what's on disk
+            # and record it, so it's only looked for there once
+            if check_if_dicom_is_processed(ident, file_stem,
+                                           [export_format]):
+                record_export(session_label, file_stem, export_format,
+                              source, os.path.join(
+                                  cfg.get_path(export_format),
+                                  ident.get_full_subjectid_with_timepoint()))
+                continue
+        else:
+            if export.source != source:
+                logger.info('Scan:{} changed on xnat since it was exported '
+                            'to {}, exporting again'.format(file_stem,
+                            export_format))
+            elif export.exporter != version:
+                logger.info('Scan:{} was exported to {} by {}, exporting '
+                            'again with {}'.format(file_stem, export_format,
+                            export.exporter, version))
+            else:
+                logger.info('Scan:{} is missing {} outputs, exporting again'
+                            .format(file_stem, export_format))
+            for path in export.outputs:
+                if os.path.exists(path):
+                    logger.debug('Removing outdated output {}'.format(path))
+                    os.remove(path)
+            ledger.forget(file_stem, export_format)
+        formats.append(export_format)
+    return formats
+
+
+def record_export(session_label, file_stem, export_format, source,
+                  target_dir):
+    """Records the files an export made in the export ledger"""
+    outputs = [p for p in glob.glob(os.path.join(target_dir, file_stem) + '.*')
+               if os.path.isfile(p)]
+    if not outputs:
+        logger.error('Exporting scan:{} to {} made no files'
+                     .format(file_stem, export_format))
+        return
+    ledger.record(session_label, file_stem, export_format, source,
+                  EXPORTER_VERSIONS.get(export_format), outputs)
+
+
 def check_create_dir(target):
     """Checks to see if a directory exists, creates if not"""
     if not os.path.isdir(target):
@@ -761,6 +1073,9 @@ def check_create_dir(target):
         try:
             os.makedirs(target)
         except OSError as e:
+            # another worker may have just made it
+            if os.path.isdir(target):
+                return
             logger.error('Failed creating dir:{}.'.format(target))
             raise e
 
@@ -858,12 +1173,9 @@ def export_dcm_command(seriesdir, outputdir, stem):
 
     dcmfile = None
     for path in glob.glob(seriesdir + '/*'):
-        try:
-            dicom.read_file(path)
+        if datman.utils.is_dicom_file(path):
             dcmfile = path
             break
-        except dicom.filereader.InvalidDicomError as e:
-            pass
 
     if not dcmfile:
         logger.error("No dicom files found in {}".format(seriesdir))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Brings a study's local mirror of its XNAT metadata (see datman.xnat_mirror) up
+to date. dm_xnat_extract.py, dm_xnat_upload.py and dm_xnat_project_overview.py
+read from the mirror when given --mirror.
+
+Usage:
+    dm_xnat_mirror.py [options] <study>
+
+Arguments:
+    <study>             Nickname of the study to sync
+
+Options:
+    --server URL        XNAT server to connect to, overrides the server defined
+                        in the site config file.
+    --db FILE           The mirror database to sync. Defaults to
+                        xnat_mirror.sqlite in the study's metadata folder
+    --full              Re-read every session, not just those that changed
+    -v --verbose
+    -d --debug
+    -q --quiet
+
+Details:
+    The XNAT username and password are read from the XNAT_USER and XNAT_PASS
+    environment variables.
+
+    Each XNAT project linked to the study is listed with two queries. Only
+    sessions with experiments that were added, modified (according to XNAT's
+    last_modified date) or deleted since the last sync are read again.
+"""
+import os
+import sys
+import time
+import logging
+
+import datman.config
+import datman.xnat
+import datman.xnat_mirror
+from datman.docopt import docopt
+
+logging.basicConfig(level=logging.WARN,
+        format="[%(name)s] %(levelname)s: %(message)s")
+logger = logging.getLogger(os.path.basename(__file__))
+
+def main():
+    arguments = docopt(__doc__)
+    study = arguments['<study>']
+    server = arguments['--server']
+    db_path = arguments['--db']
+    full = arguments['--full']
+    verbose = arguments['--verbose']
+    debug = arguments['--debug']
+    quiet = arguments['--quiet']
+
+    if verbose:
+        logger.setLevel(logging.INFO)
+        logging.getLogger('datman.xnat_mirror').setLevel(logging.INFO)
+    if debug:
+        logger.setLevel(logging.DEBUG)
+        logging.getLogger('datman.xnat_mirror').setLevel(logging.DEBUG)
+    if quiet:
+        logger.setLevel(logging.ERROR)
+
+    config = datman.config.config(study=study)
+
+    if not server:
+        try:
+            server = 'https://{}:{}'.format(config.get_key(['XNATSERVER']),
+                                            config.get_key(['XNATPORT']))
+        except KeyError:
+            logger.error('Failed to get xnat server info for study:{}'
+                         .format(study))
+            sys.exit(1)
+
+    try:
+        username = os.environ["XNAT_USER"]
+        password = os.environ["XNAT_PASS"]
+    except KeyError:
+        logger.error('XNAT_USER and XNAT_PASS must be set')
+        sys.exit(1)
+
+    connection = datman.xnat.xnat(server, username, password)
+    projects = config.get_xnat_projects(study)
+
+    start = time.time()
+    with datman.xnat_mirror.XnatMirror.from_config(config, connection,
+            db_path=db_path) as mirror:
+        if full:
+            for project in projects:
+                for session in mirror.get_sessions(project):
+                    mirror.forget(project, session['label'])
+        refreshed = mirror.sync(projects)
+
+    logger.info('Synced {} projects in {:.1f}s, {} sessions refreshed'.format(
+            len(projects), time.time() - start, len(refreshed)))
+
+if __name__ == '__main__':
+    main()
@@ -25,6 +25,10 @@ Options:
                                 xnat username and password to use. Overrides
                                 the xnat-credentials file expected in
                                 a project's metadata folder
+    --mirror                    Read the MR labels and dates from the local
+                                xnat mirror (see datman.xnat_mirror), after
+                                syncing it, instead of listing every
+                                experiment on the server
     -q, --quiet
     -d, --debug
     -v, --verbose
@@ -40,6 +44,9 @@ import pyxnat
 
 import datman.config
 import datman.utils
+import datman.exceptions
+import datman.xnat
+import datman.xnat_mirror
 
 logging.basicConfig(level=logging.WARN,
         format="[%(name)s] %(levelname)s: %(message)s")
@@ -55,6 +62,7 @@ def main():
     quiet = arguments['--quiet']
     debug = arguments['--debug']
     verbose = arguments['--verbose']
+    use_mirror = arguments['--mirror']
 
     if verbose:
         logger.setLevel(logging.INFO)
@@ -77,9 +85,13 @@ def main():
             password) as xnat_connection:
         overviews = get_session_overviews(xnat_connection, xnat_project_names)
 
-    with requests.Session() as session:
-        session.auth = (username, password)
-        MR_ids = get_MR_ids(session, xnat_url, xnat_project_names)
+    if use_mirror:
+        MR_ids = get_mirrored_MR_ids(config, xnat_url, username, password,
+                xnat_project_names)
+    else:
+        with requests.Session() as session:
+            session.auth = (username, password)
+            MR_ids = get_MR_ids(session, xnat_url, xnat_project_names)
 
     merged_records = merge_overview_and_labels(overviews, MR_ids)
     write_overview_csv(merged_records, output_file)
@@ -143,6 +155,20 @@ def get_MR_ids(xnat_session, xnat_url, xnat_projects):
         MR_ids.extend(mr_id_records)
     return MR_ids
 
+def get_mirrored_MR_ids(config, xnat_url, username, password, xnat_projects):
+    connection = datman.xnat.xnat(xnat_url, username, password)
+    MR_ids = []
+    with datman.xnat_mirror.XnatMirror.from_config(config,
+            connection) as mirror:
+        mirror.sync(xnat_projects)
+        for project in xnat_projects:
+            try:
+                MR_ids.extend(mirror.get_project_experiments(project))
+            except datman.exceptions.XnatException as e:
+                logger.error("Failed to get MR IDs for project {}. Reason: "
+                        "{}".format(project, e))
+    return MR_ids
+
 def select_MR_summary(xnat_session, xnat_url, project, retry=3):
     if retry == 0:
         logger.error("Failed to get MR IDs for project {}".format(project))
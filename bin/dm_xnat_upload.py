@@ -17,6 +17,9 @@ Options:
     -v --verbose          Be chatty
     -d --debug            Be very chatty
     -q --quiet            Be quiet
+    --jobs N              Number of archives to read dicom headers from at once. Archives are still uploaded one at a time [default: 1]
+    --no-header-cache     Read the headers of every archive instead of using the headers cached from earlier runs
+    --mirror              Read xnat metadata from the local mirror (see datman.xnat_mirror), after syncing it with the server, so only sessions that changed are queried
 """
 
 import logging
@@ -26,7 +29,9 @@ import datman.config
 import datman.utils
 import datman.scanid
 import datman.xnat
+import datman.xnat_mirror
 import datman.exceptions
+import datman.header_cache
 import os
 import getpass
 import zipfile
@@ -42,6 +47,8 @@ password = None
 server = None
 XNAT = None
 CFG = None
+HEADER_CACHE = None
+LOCAL_HEADERS = {}
 
 def main():
     global username
@@ -49,6 +56,7 @@ def main():
     global password
     global XNAT
     global CFG
+    global HEADER_CACHE
 
     arguments = docopt(__doc__)
     verbose = arguments['--verbose']
@@ -59,6 +67,9 @@ def main():
     credfile = arguments['--credfile']
     username = arguments['--username']
     archive = arguments['<archive>']
+    use_cache = not arguments['--no-header-cache']
+    jobs = int(arguments['--jobs'])
+    use_mirror = arguments['--mirror']
 
     # setup logging
     ch = logging.StreamHandler(sys.stdout)
@@ -88,6 +99,38 @@ def main():
 
     XNAT = get_xnat(server=server, credfile=credfile, username=username)
 
+    mirror = None
+    if use_mirror:
+        try:
+            mirror = datman.xnat_mirror.XnatMirror.from_config(CFG, XNAT)
+        except Exception as e:
+            logger.warning('Cannot open xnat mirror, querying the server for '
+                           'everything. Reason: {}'.format(e))
+
+    if use_cache:
+        try:
+            HEADER_CACHE = datman.header_cache.HeaderCache.from_config(CFG)
+        except Exception as e:
+            logger.warning('Cannot open dicom header cache, reading headers '
+                           'from every archive. Reason: {}'.format(e))
+
+    try:
+        if mirror is not None:
+            mirror.sync(CFG.get_xnat_projects(study))
+            XNAT = mirror
+        process_archives(study, archive, jobs)
+    finally:
+        if HEADER_CACHE is not None:
+            HEADER_CACHE.close()
+        if mirror is not None:
+            mirror.close()
+
+
+def process_archives(study, archive, jobs):
+    """Upload the archive given on the command line, or every archive in the
+    study's dicom folder"""
+    global LOCAL_HEADERS
+
     dicom_dir = CFG.get_path('dicom', study)
     # deal with a single archive specified on the command line,
     # otherwise process all files in dicom_dir
@@ -108,6 +151,12 @@ def main():
     logger.debug('Processing files in:{}'.format(dicom_dir))
     logger.info('Processing {} files'.format(len(archives)))
 
+    if jobs > 1:
+        LOCAL_HEADERS = datman.utils.get_archive_headers_many(
+                [os.path.join(dicom_dir, archivefile)
+                 for archivefile in archives],
+                cache=HEADER_CACHE, jobs=jobs)
+
     for archivefile in archives:
         process_archive(os.path.join(dicom_dir, archivefile))
 
@@ -311,7 +360,11 @@ def check_files_exist(archive, xnat_session, ident):
     scanid = str(ident)
     logger.info('Checking for archive:{} contents on xnat'.format(scanid))
     try:
-        local_headers = datman.utils.get_archive_headers(archive)
+        if archive in LOCAL_HEADERS:
+            local_headers = LOCAL_HEADERS[archive]
+        else:
+            local_headers = datman.utils.get_archive_headers(archive,
+                    cache=HEADER_CACHE)
     except:
         logger.error('Failed getting archive headers for:'.format(archive))
         return False, False
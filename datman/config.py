@@ -5,13 +5,36 @@ environment variable os.environ['DM_CONFIG']
 The system is identified from os.environ['DM_SYSTEM']
 
 These can both be overridden at __init__
+
+Parsed yaml files are cached as pickled snapshots so that the many short lived
+processes that read the same config files don't all have to re-parse them. The
+snapshots are stored in os.environ['DM_CONFIG_CACHE'] (default
+~/.cache/datman/config), setting this variable to an empty string disables the
+cache. A snapshot is only used if the size and modification time of its yaml
+file haven't changed since it was made.
+
+Code that only needs to read settings should use get_config(), which hands out
+one shared read-only instance per site config file, system and study instead
+of building (and re-reading) a new config object for every call.
 """
 import logging
 import yaml
 import os
+import copy
+import time
+import hashlib
+import tempfile
+import threading
 import datman.scanid
+import datman.metadata
+import datman.trace
 from future.utils import iteritems
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 logger = logging.getLogger(__name__)
 
 #python 2 - 3 compatibility hack
@@ -20,6 +43,67 @@ try:
 except NameError:
     basestring = str
 
+# Use libyaml's parser when pyyaml was built with it, it's much faster.
+YAML_LOADER = getattr(yaml, 'CLoader', yaml.Loader)
+
+# Increment this if the snapshot format changes, to invalidate old snapshots
+SNAPSHOT_VERSION = 1
+
+# Maps (site config file, config dir) to an index of lower case study and site
+# tags -> project name. Built the first time a tag needs resolving so later
+# lookups don't have to read every project's settings file.
+_PROJECT_INDEX = {}
+
+
+# Maps (site config file, system, project) to the shared read-only config
+# instances returned by get_config()
+_CONFIG_REGISTRY = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_config(filename=None, system=None, study=None):
+    """
+    Returns a shared, read-only config instance for the given site config file,
+    system and study. The arguments are interpreted the same way as for
+    config.__init__, and study may also be a tag or full session ID.
+
+    Instances are created once per process and then reused, so they must not
+    be modified. Calling set_study() or set_system() on them with a different
+    value raises a RuntimeError, callers that need to do this should work on
+    the result of copy() instead.
+    """
+    if not filename:
+        filename = os.environ.get('DM_CONFIG')
+    if not system:
+        system = os.environ.get('DM_SYSTEM')
+    if not filename or not system:
+        # Let config raise the usual errors about a missing environment
+        return config(filename=filename, system=system, study=study)
+
+    site_key = (os.path.abspath(filename), system, None)
+    with _REGISTRY_LOCK:
+        try:
+            site_config = _CONFIG_REGISTRY[site_key]
+        except KeyError:
+            site_config = config(filename=filename, system=system)
+            site_config.read_only = True
+            _CONFIG_REGISTRY[site_key] = site_config
+
+        if not study:
+            return site_config
+
+        project = site_config.get_project_name(study)
+        study_key = (site_key[0], system, project)
+        try:
+            return _CONFIG_REGISTRY[study_key]
+        except KeyError:
+            pass
+        study_config = site_config.copy()
+        study_config.set_study(project)
+        study_config.read_only = True
+        _CONFIG_REGISTRY[study_key] = study_config
+        return study_config
+
 
 class config(object):
     site_config = None
@@ -27,6 +111,9 @@ class config(object):
     system_config = None
     study_name = None
     study_config_file = None
+    site_config_file = None
+    system = None
+    read_only = False
 
     def __init__(self, filename=None, system=None, study=None):
         """Class object representing the site-wide configuration files.
@@ -48,6 +135,9 @@ class config(object):
                 raise
 
         self.site_config = self.load_yaml(filename)
+        self.site_config_file = filename
+        self._scope_tables = {}
+        self._tags = {}
 
         if not system:
             try:
@@ -61,23 +151,59 @@ class config(object):
         if study:
             self.set_study(study)
 
+    @datman.trace.traced('config.load_yaml', category='config',
+            args=lambda self, filename: {'filename': filename})
     def load_yaml(self, filename):
         ## Read in the configuration yaml file
         if not os.path.isfile(filename):
             raise ValueError("configuration file {} not found. Try again."
                              .format(filename))
 
-        ## load the yml file
-        with open(filename, 'r') as stream:
-            config_yaml = yaml.load(stream)
+        start = time.time()
+        config_yaml = read_snapshot(filename)
+        if config_yaml is not None:
+            logger.debug('Loaded snapshot of {} in {:.4f}s'.format(filename,
+                    time.time() - start))
+            return config_yaml
+
+        config_yaml = parse_yaml(filename)
+        logger.debug('Parsed {} in {:.4f}s'.format(filename,
+                time.time() - start))
+        write_snapshot(filename, config_yaml)
 
         return config_yaml
 
+    def copy(self):
+        """
+        Returns a modifiable copy of this config. The parsed yaml is shared
+        with the original, so only the set_* methods should be used to change
+        it.
+        """
+        new_config = copy.copy(self)
+        new_config.read_only = False
+        return new_config
+
     def set_system(self, system):
         if not self.site_config:
             logger.error('Site config not set')
             raise ValueError
+        if self.read_only and system != self.system:
+            raise RuntimeError("Can't change the system of a shared config. "
+                    "Use copy() to get a modifiable config.")
         self.system_config = self.site_config['SystemSettings'][system]
+        self.system = system
+
+    def get_project_name(self, study_name):
+        """
+        Returns the name of the project that study_name (a project name, study
+        tag, or full session ID) refers to, without changing the current
+        study.
+        """
+        valid_projects = {k.lower(): k
+                          for k in self.site_config['Projects']}
+        if study_name.lower() in valid_projects:
+            return study_name.upper()
+        return self._find_project(study_name)
 
     def set_study(self, study_name):
         """
@@ -85,17 +211,16 @@ class config(object):
         where possible, please give it an exact match to a project name or a full
         session ID.
         """
-        # make the supplied project_name case insensitive
-        valid_projects = {k.lower(): k
-                          for k in self.site_config['Projects']}
+        # This will raise an exception if given only the 'DTI' id because
+        # two studies are mapped to this ID. Give set_study() a full
+        # session ID to avoid this
+        study_name = self.get_project_name(study_name)
 
-        if study_name.lower() in valid_projects:
-            study_name = study_name.upper()
-        else:
-            ## This will raise an exception if given only the 'DTI' id because
-            ## two studies are mapped to this ID. Give set_study() a full
-            ## session ID to avoid this
-            study_name = self.map_xnat_archive_to_project(study_name)
+        if self.read_only:
+            if study_name == self.study_name:
+                return
+            raise RuntimeError("Can't change the study of a shared config. "
+                    "Use copy() to get a modifiable config.")
 
         self.study_name = study_name
 
@@ -106,6 +231,8 @@ class config(object):
 
         self.study_config = self.load_yaml(project_settings_file)
         self.study_config_name = project_settings_file
+        self._scope_tables = {}
+        self._tags = {}
 
     def get_study_base(self, study=None):
         """Return the base directory for a study"""
@@ -137,6 +264,15 @@ class config(object):
         DTI3T), the site is used to differentiate between them. As a result, if
         only a 'DTI' project tag is given this function raises an exception.
         """
+        project = self._find_project(filename)
+        self.set_study(project)
+        return project
+
+    def _find_project(self, filename):
+        """Returns the name of the project that the study tag (or the study tag
+        of the full ID) in filename belongs to, without changing the study
+        that is currently set.
+        """
         logger.debug('Searching projects for: {}'.format(filename))
 
         try:
@@ -158,46 +294,77 @@ class config(object):
 
         # If a valid project name was given instead of a study tag, return that
         if tag in self.site_config['Projects'].keys():
-            self.set_study(tag)
             return tag
 
-        for project in self.site_config['Projects'].keys():
-            # search each project for a match to the study tag,
-            # this loop exits as soon as a match is found.
-            logger.debug('Searching project: {}'.format(project))
+        try:
+            project = self.get_project_index()[tag.lower()]
+        except KeyError:
+            # didn't find a match throw a warning
+            logger.warn('Failed to find a valid project for xnat id: {}'
+                        .format(tag))
+            raise ValueError
+
+        # Hack to deal with DTI not being a unique tag :(
+        if project.upper() == 'DTI15T' or project.upper() == 'DTI3T':
+            if parts.site == 'TGH':
+                project = 'DTI15T'
+            else:
+                project = 'DTI3T'
+        return project
 
-            self.set_study(project)
-            site_tags = []
+    def get_project_index(self):
+        """
+        Returns a dictionary mapping every lower case STUDY_TAG and SITE_TAGS
+        entry to the name of the project that defines it.
 
-            if 'Sites' not in self.study_config.keys():
+        Every project settings file is read once per process to build the
+        index, afterwards it is shared by all config instances that use the
+        same site config file and CONFIG_DIR. If a tag is defined by more than
+        one project the first project read wins.
+        """
+        config_dir = self.system_config['CONFIG_DIR']
+        index_key = (os.path.abspath(self.site_config_file),
+                     os.path.abspath(config_dir))
+        try:
+            return _PROJECT_INDEX[index_key]
+        except KeyError:
+            pass
+
+        index = {}
+        for project, settings_file in self.site_config['Projects'].items():
+            logger.debug('Indexing project: {}'.format(project))
+            try:
+                study_config = self.load_yaml(os.path.join(config_dir,
+                                                           settings_file))
+            except ValueError as e:
+                logger.warning('Cant index project {}. Reason: {}'
+                               .format(project, str(e)))
+                continue
+
+            if not study_config or 'Sites' not in study_config.keys():
                 logger.debug("No sites defined for {}".format(project))
                 continue
 
-            for key, site_config in self.study_config['Sites'].iteritems():
+            site_tags = []
+            for site_config in study_config['Sites'].values():
                 try:
-                    add_tags = [t.lower() for t in site_config['SITE_TAGS']]
-                except KeyError:
+                    add_tags = site_config['SITE_TAGS']
+                except (KeyError, TypeError):
                     add_tags = []
+                if isinstance(add_tags, basestring):
+                    add_tags = [add_tags]
                 site_tags.extend(add_tags)
 
-            site_tags.append(self.study_config['STUDY_TAG'].lower())
-
-            if tag.lower() in site_tags:
-                # Hack to deal with DTI not being a unique tag :(
-                if project.upper() == 'DTI15T' or project.upper() == 'DTI3T':
-                    if parts.site == 'TGH':
-                        project = 'DTI15T'
-                    else:
-                        project = 'DTI3T'
-                # Needs to be set here in addition to at the top of the loop in
-                # case the wrong DTI study settings were encountered
-                # for the last set_study call. Ugh.
-                self.set_study(project)
-                return project
-        # didn't find a match throw a warning
-        logger.warn('Failed to find a valid project for xnat id: {}'
-                    .format(tag))
-        raise ValueError
+            try:
+                site_tags.append(study_config['STUDY_TAG'])
+            except KeyError:
+                logger.debug("No STUDY_TAG defined for {}".format(project))
+
+            for tag in site_tags:
+                index.setdefault(str(tag).lower(), project)
+
+        _PROJECT_INDEX[index_key] = index
+        return index
 
     def get_key(self, key, scope=None, site=None):
         """recursively search the yaml files for a key
@@ -209,12 +376,37 @@ class config(object):
         located there the top level of the study_config is checked
         followed by the site_config.
         key: [list of subscripted keys]
+
+        Lookups are answered from a table of every key path defined in the
+        config files (see _get_scope_table) so most calls are a single dict
+        lookup. Anything the table can't answer falls back to walking the yaml.
         """
 
         # quick check to see if a single string was passed
         if isinstance(key, basestring):
             key = [key]
 
+        if scope:
+            return self._walk_key(key, scope=scope, site=site)
+
+        if not self.study_config:
+            logger.warning('Study config not set')
+
+        try:
+            return self._scope_tables[site][tuple(key)]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable key, let the yaml search deal with it
+            return self._walk_key(key, site=site)
+
+        try:
+            return self._get_scope_table(site)[tuple(key)]
+        except KeyError:
+            return self._walk_key(key, site=site)
+
+    def _walk_key(self, key, scope=None, site=None):
+        """Searches the yaml files for a key one level at a time. See get_key"""
         if scope:
             # called recursively, look in site config
             result = self.site_config
@@ -223,7 +415,6 @@ class config(object):
             result = self.study_config
         else:
             # first call and no study set, look at site config
-            logger.warning('Study config not set')
             result = self.site_config
         if site:
             try:
@@ -237,15 +428,43 @@ class config(object):
                 result = result[val]
             except KeyError as e:
                 if site:
-                    return(self.get_key(key))
+                    return(self._walk_key(key))
                 elif not scope:
-                    return self.get_key(key, scope=1)
+                    return self._walk_key(key, scope=1)
                 else:
                     logger.warning('Failed to find key:{}'
                                    .format(key))
                     raise(e)
         return(result)
 
+    def _get_scope_table(self, site=None):
+        """
+        Returns a dictionary mapping every key path (as a tuple) defined in the
+        site config, the study config and the study config's ['Sites'][site]
+        section to its value. Where a path exists in more than one place the
+        value get_key() would find first is kept, i.e. site settings override
+        study settings which override the site config.
+
+        Tables are built once per site and discarded when the study changes.
+        """
+        try:
+            return self._scope_tables[site]
+        except KeyError:
+            pass
+
+        table = _flatten(self.site_config)
+        if self.study_config:
+            table.update(_flatten(self.study_config))
+            if site:
+                try:
+                    table.update(_flatten(self.study_config['Sites'][site]))
+                except (KeyError, TypeError):
+                    logger.info('Site:{} not found in study_config:{}'
+                                .format(site, self.study_config_file))
+
+        self._scope_tables[site] = table
+        return table
+
     def key_exists(self, scope, key):
             """DEPRECATED: use get_key()
             Check the yaml file specified by scope for a key.
@@ -296,13 +515,15 @@ class config(object):
             raise KeyError
 
         try:
-            return(os.path.join(self.get_study_base(),
-                                self.study_config['paths'][path_type]))
-        except (KeyError, TypeError):
+            path = self._get_scope_table()[('paths', path_type)]
+        except KeyError:
             logger.info('Path {} not defined in study {} config file'
                         .format(path_type, self.study_name))
-            return(os.path.join(self.get_study_base(),
-                                self.site_config['paths'][path_type]))
+            try:
+                path = self.site_config['paths'][path_type]
+            except TypeError:
+                raise KeyError(path_type)
+        return(os.path.join(self.get_study_base(), path))
 
     def get_tags(self, site=None):
         """
@@ -318,10 +539,16 @@ class config(object):
         'ExportSettings' (system config) the values in 'ExportInfo' will override
         the values in 'ExportSettings'.
         """
+        if site and not self.study_config:
+            logger.error("Cannot return site tags, study not set.")
+            raise KeyError
+
+        try:
+            return self._tags[site]
+        except KeyError:
+            pass
+
         if site:
-            if not self.study_config:
-                logger.error("Cannot return site tags, study not set.")
-                raise KeyError
             export_info = self.get_key(['ExportInfo'], site=site)
         else:
             export_info = {}
@@ -333,7 +560,9 @@ class config(object):
                     "configuration file.")
             raise KeyError
 
-        return TagInfo(export_settings, export_info)
+        tags = TagInfo(export_settings, export_info)
+        self._tags[site] = tags
+        return tags
 
     def get_xnat_projects(self, study=None):
         if study:
@@ -347,6 +576,28 @@ class config(object):
 
         return(xnat_projects)
 
+    def get_metadata_backend(self):
+        """
+        Returns 'sqlite' if the study keeps its checklist and blacklist in a
+        database (METADATA_BACKEND: sqlite) or 'csv' otherwise.
+        """
+        try:
+            backend = self.get_key('METADATA_BACKEND')
+        except KeyError:
+            return 'csv'
+        return backend.lower()
+
+    def get_metadata_file(self, name):
+        """
+        Returns the path that holds the study's 'checklist' or 'blacklist'.
+        This is <name>.csv in the metadata folder unless the study uses the
+        sqlite backend, in which case both are held in the same database.
+        """
+        meta_dir = self.get_path('meta')
+        if self.get_metadata_backend() == 'sqlite':
+            return os.path.join(meta_dir, datman.metadata.DATABASE_NAME)
+        return os.path.join(meta_dir, '{}.csv'.format(name))
+
     def get_qced_subjects(self):
         """
         Returns a dictionary of all the subjects that have been signed off on
@@ -360,19 +611,13 @@ class config(object):
             3. Dicts can be treated like a list, so if the 'value' for
             each subject 'key' isn't needed it can just be ignored.
         """
-        checklist_path = os.path.join(self.get_path('meta'), 'checklist.csv')
-        if not os.path.isfile(checklist_path):
+        checklist_path = self.get_metadata_file('checklist')
+        try:
+            checklist = datman.metadata.get_checklist(checklist_path)
+        except IOError:
             raise ValueError("Checklist {} not found".format(checklist_path))
 
-        qced_subjects = {}
-        with open(checklist_path, 'r') as checklist:
-            for entry in checklist:
-                fields = entry.split(None, 1)
-                if len(fields) < 2:
-                    continue
-                subid, _ = os.path.splitext(fields[0].strip('qc_'))
-                qced_subjects[subid] = []
-        return qced_subjects
+        return {subid: [] for subid in checklist.signed_off}
 
     def get_blacklist(self):
         """
@@ -383,27 +628,17 @@ class config(object):
         Blacklist entries with file names that violate the datman convention
         will be skipped.
         """
-        blacklist_path = os.path.join(self.get_path('meta'), 'blacklist.csv')
-        if not os.path.isfile(blacklist_path):
+        blacklist_path = self.get_metadata_file('blacklist')
+        try:
+            blacklist = datman.metadata.get_blacklist(blacklist_path)
+        except IOError:
             raise ValueError("Blacklist {} not found.".format(blacklist_path))
 
-        blacklist = {}
-        with open(blacklist_path, 'r') as blacklist_file:
-            header_line = blacklist_file.readline()
-            for entry in blacklist_file:
-                fields = entry.split(None, 1)
-                try:
-                    ident, _, _, _ = datman.scanid.parse_filename(fields[0])
-                except datman.scanid.ParseException:
-                    logger.warn("Bad subject id in series. Ignoring "
-                            "blacklist entry {}".format(entry))
-                    continue
-                except IndexError:
-                    # Empty line present in blacklist. Skip it.
-                    continue
-                subid = ident.get_full_subjectid_with_timepoint()
-                blacklist.setdefault(subid, []).append(fields[0])
-        return blacklist
+        for entry in blacklist.unparsed:
+            logger.warn("Bad subject id in series. Ignoring "
+                    "blacklist entry {}".format(entry))
+        return {subid: list(entries)
+                for subid, entries in iteritems(blacklist.subjects)}
 
     def get_subject_metadata(self):
         """
@@ -460,6 +695,138 @@ class config(object):
 
         return tags
 
+def _flatten(settings, prefix=()):
+    """
+    Returns a dictionary mapping the path (as a tuple of keys) of every entry in
+    a nested dictionary to its value. Entries that are themselves dictionaries
+    are included as well as their contents.
+    """
+    table = {}
+    if not isinstance(settings, dict):
+        return table
+    for key, value in settings.items():
+        path = prefix + (key,)
+        table[path] = value
+        if isinstance(value, dict):
+            table.update(_flatten(value, path))
+    return table
+
+def parse_yaml(filename):
+    """Parses a yaml file, bypassing any snapshot that may exist for it."""
+    with open(filename, 'r') as stream:
+        return yaml.load(stream, Loader=YAML_LOADER)
+
+def get_snapshot_dir():
+    """
+    Returns the folder config snapshots are stored in, or None if snapshots
+    have been disabled.
+    """
+    try:
+        snapshot_dir = os.environ['DM_CONFIG_CACHE']
+    except KeyError:
+        snapshot_dir = os.path.join(os.path.expanduser('~'), '.cache',
+                                    'datman', 'config')
+    if not snapshot_dir:
+        return None
+    return snapshot_dir
+
+def get_snapshot_path(filename):
+    """Returns the path to the snapshot of filename, or None if disabled."""
+    snapshot_dir = get_snapshot_dir()
+    if not snapshot_dir:
+        return None
+    file_hash = hashlib.sha1(os.path.abspath(filename).encode('utf-8'))
+    return os.path.join(snapshot_dir, file_hash.hexdigest() + '.pickle')
+
+def _get_file_identity(filename):
+    stat = os.stat(filename)
+    return (SNAPSHOT_VERSION, os.path.abspath(filename), stat.st_size,
+            stat.st_mtime)
+
+def read_snapshot(filename):
+    """
+    Returns the parsed contents of filename from its snapshot. None is returned
+    if there is no snapshot or the yaml file has changed since it was made.
+    """
+    snapshot_path = get_snapshot_path(filename)
+    if not snapshot_path:
+        return None
+
+    try:
+        with open(snapshot_path, 'rb') as snapshot:
+            identity, contents = pickle.load(snapshot)
+    except (IOError, OSError):
+        return None
+    except Exception as e:
+        logger.debug('Ignoring unreadable snapshot {}. Reason: {}'.format(
+                snapshot_path, str(e)))
+        return None
+
+    if identity != _get_file_identity(filename):
+        logger.debug('Snapshot of {} is out of date'.format(filename))
+        return None
+    return contents
+
+def write_snapshot(filename, contents):
+    """
+    Stores the parsed contents of filename as a snapshot. Failures are logged
+    but otherwise ignored, the snapshot is just an optimization.
+    """
+    snapshot_path = get_snapshot_path(filename)
+    if not snapshot_path:
+        return
+
+    snapshot_dir = os.path.dirname(snapshot_path)
+    try:
+        if not os.path.isdir(snapshot_dir):
+            os.makedirs(snapshot_dir)
+        # Write to a temp file and rename it so readers never see a partial
+        # snapshot
+        handle, temp_path = tempfile.mkstemp(dir=snapshot_dir,
+                                             suffix='.tmp')
+    except (IOError, OSError) as e:
+        logger.debug('Failed writing config snapshot for {}. Reason: {}'
+                     .format(filename, str(e)))
+        return
+
+    try:
+        with os.fdopen(handle, 'wb') as snapshot:
+            pickle.dump((_get_file_identity(filename), contents), snapshot,
+                        pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, snapshot_path)
+    except Exception as e:
+        logger.debug('Failed writing config snapshot for {}. Reason: {}'
+                     .format(filename, str(e)))
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+def rebuild_snapshot(filename):
+    """Re-parses filename and replaces its snapshot. Returns the contents."""
+    contents = parse_yaml(filename)
+    write_snapshot(filename, contents)
+    return contents
+
+def clear_snapshots():
+    """Deletes every config snapshot. Returns the number deleted."""
+    snapshot_dir = get_snapshot_dir()
+    if not snapshot_dir or not os.path.isdir(snapshot_dir):
+        return 0
+
+    deleted = 0
+    for item in os.listdir(snapshot_dir):
+        if not item.endswith('.pickle'):
+            continue
+        try:
+            os.remove(os.path.join(snapshot_dir, item))
+        except OSError as e:
+            logger.warning('Failed to delete snapshot {}. Reason: {}'.format(
+                    item, str(e)))
+            continue
+        deleted += 1
+    return deleted
+
 class TagInfo(object):
 
     def __init__(self, export_settings, site_settings=None):
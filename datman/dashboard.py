@@ -26,8 +26,7 @@ class dashboard(object):
 
     def set_study(self, study):
         """Sets the object study"""
-        cfg = datman.config.config()
-        study_name = cfg.map_xnat_archive_to_project(study)
+        study_name = datman.config.get_config(study=study).study_name
         qry = Study.query.filter(Study.nickname == study_name)
         if qry.count() < 1:
             logger.error('Study:{} not found in dashboard')
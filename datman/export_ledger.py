@@ -0,0 +1,136 @@
+"""
+A record of the series dm_xnat_extract.py has exported, and where to.
+
+Each entry is keyed on a scan's name (its file stem) and export format, and
+records what the XNAT series looked like when it was exported (its UID and
+the number and total size of its dicom files), the files the export made and
+the version of the exporter that made them. A series only needs exporting
+again if one of those has changed or one of its files has gone missing (see
+is_current). Checking whether outputs exist lists each output folder once, so
+checking a whole session needs no per-file filesystem calls.
+"""
+import os
+import json
+import time
+import logging
+import collections
+
+import datman.sqlite_store
+
+logger = logging.getLogger(__name__)
+
+LEDGER_NAME = 'export_ledger.sqlite'
+
+# What an XNAT series looked like when it was exported
+Source = collections.namedtuple('Source', ['uid', 'file_count', 'file_size'])
+
+# A ledger entry. outputs is a list of the paths the export made
+Export = collections.namedtuple('Export', ['scan', 'format', 'source',
+                                           'exporter', 'outputs', 'exported'])
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS exports ("
+        "session TEXT NOT NULL, "
+        "scan TEXT NOT NULL, "
+        "format TEXT NOT NULL, "
+        "uid TEXT, "
+        "file_count INTEGER, "
+        "file_size INTEGER, "
+        "exporter TEXT NOT NULL, "
+        "outputs TEXT NOT NULL, "
+        "exported REAL NOT NULL, "
+        "PRIMARY KEY (scan, format))",
+    "CREATE INDEX IF NOT EXISTS exports_by_session ON exports (session)"]
+
+
+class ExportLedger(datman.sqlite_store.SQLiteStore):
+    """
+    The record of a study's exported series.
+
+        db_path:    The path to the SQLite database to store the ledger in.
+                    It will be created if it doesn't exist.
+    """
+
+    DB_NAME = LEDGER_NAME
+    SCHEMA = SCHEMA
+
+    @classmethod
+    def from_config(cls, config, db_path=None):
+        """
+        Opens the export ledger for the study that config is set to.
+        """
+        if db_path is None:
+            db_path = cls.get_default_path(config)
+        return cls(db_path)
+
+    def get_session(self, session):
+        """
+        Returns the exports recorded for a session, as a dictionary of
+        (scan, format) -> Export.
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT scan, format, uid, "
+                    "file_count, file_size, exporter, outputs, exported FROM "
+                    "exports WHERE session = ?", (session,)).fetchall()
+        exports = {}
+        for scan, format, uid, count, size, exporter, outputs, exported in \
+                rows:
+            exports[(scan, format)] = Export(scan, format,
+                    Source(uid, count, size), exporter, json.loads(outputs),
+                    exported)
+        return exports
+
+    def record(self, session, scan, format, source, exporter, outputs):
+        """
+        Records that a series was exported to the paths in outputs.
+        """
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO exports VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?)", (session, scan, format,
+                    source.uid, source.file_count, source.file_size, exporter,
+                    json.dumps(sorted(outputs)), time.time()))
+
+    def forget(self, scan, format):
+        with self._lock:
+            self._connection.execute("DELETE FROM exports WHERE scan = ? AND "
+                    "format = ?", (scan, format))
+
+
+class OutputListing(object):
+    """
+    Answers whether files exist by listing each folder they're in once.
+    Meant to be used for a short time (e.g. while processing one session),
+    since it doesn't see files that appear after their folder was listed.
+    """
+
+    def __init__(self):
+        self._folders = {}
+
+    def exists(self, path):
+        folder, name = os.path.split(path)
+        try:
+            names = self._folders[folder]
+        except KeyError:
+            try:
+                names = set(os.listdir(folder))
+            except OSError:
+                names = set()
+            self._folders[folder] = names
+        return name in names
+
+
+def is_current(export, source, exporter, listing=None):
+    """
+    Returns True if a ledger entry shows a series has been exported from
+    the same source with the same exporter, and its outputs still exist.
+    listing, if given, is an OutputListing to check for the outputs with.
+    """
+    if export is None:
+        return False
+    if export.source != source or export.exporter != exporter:
+        return False
+    if not export.outputs:
+        return False
+    if listing is None:
+        listing = OutputListing()
+    return all(listing.exists(path) for path in export.outputs)
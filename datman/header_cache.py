@@ -0,0 +1,188 @@
+"""
+A persistent cache of the dicom headers read from exam archives.
+
+Reading headers from an exam zip or tarball means opening and decompressing
+part of every series in it, and most archives never change once they arrive.
+The cache remembers a subset of the headers (HEADER_FIELDS by default) read
+from each archive, keyed on the archive's path, size and modification time, so
+that re-reading an unchanged archive doesn't touch it at all.
+
+The cache is kept in an SQLite database (metadata/header_cache.sqlite by
+default) and is used by passing it to datman.utils.get_archive_headers:
+
+    import datman.config
+    import datman.utils
+    import datman.header_cache
+
+    config = datman.config.config(study='SPINS')
+    with datman.header_cache.HeaderCache.from_config(config) as cache:
+        headers = datman.utils.get_archive_headers(archive, cache=cache)
+
+Cached headers are returned as dicom Datasets holding only the cached fields.
+A request for fields that weren't recorded when an archive was cached (see the
+'fields' argument to HeaderCache) is treated as a miss, and the archive is
+re-read.
+"""
+import os
+import logging
+
+from dicom.dataset import Dataset
+
+import datman.sqlite_store
+
+logger = logging.getLogger(__name__)
+
+CACHE_NAME = 'header_cache.sqlite'
+
+# The header fields datman's own tools read from archive headers
+HEADER_FIELDS = ['SeriesInstanceUID', 'StudyInstanceUID', 'SeriesDescription',
+        'SeriesNumber', 'PatientName', 'PatientID', 'StudyID',
+        'StudyDescription', 'StudyDate', 'SeriesDate', 'AcquisitionDate',
+        'ContentDate']
+
+# Separates the values of multi-valued elements, as in the dicom standard
+MULTI_VALUE_SEPARATOR = '\\'
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS archives ("
+        "path TEXT PRIMARY KEY, "
+        "size INTEGER NOT NULL, "
+        "mtime REAL NOT NULL, "
+        "fields TEXT NOT NULL, "
+        "complete INTEGER NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS headers ("
+        "archive TEXT NOT NULL, "
+        "folder TEXT NOT NULL, "
+        "field TEXT NOT NULL, "
+        "value TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS headers_by_archive ON headers (archive)"]
+
+
+class HeaderCache(datman.sqlite_store.SQLiteStore):
+    """
+    A cache of the dicom headers found in exam archives.
+
+        db_path:    The path to the SQLite database to store the cache in. It
+                    will be created if it doesn't exist.
+        fields:     The header fields to cache. Defaults to HEADER_FIELDS.
+                    Extra fields (e.g. ones used to validate archives against
+                    a lookup table) can be added to this list.
+    """
+
+    DB_NAME = CACHE_NAME
+    SCHEMA = SCHEMA
+
+    def __init__(self, db_path, fields=None, timeout=60):
+        if fields is None:
+            fields = HEADER_FIELDS
+        super(HeaderCache, self).__init__(db_path, timeout=timeout)
+        self.fields = sorted(set(fields))
+
+    @classmethod
+    def from_config(cls, config, fields=None, db_path=None):
+        """
+        Opens the header cache for the study that config is set to.
+        """
+        if db_path is None:
+            db_path = cls.get_default_path(config)
+        return cls(db_path, fields=fields)
+
+    def get(self, archive, stop_after_first=False):
+        """
+        Returns the cached headers for archive as a dictionary that maps each
+        folder to a Dataset, in the same format returned by
+        datman.utils.get_archive_headers. Returns None if the archive isn't
+        cached, has changed since it was cached, or was cached without all
+        of this cache's fields.
+
+        If stop_after_first is set the headers from a single folder are
+        returned, otherwise only a cached result for the whole archive is
+        used.
+        """
+        archive = os.path.abspath(archive)
+        try:
+            identity = _get_identity(archive)
+        except OSError:
+            return None
+        with self._lock:
+            record = self._connection.execute("SELECT size, mtime, fields, "
+                    "complete FROM archives WHERE path = ?",
+                    (archive,)).fetchone()
+            if record is None:
+                return None
+            size, mtime, fields, complete = record
+            if (size, mtime) != identity:
+                logger.debug("{} has changed since its headers were "
+                        "cached".format(archive))
+                return None
+            if not set(self.fields).issubset(fields.split(',')):
+                return None
+            if not (complete or stop_after_first):
+                return None
+            rows = self._connection.execute("SELECT folder, field, value "
+                    "FROM headers WHERE archive = ? ORDER BY folder",
+                    (archive,)).fetchall()
+        return _make_manifest(rows, stop_after_first)
+
+    def add(self, archive, manifest, stop_after_first=False):
+        """
+        Records the headers read from archive, replacing anything cached for
+        it before. Headers read with stop_after_first set are only used to
+        answer later stop_after_first requests.
+
+        Returns the headers as they will be returned from the cache, so that
+        callers see the same fields whether or not the cache was used.
+        """
+        archive = os.path.abspath(archive)
+        rows = []
+        for folder in sorted(manifest):
+            # Keeps a record of the folder even if it has none of the fields
+            rows.append((folder, '', ''))
+            for field in self.fields:
+                value = manifest[folder].get(field)
+                if value is None:
+                    continue
+                rows.append((folder, field, _to_text(value)))
+
+        try:
+            size, mtime = _get_identity(archive)
+        except OSError:
+            return _make_manifest(rows)
+
+        with self._lock, self._transaction() as connection:
+            connection.execute("DELETE FROM headers WHERE archive = ?",
+                    (archive,))
+            connection.executemany("INSERT INTO headers VALUES (?, ?, ?, ?)",
+                    [(archive,) + row for row in rows])
+            connection.execute("INSERT OR REPLACE INTO archives VALUES "
+                    "(?, ?, ?, ?, ?)", (archive, size, mtime,
+                    ','.join(self.fields), int(not stop_after_first)))
+        return _make_manifest(rows)
+
+def _make_manifest(rows, stop_after_first=False):
+    """
+    Makes a dictionary of folder -> Dataset from (folder, field, value) rows
+    sorted by folder.
+    """
+    manifest = {}
+    for folder, field, value in rows:
+        if stop_after_first and manifest and folder not in manifest:
+            break
+        header = manifest.setdefault(folder, Dataset())
+        if not field:
+            continue
+        values = value.split(MULTI_VALUE_SEPARATOR)
+        setattr(header, field, values if len(values) > 1 else value)
+    return manifest
+
+def _get_identity(path):
+    info = os.stat(path)
+    return info.st_size, info.st_mtime
+
+def _to_text(value):
+    if isinstance(value, list):
+        return MULTI_VALUE_SEPARATOR.join(_to_text(item) for item in value)
+    try:
+        return str(value)
+    except UnicodeError:
+        return value.encode('utf-8')
\ No newline at end of file
@@ -0,0 +1,284 @@
+"""
+A persistent manifest of the files in a datman project.
+
+Each indexed folder (e.g. data/nii) is expected to hold one sub-folder per
+session, which in turn holds that session's files. The index records every
+file found this way, along with its size, modification time and (when the file
+name follows the datman convention) its parsed study, site, subject, timepoint,
+session, tag, series number and description.
+
+The manifest is kept in an SQLite database (metadata/file_index.sqlite by
+default). On refresh() only session folders whose modification time has
+changed are re-read, so keeping it current costs one stat() per session
+folder instead of a listing and a stat() for every file.
+
+    import datman.config
+    import datman.index
+
+    config = datman.config.config(study='SPINS')
+    index = datman.index.ProjectIndex.from_config(config)
+    index.refresh()
+
+    t1s = index.find('nii', tag='T1', site='CMH')
+    stale_qc = index.get_newer_than_qc()
+
+Note that a folder's modification time only changes when files are added,
+removed or renamed inside it, so a file that is rewritten in place will keep
+its old size and mtime in the index until something else changes in its
+folder.
+"""
+import os
+import stat
+import time
+import logging
+import collections
+
+import datman.utils
+import datman.scanid
+import datman.sqlite_store
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = 'file_index.sqlite'
+
+# The config 'paths' keys indexed by default
+DEFAULT_PATH_KEYS = ['nii', 'dcm', 'qc']
+
+IndexedFile = collections.namedtuple('IndexedFile', ['path', 'path_key',
+        'folder', 'name', 'study', 'site', 'subject', 'timepoint', 'session',
+        'tag', 'series', 'description', 'ext', 'size', 'mtime'])
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS folders ("
+        "path TEXT PRIMARY KEY, "
+        "path_key TEXT NOT NULL, "
+        "parent TEXT NOT NULL, "
+        "name TEXT NOT NULL, "
+        "mtime REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS files ("
+        "path TEXT PRIMARY KEY, "
+        "path_key TEXT NOT NULL, "
+        "folder TEXT NOT NULL, "
+        "name TEXT NOT NULL, "
+        "study TEXT, site TEXT, subject TEXT, timepoint TEXT, session TEXT, "
+        "tag TEXT, series TEXT, description TEXT, ext TEXT, "
+        "size INTEGER NOT NULL, "
+        "mtime REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS files_by_folder ON files (folder)",
+    "CREATE INDEX IF NOT EXISTS files_by_tag ON files (path_key, tag)",
+    "CREATE INDEX IF NOT EXISTS folders_by_parent ON folders (parent)"]
+
+
+class ProjectIndex(datman.sqlite_store.SQLiteStore):
+    """
+    A manifest of the files in one or more folders of a project.
+
+        db_path:    The path to the SQLite database to store the index in. It
+                    will be created if it doesn't exist.
+        roots:      A dictionary mapping a name for each folder to index (e.g.
+                    'nii') to its path.
+    """
+
+    DB_NAME = INDEX_NAME
+    SCHEMA = SCHEMA
+
+    def __init__(self, db_path, roots, timeout=60):
+        super(ProjectIndex, self).__init__(db_path, timeout=timeout)
+        self.roots = dict((key, os.path.normpath(os.path.abspath(path)))
+                          for key, path in roots.items())
+
+    @classmethod
+    def from_config(cls, config, path_keys=None, db_path=None):
+        """
+        Makes an index of the given config 'paths' keys for the study that
+        config is set to. Keys that aren't defined are skipped.
+        """
+        if path_keys is None:
+            path_keys = DEFAULT_PATH_KEYS
+        roots = {}
+        for key in path_keys:
+            try:
+                roots[key] = config.get_path(key)
+            except KeyError:
+                logger.debug("Path {} not defined for {}. Not "
+                        "indexing".format(key, config.study_name))
+        if db_path is None:
+            db_path = cls.get_default_path(config)
+        return cls(db_path, roots)
+
+    def refresh(self, path_keys=None):
+        """
+        Brings the index up to date with the file system, re-reading only the
+        session folders that have changed. Returns the number of folders
+        re-read.
+        """
+        if path_keys is None:
+            path_keys = sorted(self.roots)
+        start = time.time()
+        updated = 0
+        for key in path_keys:
+            updated += self._refresh_root(key, self.roots[key])
+        logger.debug("Refreshed {} in {:.2f}s, {} folders re-read".format(
+                self.db_path, time.time() - start, updated))
+        return updated
+
+    def _refresh_root(self, key, root):
+        known = dict(self._connection.execute("SELECT path, mtime FROM "
+                "folders WHERE parent = ?", (root,)).fetchall())
+
+        try:
+            names = os.listdir(root)
+        except OSError:
+            logger.debug("Cannot read {}. Removing it from the index".format(
+                    root))
+            names = []
+
+        updated = 0
+        current = set()
+        for name in names:
+            folder = os.path.join(root, name)
+            try:
+                mtime = _get_dir_mtime(folder)
+            except OSError:
+                continue
+            if mtime is None:
+                continue
+            current.add(folder)
+            if known.get(folder) == mtime:
+                continue
+            self._index_folder(key, root, folder, mtime)
+            updated += 1
+
+        removed = [folder for folder in known if folder not in current]
+        if removed:
+            with self._transaction() as connection:
+                for folder in removed:
+                    connection.execute("DELETE FROM files WHERE folder = ?",
+                            (folder,))
+                    connection.execute("DELETE FROM folders WHERE path = ?",
+                            (folder,))
+        return updated + len(removed)
+
+    def _index_folder(self, key, root, folder, mtime):
+        rows = []
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            names = []
+        for name in names:
+            path = os.path.join(folder, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                # Broken links are indexed with size and mtime of 0
+                if not os.path.islink(path):
+                    continue
+                size, file_mtime = 0, 0
+            else:
+                if not stat.S_ISREG(info.st_mode):
+                    continue
+                size, file_mtime = info.st_size, info.st_mtime
+            rows.append((path, key, folder, name) + _parse_name(name) +
+                    (size, file_mtime))
+
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM files WHERE folder = ?", (folder,))
+            connection.executemany("INSERT INTO files VALUES ({})".format(
+                    ", ".join(['?'] * len(IndexedFile._fields))), rows)
+            connection.execute("INSERT OR REPLACE INTO folders VALUES "
+                    "(?, ?, ?, ?, ?)", (folder, key, root,
+                    os.path.basename(folder), mtime))
+
+    def find(self, path_key=None, **fields):
+        """
+        Returns a list of IndexedFile records for all files matching the given
+        path_key and field values, e.g. find('nii', tag='T1', site='CMH').
+        Any IndexedFile field can be used. Results are sorted by path.
+        """
+        for field in fields:
+            if field not in IndexedFile._fields:
+                raise KeyError("{} is not a valid field. Expected one "
+                        "of {}".format(field, ", ".join(IndexedFile._fields)))
+        if path_key is not None:
+            fields['path_key'] = path_key
+
+        query = "SELECT * FROM files"
+        if fields:
+            names = sorted(fields)
+            query += " WHERE " + " AND ".join("{} = ?".format(name)
+                    for name in names)
+            values = [fields[name] for name in names]
+        else:
+            values = []
+        query += " ORDER BY path"
+        return [IndexedFile(*row) for row in
+                self._connection.execute(query, values)]
+
+    def listdir(self, folder):
+        """
+        Returns the names of the files in an indexed session folder, or None
+        if the folder isn't indexed. Sub-folders are not included.
+        """
+        folder = os.path.normpath(os.path.abspath(folder))
+        known = self._connection.execute("SELECT 1 FROM folders WHERE "
+                "path = ?", (folder,)).fetchone()
+        if not known:
+            return None
+        return [row[0] for row in self._connection.execute("SELECT name FROM "
+                "files WHERE folder = ? ORDER BY name", (folder,))]
+
+    def get_sessions(self, path_key='nii'):
+        """
+        Returns the sorted names of all session folders in the path_key folder.
+        """
+        return [row[0] for row in self._connection.execute("SELECT name FROM "
+                "folders WHERE path_key = ? ORDER BY name", (path_key,))]
+
+    def get_newer_than_qc(self, path_key='nii', qc_key='qc'):
+        """
+        Returns a list of (session, data_mtime, qc_mtime) tuples for every
+        session in path_key with files newer than its QC page
+        (<qc>/<session>/qc_<session>.html). qc_mtime is None if there is no QC
+        page. Phantoms are skipped.
+        """
+        query = ("SELECT data.name, "
+                 "MAX(data.mtime, IFNULL(MAX(files.mtime), 0)), "
+                 "qc.mtime "
+                 "FROM folders AS data "
+                 "LEFT JOIN files ON files.folder = data.path "
+                 "LEFT JOIN files AS qc ON qc.path_key = ? "
+                 "AND qc.name = 'qc_' || data.name || '.html' "
+                 "AND qc.folder = ? || data.name "
+                 "WHERE data.path_key = ? "
+                 "GROUP BY data.path "
+                 "ORDER BY data.name")
+        qc_root = self.roots.get(qc_key, '') + os.sep
+        newer = []
+        for session, data_mtime, qc_mtime in self._connection.execute(query,
+                (qc_key, qc_root, path_key)):
+            if datman.scanid.is_phantom(session):
+                continue
+            if qc_mtime is None or data_mtime > qc_mtime:
+                newer.append((session, data_mtime, qc_mtime))
+        return newer
+
+def _get_dir_mtime(path):
+    """Returns the mtime of path if it is a folder and None otherwise."""
+    info = os.stat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        return None
+    return info.st_mtime
+
+def _parse_name(name):
+    """
+    Returns a tuple of the datman fields for a file name (study, site, subject,
+    timepoint, session, tag, series, description, ext). All fields other than
+    ext are None if the name doesn't follow the convention.
+    """
+    ext = datman.utils.get_extension(name)
+    try:
+        ident, tag, series, description = datman.scanid.parse_filename(name)
+    except datman.scanid.ParseException:
+        return (None,) * 8 + (ext,)
+    return (ident.study, ident.site, ident.subject, ident.timepoint,
+            ident.session, tag, series, description, ext)
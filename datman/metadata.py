@@ -0,0 +1,430 @@
+"""
+Indexed access to a project's QC checklist (metadata/checklist.csv) and
+blacklist (metadata/blacklist.csv).
+
+Each file is read once per process into dictionaries keyed by QC page,
+subject and series, so that a query is a dictionary lookup instead of a pass
+over the file. The indexes are cached by path and a file is only re-read if
+its modification time or size changes.
+
+    import datman.metadata
+
+    checklist = datman.metadata.get_checklist('/path/to/checklist.csv')
+    checklist.get_comment('SPN01_CMH_0001_01')
+
+    blacklist = datman.metadata.get_blacklist('/path/to/blacklist.csv')
+    blacklist.get_comment('SPN01_CMH_0001_01_01_T1_02_SagT1-BRAVO')
+
+IOError is raised if a file doesn't exist or can't be read.
+
+A study can instead keep its checklist and blacklist in a single SQLite
+database (metadata/metadata.sqlite) by setting 'METADATA_BACKEND: sqlite' in
+its config. Each insert is atomic and duplicate entries are ignored.
+get_checklist() and get_blacklist() accept the database path in place of a
+csv file and only read from it, so they work without write access to the
+metadata folder, and MetadataDatabase.export() regenerates the csv files for anyone
+that still reads them directly. See bin/dm_metadata_export.py.
+"""
+import os
+import re
+import logging
+import tempfile
+import threading
+
+import datman.scanid
+import datman.sqlite_store
+
+logger = logging.getLogger(__name__)
+
+# Maps the absolute path of a checklist / blacklist to its loaded index
+_INDEXES = {}
+_INDEX_LOCK = threading.Lock()
+
+# Entries may be separated from their comments by whitespace or commas
+ENTRY_SEPARATOR = re.compile(r'[,\s]+')
+
+DATABASE_NAME = 'metadata.sqlite'
+DATABASE_EXT = '.sqlite'
+
+
+def get_checklist(path):
+    """Returns the ChecklistIndex for the checklist at path"""
+    return _get_index(path, ChecklistIndex)
+
+def get_blacklist(path):
+    """Returns the BlacklistIndex for the blacklist at path"""
+    return _get_index(path, BlacklistIndex)
+
+def clear_cache():
+    """Forgets all loaded indexes, forcing every file to be re-read"""
+    with _INDEX_LOCK:
+        _INDEXES.clear()
+
+def _get_index(path, index_type):
+    path = os.path.abspath(path)
+    identity = _get_file_identity(path)
+    with _INDEX_LOCK:
+        try:
+            index = _INDEXES[path]
+        except KeyError:
+            index = None
+        if (index is None or index.identity != identity or
+                not isinstance(index, index_type)):
+            logger.debug('Loading {}'.format(path))
+            index = index_type(path, identity)
+            _INDEXES[path] = index
+    return index
+
+def _get_file_identity(path):
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        raise IOError(e.errno, e.strerror, path)
+    identity = (stat.st_mtime, stat.st_size)
+    if not is_database(path):
+        return identity
+
+    # Committed changes to a database live in its write-ahead log until the
+    # next checkpoint, so the log must be checked too
+    try:
+        wal = os.stat(path + '-wal')
+    except OSError:
+        return identity
+    return identity + (wal.st_mtime, wal.st_size)
+
+def is_database(path):
+    return path.endswith(DATABASE_EXT)
+
+def split_entry(line):
+    """
+    Splits a checklist or blacklist line into its entry and comment. The
+    comment is '' if the line has none and the entry is '' for blank lines.
+    """
+    fields = ENTRY_SEPARATOR.split(line.strip(), 1)
+    entry = fields[0]
+    try:
+        comment = fields[1].strip()
+    except IndexError:
+        comment = ''
+    return entry, comment
+
+
+class MetadataIndex(object):
+    """Base class for the in-memory index of a single metadata file."""
+
+    # The MetadataDatabase table that holds this index's entries
+    table = None
+
+    def __init__(self, path, identity=None):
+        self.path = path
+        self.identity = identity
+        if is_database(path):
+            with MetadataDatabase(path, readonly=True) as database:
+                lines = list(database.get_lines(self.table))
+        else:
+            with open(path, 'r') as metadata:
+                lines = metadata.readlines()
+        self._load(lines)
+
+    def _load(self, lines):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "<{}: {}>".format(self.__class__.__name__, self.path)
+
+
+class ChecklistIndex(MetadataIndex):
+    """
+    Index of a QC checklist. Each line of the checklist holds a QC page name
+    (e.g. qc_SPN01_CMH_0001_01.html) optionally followed by the comment left
+    when it was signed off.
+    """
+
+    table = 'checklist'
+
+    def _load(self, lines):
+        # maps the page name without extension to the first comment found
+        self.pages = {}
+        # subject IDs with at least one signed off page, in file order
+        self.signed_off = []
+
+        seen = set()
+        for line in lines:
+            page, comment = split_entry(line)
+            if not page:
+                continue
+            page = os.path.splitext(page)[0]
+            self.pages.setdefault(page, comment)
+
+            if not comment:
+                continue
+            subject = page[3:] if page.startswith('qc_') else page
+            if subject not in seen:
+                seen.add(subject)
+                self.signed_off.append(subject)
+
+    def get_comment(self, session):
+        """
+        Returns the checklist comment for session's QC page ('' if it has no
+        comment) or None if the session is not on the checklist.
+        """
+        return self.pages.get('qc_{}'.format(session))
+
+    def is_signed_off(self, session):
+        return bool(self.get_comment(session))
+
+
+class BlacklistIndex(MetadataIndex):
+    """
+    Index of a blacklist. Each line holds a series name following the datman
+    convention (e.g. SPN01_CMH_0001_01_01_T1_02_SagT1-BRAVO) followed by the
+    reason it was blacklisted. A header line starting with 'series' is
+    ignored.
+    """
+
+    table = 'blacklist'
+
+    def _load(self, lines):
+        # each entry exactly as it appears in the file, in file order
+        self.entries = []
+        # maps each entry to its comment
+        self.series = {}
+        # maps <session id>_<tag>_<series num> to the first matching entry
+        self.scans = {}
+        # maps subject ID with timepoint to its entries, in file order
+        self.subjects = {}
+        # entries that don't follow the naming convention
+        self.unparsed = []
+
+        for line in lines:
+            entry, comment = split_entry(line)
+            if not entry or entry == 'series':
+                continue
+            if entry in self.series:
+                continue
+            self.entries.append(entry)
+            self.series[entry] = comment
+
+            try:
+                ident, tag, series_num, _ = datman.scanid.parse_filename(entry)
+            except datman.scanid.ParseException:
+                logger.debug("Blacklist entry {} doesn't match the datman "
+                        "convention".format(entry))
+                self.unparsed.append(entry)
+                continue
+
+            scan_key = _get_scan_key(ident, tag, series_num)
+            self.scans.setdefault(scan_key, entry)
+            subject = ident.get_full_subjectid_with_timepoint()
+            self.subjects.setdefault(subject, []).append(entry)
+
+    def find_entry(self, scan_name):
+        """
+        Returns the blacklist entry for scan_name (a file name or path that
+        follows the datman convention, with or without description and
+        extension) or None if it isn't blacklisted.
+        """
+        try:
+            ident, tag, series_num, _ = datman.scanid.parse_filename(scan_name)
+        except datman.scanid.ParseException:
+            return None
+        scan_key = _get_scan_key(ident, tag, series_num)
+
+        try:
+            return self.scans[scan_key]
+        except KeyError:
+            pass
+
+        for entry in self.unparsed:
+            if scan_key in entry:
+                return entry
+        return None
+
+    def get_comment(self, scan_name):
+        """
+        Returns the reason scan_name was blacklisted ('' if none was given) or
+        None if it isn't blacklisted.
+        """
+        entry = self.find_entry(scan_name)
+        if entry is None:
+            return None
+        return self.series[entry]
+
+    def is_blacklisted(self, scan_name):
+        return self.find_entry(scan_name) is not None
+
+    def get_subject_entries(self, subject):
+        """
+        Returns a list of all entries for a subject ID (with timepoint). The
+        list is empty if none of the subject's data is blacklisted.
+        """
+        return list(self.subjects.get(subject, []))
+
+def _get_scan_key(ident, tag, series_num):
+    return "_".join([str(ident), tag, series_num])
+
+
+class MetadataDatabase(object):
+    """
+    A study's checklist and blacklist held in an SQLite database.
+
+    Both tables keep their entries in insertion order. Checklist entries are
+    unique by QC page name without extension (so a .pdf and .html report for a
+    session count as one entry) and blacklist entries are unique by series.
+
+    If the database doesn't exist yet it is created and seeded from any
+    checklist.csv and blacklist.csv in the same folder. A database opened
+    with readonly set is only queried, its tables are never created or
+    changed.
+
+    Setting wal switches the database to write-ahead logging, which it then
+    keeps for every later connection. This lets readers and writers work at
+    once, but needs shared memory and so must not be used for a database on
+    a network file system.
+
+        with MetadataDatabase('/path/to/metadata.sqlite') as database:
+            database.add_checklist_entry('qc_SPN01_CMH_0001_01.html')
+            database.export('checklist', '/path/to/checklist.csv')
+    """
+
+    TABLES = {
+        'checklist': "CREATE TABLE IF NOT EXISTS checklist ("
+                     "name TEXT PRIMARY KEY, "
+                     "entry TEXT NOT NULL, "
+                     "comment TEXT NOT NULL DEFAULT '')",
+        'blacklist': "CREATE TABLE IF NOT EXISTS blacklist ("
+                     "name TEXT PRIMARY KEY, "
+                     "entry TEXT NOT NULL, "
+                     "comment TEXT NOT NULL DEFAULT '')"}
+
+    # Header line written at the top of exported csv files
+    HEADERS = {'checklist': None,
+               'blacklist': 'series reason'}
+
+    def __init__(self, path, timeout=60, readonly=False, wal=False):
+        """
+        timeout is the number of seconds to wait for another process's write
+        to finish before giving up with sqlite3.OperationalError.
+        """
+        self.path = path
+        if readonly:
+            self._connection = datman.sqlite_store.connect(path,
+                    timeout=timeout)
+            return
+
+        is_new = not os.path.exists(path)
+        self._connection = datman.sqlite_store.connect(path,
+                [self.TABLES[table] for table in sorted(self.TABLES)],
+                timeout=timeout, wal=wal)
+
+        if is_new:
+            self._import_existing_csvs()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def _transaction(self):
+        return datman.sqlite_store.transaction(self._connection)
+
+    def _import_existing_csvs(self):
+        meta_dir = os.path.dirname(self.path)
+        for table in sorted(self.TABLES):
+            csv_file = os.path.join(meta_dir, '{}.csv'.format(table))
+            if os.path.exists(csv_file):
+                logger.info('Importing {} into {}'.format(csv_file, self.path))
+                self.import_csv(table, csv_file)
+
+    def add_checklist_entry(self, page, comment=''):
+        """
+        Adds a QC page to the checklist if a page with the same name (ignoring
+        extension) isn't there already. Returns True if the page was added.
+        """
+        return self._insert('checklist', _get_page_name(page), page, comment)
+
+    def sign_off(self, page, comment):
+        """Sets the checklist comment for a QC page, adding it if needed."""
+        self._upsert('checklist', _get_page_name(page), page, comment)
+
+    def add_blacklist_entry(self, series, comment=''):
+        """
+        Blacklists a series or, if it is already blacklisted, replaces the
+        reason given with comment.
+        """
+        self._upsert('blacklist', series, series, comment)
+
+    def _insert(self, table, name, entry, comment):
+        with self._transaction() as connection:
+            cursor = connection.execute("INSERT OR IGNORE INTO {} "
+                    "(name, entry, comment) VALUES (?, ?, ?)".format(table),
+                    (name, entry, comment or ''))
+        return cursor.rowcount == 1
+
+    def _upsert(self, table, name, entry, comment):
+        with self._transaction() as connection:
+            connection.execute("INSERT OR IGNORE INTO {} (name, entry, comment) "
+                    "VALUES (?, ?, ?)".format(table), (name, entry, ''))
+            connection.execute("UPDATE {} SET comment = ? WHERE name = ?".format(
+                    table), (comment or '', name))
+
+    def get_lines(self, table):
+        """
+        Yields the entries of table formatted as they would be in its csv file.
+        """
+        header = self.HEADERS[table]
+        if header:
+            yield header + '\n'
+        cursor = self._connection.execute("SELECT entry, comment FROM {} "
+                "ORDER BY rowid".format(table))
+        for entry, comment in cursor:
+            yield ' '.join([entry, comment]).strip() + '\n'
+
+    def import_csv(self, table, csv_file):
+        """
+        Adds all entries from an existing checklist or blacklist csv file.
+        Entries already in the database are left unchanged.
+        """
+        rows = []
+        with open(csv_file, 'r') as csv_data:
+            for line in csv_data:
+                entry, comment = split_entry(line)
+                if not entry or entry == 'series':
+                    continue
+                name = _get_page_name(entry) if table == 'checklist' else entry
+                rows.append((name, entry, comment))
+
+        with self._transaction() as connection:
+            connection.executemany("INSERT OR IGNORE INTO {} "
+                    "(name, entry, comment) VALUES (?, ?, ?)".format(table),
+                    rows)
+
+    def export(self, table, csv_file):
+        """
+        Writes the contents of table to csv_file. The file is replaced in one
+        step so that readers never see a partially written file.
+        """
+        csv_dir = os.path.dirname(os.path.abspath(csv_file))
+        handle, tmp_path = tempfile.mkstemp(dir=csv_dir, prefix='.{}.'.format(
+                os.path.basename(csv_file)))
+        try:
+            with os.fdopen(handle, 'w') as tmp_file:
+                for line in self.get_lines(table):
+                    tmp_file.write(line)
+            try:
+                mode = os.stat(csv_file).st_mode & 0o777
+            except OSError:
+                mode = 0o664
+            os.chmod(tmp_path, mode)
+            os.rename(tmp_path, csv_file)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+def _get_page_name(page):
+    return os.path.splitext(os.path.basename(page))[0]
@@ -109,7 +109,8 @@ def add_new_subjects_to_checklist(subject_list, checklist, cols):
 def find_images(checklist, checklist_col, input_dir, tag,
                 subject_filter = None,
                 image_filter = None,
-                allow_multiple = False):
+                allow_multiple = False,
+                index = None):
     """
     finds new files in the inputdir and add them to a list for the processing
     Arguments:
@@ -121,6 +122,9 @@ def find_images(checklist, checklist_col, input_dir, tag,
         image_filter:     optional filter for the image type (i.e. 'DTI-60')
         allow_multiple:   Wether to allow multiple images from one subject into
                           this analysis (default is False)
+        index:            An optional datman.index.ProjectIndex of input_dir.
+                          Subject folders it holds are read from the index
+                          instead of the file system.
     """
     for row in range(0,len(checklist)):
 
@@ -133,7 +137,7 @@ def find_images(checklist, checklist_col, input_dir, tag,
 	    #if no T1 file listed for this row
         if pd.isnull(checklist[checklist_col][row]):
             subject_files = []
-            for fname in os.listdir(subject_dir):
+            for fname in list_subject_dir(subject_dir, index):
                 if tag in fname:
                     if not image_filter:
                         subject_files.append(fname)
@@ -155,6 +159,16 @@ def find_images(checklist, checklist_col, input_dir, tag,
 
     return checklist
 
+def list_subject_dir(subject_dir, index=None):
+    """
+    Returns the contents of subject_dir, from index if it holds the folder.
+    """
+    if index is not None:
+        names = index.listdir(subject_dir)
+        if names is not None:
+            return names
+    return os.listdir(subject_dir)
+
 def make_file_qbatch_command(job_txt, job_name, log_dir, wall_time, afterok = ''):
     '''
     Submits jobs (i.e. pipelines) to qbatch
@@ -3,9 +3,11 @@ A class to make access to all information about a single scan easy
 and uniform.
 
 
-    WARNING: This class currently assumes the contents of the directories
-    does not change after the object is created. Certain attribute values may
-    become out of date if this is not true.
+    WARNING: The nifti and dicom folders are read the first time niftis,
+    dicoms, nii_tags, dcm_tags or get_tagged_* are used, and the result is
+    kept for the life of the object. Certain attribute values may become out
+    of date if the contents of these folders change after that. A misnamed
+    file causes a ParseException at that first use, not when the Scan is made.
 
 
     Both Scan and Series inherit from DatmanNamed and have the following
@@ -58,11 +60,20 @@ and uniform.
                                 are found returns an empty list.
 """
 import os
-import glob
 import logging
 
+import datman.config
 import datman.utils
 import datman.scanid as scanid
+import datman.trace
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 try:
     # Only one function uses dashboard, and it may not always be setup in the
@@ -102,7 +113,10 @@ class Series(DatmanNamed):
         self.ext = datman.utils.get_extension(path)
         self.file_name = os.path.basename(self.path)
 
-        path_minus_ext = path.replace(self.ext, "")
+        if self.ext:
+            path_minus_ext = path[:-len(self.ext)]
+        else:
+            path_minus_ext = path
 
         try:
             ident, tag, series, description = scanid.parse_filename(path_minus_ext)
@@ -129,12 +143,20 @@ class Scan(DatmanNamed):
         subject_id:     A subject id of the format STUDY_SITE_ID_TIMEPOINT
                         _SESSION may be included, but will be set to the
                         default _01 if missing.
-        config:         A config object made from a project_settings.yml file
+        config:         A config object made from a project_settings.yml file.
+                        If not given, the shared config for the subject's
+                        study is used (see datman.config.get_config)
+        index:          An optional datman.index.ProjectIndex for the study.
+                        Folders it holds are read from the index instead of
+                        the file system.
 
     May raise a ParseException if the given subject_id does not match the
     datman naming convention
     """
-    def __init__(self, subject_id, config):
+    @datman.trace.traced('Scan.__init__', category='scan',
+            args=lambda self, subject_id, *args, **kwargs: {
+                'subject': subject_id})
+    def __init__(self, subject_id, config=None, index=None):
 
         self.is_phantom = True if '_PHA_' in subject_id else False
 
@@ -147,6 +169,8 @@ class Scan(DatmanNamed):
             raise datman.scanid.ParseException(message)
 
         try:
+            if config is None:
+                config = datman.config.get_config(study=subject_id)
             self.project = config.map_xnat_archive_to_project(subject_id)
         except Exception as e:
             message = 'Failed getting project from config: {}'.format(str(e))
@@ -159,25 +183,42 @@ class Scan(DatmanNamed):
         self.qc_path = self.__get_path('qc', config)
         self.resource_path = self.__get_path('resources', config, session=True)
 
-        self.niftis = self.__get_series(self.nii_path, ['.nii', '.nii.gz'])
-        self.dicoms = self.__get_series(self.dcm_path, ['.dcm'])
+        self._index = index
+        self._niftis = None
+        self._dicoms = None
+        self._nii_dict = None
+        self._dcm_dict = None
+
+    @property
+    def niftis(self):
+        if self._niftis is None:
+            self._niftis = self.__get_series(self.nii_path, ['.nii', '.nii.gz'])
+        return self._niftis
 
-        self.__nii_dict = self.__make_dict(self.niftis)
-        self.__dcm_dict = self.__make_dict(self.dicoms)
+    @property
+    def dicoms(self):
+        if self._dicoms is None:
+            self._dicoms = self.__get_series(self.dcm_path, ['.dcm'])
+        return self._dicoms
 
-        self.nii_tags = self.__nii_dict.keys()
-        self.dcm_tags = self.__dcm_dict.keys()
+    @property
+    def nii_tags(self):
+        return list(self.__get_nii_dict().keys())
+
+    @property
+    def dcm_tags(self):
+        return list(self.__get_dcm_dict().keys())
 
     def get_tagged_nii(self, tag):
         try:
-            matched_niftis = self.__nii_dict[tag]
+            matched_niftis = self.__get_nii_dict()[tag]
         except KeyError:
             matched_niftis = []
         return matched_niftis
 
     def get_tagged_dcm(self, tag):
         try:
-            matched_dicoms = self.__dcm_dict[tag]
+            matched_dicoms = self.__get_dcm_dict()[tag]
         except KeyError:
             matched_dicoms = []
         return matched_dicoms
@@ -214,27 +255,46 @@ class Scan(DatmanNamed):
         path = os.path.join(config.get_path(key), folder_name)
         return path
 
+    def __get_nii_dict(self):
+        if self._nii_dict is None:
+            self._nii_dict = self.__make_dict(self.niftis)
+        return self._nii_dict
+
+    def __get_dcm_dict(self):
+        if self._dcm_dict is None:
+            self._dcm_dict = self.__make_dict(self.dicoms)
+        return self._dcm_dict
+
     def __get_series(self, path, ext_list):
         """
         This method will generate a ParseException if any files are not named
         according to the datman naming convention.
         """
-        glob_path = os.path.join(path, "*")
         series_list = []
         badly_named = []
-        for item in glob.glob(glob_path):
-            if datman.utils.get_extension(item) in ext_list:
-                try:
-                    series = Series(item)
-                except datman.scanid.ParseException:
-                    badly_named.append(item)
-                    continue
-                series_list.append(series)
+        for name in self.__list_files(path):
+            # Check the extension first so unrelated files are never parsed
+            if datman.utils.get_extension(name) not in ext_list:
+                continue
+            item = os.path.join(path, name)
+            try:
+                series = Series(item)
+            except datman.scanid.ParseException:
+                badly_named.append(item)
+                continue
+            series_list.append(series)
         if badly_named:
             message = "File(s) misnamed: {}".format(', '.join(badly_named))
             raise datman.scanid.ParseException(message)
         return series_list
 
+    def __list_files(self, path):
+        if self._index is not None:
+            names = self._index.listdir(path)
+            if names is not None:
+                return names
+        return list_dir(path)
+
     def __make_dict(self, series_list):
         tag_dict = {}
         for series in series_list:
@@ -250,3 +310,17 @@ class Scan(DatmanNamed):
 
     def __repr__(self):
         return "<datman.scan.Scan: {}>".format(self.full_id)
+
+def list_dir(path):
+    """
+    Returns the names of all entries in path except hidden ones, or an empty
+    list if path can't be read.
+    """
+    try:
+        if scandir is not None:
+            names = [entry.name for entry in scandir(path)]
+        else:
+            names = os.listdir(path)
+    except OSError:
+        return []
+    return [name for name in names if not name.startswith('.')]
@@ -50,16 +50,60 @@ try:
 except NameError:
     basestring = str
 
+try:
+    intern
+except NameError:
+    from sys import intern
+
+# The maximum number of distinct ids and file names remembered by parse() and
+# parse_filename()
+CACHE_SIZE = 65536
+
 class ParseException(Exception):
     pass
 
-class Identifier:
+class Identifier(object):
+    """
+    An immutable, parsed datman ID. Identifiers returned by parse() and
+    parse_filename() may be shared between callers, so use replace() to get
+    a modified copy instead of changing one.
+    """
+    __slots__ = ('study', 'site', 'subject', 'timepoint', '_session')
+
     def __init__(self, study, site, subject, timepoint, session):
-        self.study = study
-        self.site = site
-        self.subject = subject
-        self.timepoint = timepoint
-        self._session = session
+        # The same few study and site names appear in every id of a project,
+        # so share one copy of each
+        set_field = object.__setattr__
+        set_field(self, 'study', _intern(study))
+        set_field(self, 'site', _intern(site))
+        set_field(self, 'subject', subject)
+        set_field(self, 'timepoint', timepoint)
+        set_field(self, '_session', session)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Identifier is immutable, use replace() to make "
+                "a modified copy")
+
+    def __reduce__(self):
+        return (Identifier, self._fields())
+
+    def _fields(self):
+        return (self.study, self.site, self.subject, self.timepoint,
+                self._session)
+
+    def __eq__(self, other):
+        if not isinstance(other, Identifier):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self._fields())
 
     @property
     def session(self):
@@ -67,10 +111,19 @@ class Identifier:
             return ''
         return self._session
 
-    @session.setter
-    def session(self, value):
-        self._x = value
-
+    def replace(self, **fields):
+        """
+        Returns a copy of this Identifier with the given fields (study, site,
+        subject, timepoint or session) changed.
+        """
+        values = {'study': self.study, 'site': self.site,
+                  'subject': self.subject, 'timepoint': self.timepoint,
+                  'session': self._session}
+        for field in fields:
+            if field not in values:
+                raise TypeError("{} is not an Identifier field".format(field))
+        values.update(fields)
+        return Identifier(**values)
 
     def get_full_subjectid(self):
         return "_".join([self.study, self.site, self.subject])
@@ -97,15 +150,89 @@ class Identifier:
         else:  # it's a phantom, so no timepoints
             return self.get_full_subjectid()
 
+    def __repr__(self):
+        return "<datman.scanid.Identifier: {}>".format(self)
+
+def _intern(value):
+    try:
+        return intern(value)
+    except TypeError:
+        # Only byte strings can be interned in python 2
+        return value
+
+class _LRUCache(object):
+    """
+    A bounded mapping that drops its least recently used items first.
+
+    Items live in two generations of plain dictionaries. When the current
+    generation fills up it becomes the old one, and whatever was in the old
+    generation (i.e. not used since the last swap) is dropped. This keeps
+    lookups to one or two dictionary accesses, which is much cheaper than
+    exact LRU bookkeeping for something as quick as a regex match. At most
+    2 * size items are held.
+
+    Dictionary operations are atomic, so no lock is needed. A race between
+    threads can only cost a cache miss.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._current = {}
+        self._old = {}
+
+    def get(self, key, default=None):
+        try:
+            return self._current[key]
+        except KeyError:
+            pass
+        try:
+            value = self._old[key]
+        except KeyError:
+            return default
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        if len(self._current) >= self.size:
+            self._old = self._current
+            self._current = {}
+        self._current[key] = value
+
+    def clear(self):
+        self._current = {}
+        self._old = {}
+
+    def __len__(self):
+        return len(self._current) + len(self._old)
+
+# Results for ids / file names that don't match are cached as _INVALID
+_INVALID = object()
+_ID_CACHE = _LRUCache(CACHE_SIZE)
+_FILENAME_CACHE = _LRUCache(CACHE_SIZE)
+
+def clear_cache():
+    """Forgets all previously parsed ids and file names."""
+    _ID_CACHE.clear()
+    _FILENAME_CACHE.clear()
+
 def parse(identifier):
     if not isinstance(identifier, basestring):
         raise ParseException
 
+    ident = _ID_CACHE.get(identifier)
+    if ident is None:
+        ident = _parse(identifier)
+        _ID_CACHE.set(identifier, ident)
+    if ident is _INVALID:
+        raise ParseException()
+    return ident
+
+def _parse(identifier):
     match = SCANID_PATTERN.match(identifier)
     if not match: match = SCANID_PHA_PATTERN.match(identifier)
     # work around for matching scanid's when session not supplied
     if not match: match = SCANID_PATTERN.match(identifier + '_XX')
-    if not match: raise ParseException()
+    if not match: return _INVALID
 
     ident = Identifier(study    = match.group("study"),
                        site     = match.group("site"),
@@ -117,9 +244,18 @@ def parse(identifier):
 
 def parse_filename(path):
     fname = os.path.basename(path)
+    parsed = _FILENAME_CACHE.get(fname)
+    if parsed is None:
+        parsed = _parse_filename(fname)
+        _FILENAME_CACHE.set(fname, parsed)
+    if parsed is _INVALID:
+        raise ParseException()
+    return parsed
+
+def _parse_filename(fname):
     match = FILENAME_PHA_PATTERN.match(fname)  # check PHA first
     if not match: match = FILENAME_PATTERN.match(fname)
-    if not match: raise ParseException()
+    if not match: return _INVALID
 
     ident = Identifier(study    = match.group("study"),
                        site     = match.group("site"),
@@ -132,6 +268,52 @@ def parse_filename(path):
     description = match.group("description")
     return ident, tag, series, description
 
+# The columns returned by parse_many()
+PARSE_MANY_FIELDS = ('path', 'study', 'site', 'subject', 'timepoint',
+                     'session', 'tag', 'series', 'description')
+
+def parse_many(paths):
+    """
+    Parses a list of file names or paths in one go and returns the results
+    as columns: a dictionary mapping each of PARSE_MANY_FIELDS to a list with
+    one value per path, in the order given. All values other than 'path' are
+    None for names that don't match the datman convention.
+
+    The results aren't added to the parse_filename() cache, so this can be
+    used on a large file listing without pushing out more useful entries.
+    Repeated study, site and tag values share a single string.
+    """
+    columns = dict((field, []) for field in PARSE_MANY_FIELDS)
+    path_col = columns['path']
+    study_col, site_col = columns['study'], columns['site']
+    subject_col, timepoint_col = columns['subject'], columns['timepoint']
+    session_col, tag_col = columns['session'], columns['tag']
+    series_col, description_col = columns['series'], columns['description']
+
+    pha_match = FILENAME_PHA_PATTERN.match
+    name_match = FILENAME_PATTERN.match
+    basename = os.path.basename
+    for path in paths:
+        fname = basename(path)
+        match = pha_match(fname) or name_match(fname)
+        path_col.append(path)
+        if not match:
+            for column in (study_col, site_col, subject_col, timepoint_col,
+                    session_col, tag_col, series_col, description_col):
+                column.append(None)
+            continue
+        study, site, subject, timepoint, session, tag, series, description, \
+                _ = match.groups()
+        study_col.append(_intern(study))
+        site_col.append(_intern(site))
+        subject_col.append(subject)
+        timepoint_col.append(timepoint)
+        session_col.append('' if session == 'XX' else session)
+        tag_col.append(_intern(tag))
+        series_col.append(series)
+        description_col.append(description)
+    return columns
+
 def make_filename(ident, tag, series, description, ext=None):
     filename = "_".join([str(ident), tag, series, description])
     if ext:
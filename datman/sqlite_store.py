@@ -0,0 +1,103 @@
+"""
+The SQLite plumbing shared by datman's database backed stores (the project
+file index, archive header cache, XNAT mirror and export ledger).
+
+Each store is a subclass of SQLiteStore that names its database file and
+schema:
+
+    class MyStore(datman.sqlite_store.SQLiteStore):
+        DB_NAME = 'my_store.sqlite'
+        SCHEMA = ["CREATE TABLE IF NOT EXISTS things (name TEXT PRIMARY KEY)"]
+
+connect() and transaction() can also be used on their own by code that
+manages its own connection.
+"""
+import os
+import sqlite3
+import threading
+import contextlib
+
+
+def connect(db_path, schema=None, timeout=60, wal=False,
+            check_same_thread=True):
+    """
+    Opens the database at db_path in autocommit mode (use transaction() to
+    group statements) and runs the statements in schema, if given.
+
+    timeout is the number of seconds to wait for another process's write to
+    finish before giving up with sqlite3.OperationalError. If wal is set the
+    database is switched to write-ahead logging, which lets readers and a
+    writer work at once but needs shared memory, so it can't be used on a
+    network file system.
+    """
+    connection = sqlite3.connect(db_path, timeout=timeout,
+            isolation_level=None, check_same_thread=check_same_thread)
+    connection.text_factory = str
+    if wal:
+        connection.execute('PRAGMA journal_mode=WAL')
+    for statement in schema or []:
+        connection.execute(statement)
+    return connection
+
+@contextlib.contextmanager
+def transaction(connection):
+    """
+    Runs the statements made inside the with block as one transaction, rolled
+    back if the block raises an exception.
+    """
+    # IMMEDIATE takes the write lock up front, so two writers never both
+    # read a table and then try to upgrade to a write
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+    except:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+class SQLiteStore(object):
+    """
+    Base class for a store kept in its own SQLite database.
+
+        db_path:    The path to the database. It will be created if it
+                    doesn't exist.
+
+    The connection may be shared between threads, as long as they hold
+    self._lock while using it.
+    """
+
+    # The database's file name in a study's metadata folder
+    DB_NAME = None
+
+    # Statements run each time the database is opened to create its tables
+    SCHEMA = []
+
+    # Whether the database uses write-ahead logging (see connect())
+    WAL = True
+
+    def __init__(self, db_path, timeout=60):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._connection = connect(db_path, self.SCHEMA, timeout=timeout,
+                wal=self.WAL, check_same_thread=False)
+
+    @classmethod
+    def get_default_path(cls, config):
+        """
+        Returns the path of the store's database for the study that config
+        is set to.
+        """
+        return os.path.join(config.get_path('meta'), cls.DB_NAME)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def _transaction(self):
+        return transaction(self._connection)
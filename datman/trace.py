@@ -0,0 +1,186 @@
+"""
+Lightweight tracing of where datman spends its time.
+
+Code is marked up with spans, either as a context manager or a decorator:
+
+    import datman.trace
+
+    with datman.trace.span('convert', category='command', series=name):
+        ...
+
+    @datman.trace.traced('xnat.query', category='xnat')
+    def query(url):
+        ...
+
+Tracing is off unless the DATMAN_TRACE environment variable is set to a file
+name, or enable() is called (e.g. by a script's --trace option). While it's
+off a span does no work beyond checking a single global, so spans can be left
+in place permanently.
+
+While it's on each finished span is appended to the trace file as a Chrome
+trace event ('complete' events, with microsecond timestamps). The file can be
+loaded into chrome://tracing or https://ui.perfetto.dev to see a flame graph of
+a run. If the file name ends with '.jsonl' events are written one per line
+instead, for processing with other tools.
+
+Every event is written with a single append, so threads and forked worker
+processes can safely share one trace file. Events record the process and
+thread that made them.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import functools
+import threading
+
+logger = logging.getLogger(__name__)
+
+ENV_VAR = 'DATMAN_TRACE'
+
+# Set to a _TraceFile while tracing is on
+_trace_file = None
+
+
+class _TraceFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.jsonl = path.endswith('.jsonl')
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                0o644)
+        if not self.jsonl and os.fstat(self._fd).st_size == 0:
+            # The trace viewers accept an array with no closing bracket, so
+            # the file is valid no matter where a run stops
+            os.write(self._fd, b'[\n')
+
+    def write(self, event):
+        line = json.dumps(event, default=str)
+        line += '\n' if self.jsonl else ',\n'
+        os.write(self._fd, line.encode('utf-8'))
+
+    def close(self):
+        os.close(self._fd)
+
+
+class _Span(object):
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is not None:
+            self.args['error'] = type.__name__
+        self.finish(time.time())
+
+    def finish(self, end):
+        trace_file = _trace_file
+        if trace_file is None:
+            return
+        event = {'name': self.name,
+                 'cat': self.category,
+                 'ph': 'X',
+                 'ts': int(self.start * 1e6),
+                 'dur': int((end - self.start) * 1e6),
+                 'pid': os.getpid(),
+                 'tid': threading.current_thread().ident}
+        if self.args:
+            event['args'] = self.args
+        try:
+            trace_file.write(event)
+        except (OSError, ValueError) as e:
+            logger.debug("Failed writing trace event: {}".format(e))
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+
+def enable(path):
+    """
+    Starts writing trace events to path. Events are added to the end of the
+    file if it exists already.
+    """
+    global _trace_file
+    disable()
+    _trace_file = _TraceFile(path)
+    logger.debug("Writing trace events to {}".format(path))
+
+def disable():
+    """
+    Stops tracing.
+    """
+    global _trace_file
+    trace_file, _trace_file = _trace_file, None
+    if trace_file is not None:
+        trace_file.close()
+
+def is_enabled():
+    return _trace_file is not None
+
+def span(name, category='datman', **args):
+    """
+    Returns a context manager that records the time spent inside it, under
+    the given name and category. Any keyword arguments are recorded with the
+    event.
+    """
+    if _trace_file is None:
+        return _NULL_SPAN
+    return _Span(name, category, args)
+
+def record(name, start, end, category='datman', **args):
+    """
+    Records work that has already been timed (start and end are from
+    time.time()) as a span.
+    """
+    if _trace_file is None:
+        return
+    trace_span = _Span(name, category, args)
+    trace_span.start = start
+    trace_span.finish(end)
+
+def traced(name=None, category='datman', args=None):
+    """
+    A decorator that records each call to a function as a span. The name
+    defaults to the function's module and name.
+
+    args may be a function that takes the same arguments as the decorated
+    function and returns a dictionary of details to record with the event.
+    It is only called while tracing is on.
+    """
+    def decorator(func):
+        span_name = name or '{}.{}'.format(func.__module__, func.__name__)
+
+        @functools.wraps(func)
+        def wrapper(*func_args, **func_kwargs):
+            if _trace_file is None:
+                return func(*func_args, **func_kwargs)
+            details = {}
+            if args is not None:
+                details = args(*func_args, **func_kwargs)
+            with _Span(span_name, category, details):
+                return func(*func_args, **func_kwargs)
+        return wrapper
+    return decorator
+
+
+if os.environ.get(ENV_VAR):
+    try:
+        enable(os.environ[ENV_VAR])
+    except OSError as e:
+        sys.stderr.write("Cannot write trace to {}: {}\n".format(
+                os.environ[ENV_VAR], e))
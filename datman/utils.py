@@ -5,6 +5,9 @@ import os
 import sys
 import re
 import io
+import time
+import errno
+import signal
 import glob
 import zipfile
 import tarfile
@@ -13,19 +16,38 @@ import tempfile
 import shutil
 import shlex
 import pipes
+import threading
 import contextlib
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import subprocess as proc
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
 import dicom as dcm
 import numpy as np
 import nibabel as nib
 import pyxnat
 
 import datman.config
+import datman.metadata
+import datman.trace
 import datman.scanid as scanid
 
 logger = logging.getLogger(__name__)
 
+# The number of bytes first read from each archive member when looking for
+# dicom headers. More is read only if the header turns out to be larger.
+HEADER_READ_SIZE = 64 * 1024
+
+# Dicom files start with a 128 byte preamble followed by the magic number
+DICOM_PREAMBLE_SIZE = 128
+DICOM_MAGIC = b'DICM'
+
 def check_checklist(session_name, study=None):
     """Reads the checklist identified from the session_name
     If there is an entry returns the comment, otherwise
@@ -39,78 +61,148 @@ def check_checklist(session_name, study=None):
         return
 
     if study:
-        cfg = datman.config.config(study=study)
+        cfg = datman.config.get_config(study=study)
     else:
-        cfg = datman.config.config(study=session_name)
+        cfg = datman.config.get_config(study=session_name)
 
     try:
-        checklist_path = os.path.join(cfg.get_path('meta'),
-                                      'checklist.csv')
+        checklist_path = cfg.get_metadata_file('checklist')
     except KeyError:
         logger.warning('Unable to identify meta path for study:{}'
                        .format(cfg.study_name))
         return
 
     try:
-        with open(checklist_path, 'r') as f:
-            lines = f.readlines()
+        checklist = datman.metadata.get_checklist(checklist_path)
     except IOError:
         logger.warning('Unable to open checklist file:{} for reading'
                        .format(checklist_path))
         return
 
-    for line in lines:
-        parts = line.split(None, 1)
-        if parts:  # fix for empty lines
-            if os.path.splitext(parts[0])[0] == 'qc_{}'.format(session_name):
-                try:
-                    return parts[1].strip()
-                except IndexError:
-                    return ''
-
-    return None
+    return checklist.get_comment(session_name)
 
 def check_blacklist(scan_name, study=None):
-    """Reads the checklist identified from the session_name
+    """Reads the blacklist identified from the scan_name
     If there is an entry returns the comment, otherwise
     returns None
     """
 
     try:
         ident, tag, series_num, _ = scanid.parse_filename(scan_name)
-        blacklist_id = "_".join([str(ident), tag, series_num])
     except scanid.ParseException:
         logger.warning('Invalid session id:{}'.format(scan_name))
         return
 
     if study:
-        cfg = datman.config.config(study=study)
+        cfg = datman.config.get_config(study=study)
     else:
-        cfg = datman.config.config(study=ident.get_full_subjectid_with_timepoint())
+        cfg = datman.config.get_config(
+                study=ident.get_full_subjectid_with_timepoint())
 
     try:
-        checklist_path = os.path.join(cfg.get_path('meta'),
-                                      'blacklist.csv')
+        blacklist_path = cfg.get_metadata_file('blacklist')
     except KeyError:
         logger.warning('Unable to identify meta path for study:{}'
                        .format(study))
         return
 
     try:
-        with open(checklist_path, 'r') as f:
-            lines = f.readlines()
+        blacklist = datman.metadata.get_blacklist(blacklist_path)
     except IOError:
         logger.warning('Unable to open blacklist file:{} for reading'
-                       .format(checklist_path))
+                       .format(blacklist_path))
         return
-    for line in lines:
-        parts = line.split(None, 1)
-        if parts:  # fix for empty lines
-            if blacklist_id in parts[0]:
+
+    comment = blacklist.get_comment(scan_name)
+    if not comment:
+        # Entries without a reason have always been reported as None
+        return None
+    return comment
+
+
+def qc_status_many(session_names, study=None):
+    """
+    Returns a dictionary mapping each of session_names to its checklist
+    comment ('' if it is listed without a comment) or to None if it
+    is not on the checklist. The checklist is only read once for all sessions,
+    so this should be preferred to calling check_checklist in a loop.
+
+    If study is not given it is determined from the first valid session name.
+    All sessions are assumed to belong to the same study.
+    """
+    status = dict.fromkeys(session_names)
+    checklist = _get_metadata_index(status.keys(), 'checklist',
+            datman.metadata.get_checklist, study=study)
+    if checklist is None:
+        return status
+
+    for session in status:
+        status[session] = checklist.get_comment(session)
+    return status
+
+def check_blacklist_many(scan_names, study=None):
+    """
+    Returns a dictionary mapping each of scan_names to the reason it was
+    blacklisted ('' if no reason was given) or None if it is not blacklisted.
+    The blacklist is only read once for all scans, so this should be preferred
+    to calling check_blacklist in a loop.
+
+    Unlike check_blacklist, an entry without a reason is reported as '' instead
+    of None so that 'is not None' can be used to test for blacklisted scans.
+
+    If study is not given it is determined from the first valid scan name. All
+    scans are assumed to belong to the same study.
+    """
+    blacklisted = dict.fromkeys(scan_names)
+    blacklist = _get_metadata_index(blacklisted.keys(), 'blacklist',
+            datman.metadata.get_blacklist, study=study)
+    if blacklist is None:
+        return blacklisted
+
+    for scan in blacklisted:
+        blacklisted[scan] = blacklist.get_comment(scan)
+    return blacklisted
+
+def _get_metadata_index(names, metadata_type, get_index, study=None):
+    """
+    Finds the 'checklist' or 'blacklist' metadata for the study that the
+    names belong to and returns its index from get_index. Returns None if the
+    file can't be found or read.
+    """
+    if not names:
+        return None
+
+    if not study:
+        for name in names:
+            try:
+                ident, _, _, _ = scanid.parse_filename(name)
+            except scanid.ParseException:
                 try:
-                    return parts[1].strip()
-                except IndexError:
-                    return
+                    ident = scanid.parse(name)
+                except scanid.ParseException:
+                    continue
+            study = ident.get_full_subjectid_with_timepoint()
+            break
+        else:
+            logger.warning('No valid datman IDs found in: {}'.format(
+                    ", ".join(names)))
+            return None
+
+    cfg = datman.config.get_config(study=study)
+
+    try:
+        metadata_path = cfg.get_metadata_file(metadata_type)
+    except KeyError:
+        logger.warning('Unable to identify meta path for study:{}'
+                       .format(study))
+        return None
+
+    try:
+        return get_index(metadata_path)
+    except IOError:
+        logger.warning('Unable to open {} file:{} for reading'.format(
+                metadata_type, metadata_path))
+        return None
 
 
 def get_subject_from_filename(filename):
@@ -182,7 +274,9 @@ def get_extension(path):
     else:
         return os.path.splitext(path)[1]
 
-def get_archive_headers(path, stop_after_first = False):
+@datman.trace.traced(category='headers',
+        args=lambda path, *args, **kwargs: {'path': path})
+def get_archive_headers(path, stop_after_first = False, cache = None):
     """
     Get dicom headers from a scan archive.
 
@@ -196,57 +290,207 @@ def get_archive_headers(path, stop_after_first = False):
     If stop_after_first == True only a single set of dicom headers are
     returned for the entire archive, which is useful if you only care about the
     exam details.
+
+    If a datman.header_cache.HeaderCache is given as cache, zip and tar
+    archives are only read if the cache doesn't already hold their headers.
+    The headers returned then only contain the fields the cache was made to
+    hold.
     """
     if os.path.isdir(path):
         return get_folder_headers(path, stop_after_first)
-    elif zipfile.is_zipfile(path):
-        return get_zipfile_headers(path, stop_after_first)
+
+    if cache is not None:
+        manifest = cache.get(path, stop_after_first)
+        if manifest is not None:
+            return manifest
+
+    if zipfile.is_zipfile(path):
+        manifest = get_zipfile_headers(path, stop_after_first)
     elif os.path.isfile(path) and path.endswith('.tar.gz'):
-        return get_tarfile_headers(path, stop_after_first)
+        manifest = get_tarfile_headers(path, stop_after_first)
     else:
         raise Exception("{} must be a file (zip/tar) or folder.".format(path))
 
+    if cache is not None:
+        manifest = cache.add(path, manifest, stop_after_first)
+    return manifest
+
+def get_archive_headers_many(paths, stop_after_first = False, cache = None,
+        jobs = 1):
+    """
+    Get dicom headers from many scan archives, reading up to 'jobs' archives
+    at once in separate processes.
+
+    Returns a dictionary that maps each path to the headers that
+    get_archive_headers returns for it. Archives that can't be read are left
+    out, so callers can fall back to get_archive_headers to handle the error.
+
+    If a datman.header_cache.HeaderCache is given, archives it already holds
+    are not read, and the headers of the others are added to it by this
+    process only.
+    """
+    manifests = {}
+    to_read = []
+    for path in paths:
+        cached = None
+        if cache is not None:
+            cached = cache.get(path, stop_after_first)
+        if cached is None:
+            to_read.append(path)
+        else:
+            manifests[path] = cached
+
+    tasks = [(path, stop_after_first) for path in to_read]
+    pool = None
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        results = pool.imap_unordered(_read_archive_headers, tasks)
+    else:
+        results = (_read_archive_headers(task) for task in tasks)
+
+    try:
+        for path, manifest, error in results:
+            if error:
+                logger.debug("Cannot read headers from {}. Reason: "
+                        "{}".format(path, error))
+                continue
+            if cache is not None:
+                manifest = cache.add(path, manifest, stop_after_first)
+            manifests[path] = manifest
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return manifests
+
+def _read_archive_headers(task):
+    path, stop_after_first = task
+    try:
+        return path, get_archive_headers(path, stop_after_first), None
+    except Exception as e:
+        return path, None, str(e)
+
+@datman.trace.traced(category='headers',
+        args=lambda path, *args, **kwargs: {'path': path})
 def get_tarfile_headers(path, stop_after_first = False):
     """
     Get headers for dicom files within a tarball
-    """
-    tar = tarfile.open(path)
-    members = tar.getmembers()
 
+    The tarball is read as a stream, one member at a time, so reading stops as
+    soon as the headers needed have been found.
+    """
     manifest = {}
-    # for each dir, we want to inspect files inside of it until we find a dicom
-    # file that has header information
-    for f in filter(lambda x: x.isfile(), members):
-        dirname = os.path.dirname(f.name)
-        if dirname in manifest: continue
-        try:
-            manifest[dirname] = dcm.read_file(tar.extractfile(f))
-            if stop_after_first: break
-        except dcm.filereader.InvalidDicomError as e:
-            continue
+    with tarfile.open(path, 'r|*') as tar:
+        # for each dir, we want to inspect files inside of it until we find a
+        # dicom file that has header information
+        for f in tar:
+            if not f.isfile():
+                continue
+            dirname = os.path.dirname(f.name)
+            if dirname in manifest: continue
+            try:
+                with contextlib.closing(tar.extractfile(f)) as member:
+                    manifest[dirname] = read_dicom_header(member)
+                if stop_after_first: break
+            except dcm.filereader.InvalidDicomError as e:
+                continue
     return manifest
 
+@datman.trace.traced(category='headers',
+        args=lambda path, *args, **kwargs: {'path': path})
 def get_zipfile_headers(path, stop_after_first = False):
     """
     Get headers for a dicom file within a zipfile
     """
-    zf = zipfile.ZipFile(path)
-
     manifest = {}
-    for f in zf.namelist():
-        dirname = os.path.dirname(f)
-        if dirname in manifest: continue
-        try:
-            manifest[dirname] = dcm.read_file(io.BytesIO(zf.read(f)))
-            if stop_after_first: break
-        except dcm.filereader.InvalidDicomError as e:
-            continue
-        except zipfile.BadZipfile:
-            logger.warning('Error in zipfile:{}'
-                           .format(path))
-            break
+    with zipfile.ZipFile(path) as zf:
+        for f in zf.namelist():
+            if f.endswith('/'):
+                continue
+            dirname = os.path.dirname(f)
+            if dirname in manifest: continue
+            try:
+                with contextlib.closing(zf.open(f)) as member:
+                    manifest[dirname] = read_dicom_header(member)
+                if stop_after_first: break
+            except dcm.filereader.InvalidDicomError as e:
+                continue
+            except zipfile.BadZipfile:
+                logger.warning('Error in zipfile:{}'
+                               .format(path))
+                break
     return manifest
 
+def read_dicom_header(stream, read_size=None):
+    """
+    Reads the headers of a dicom from an open file object, stopping before
+    the pixel data.
+
+    The stream does not need to support seeking (e.g. a zip or tar member).
+    It is read read_size bytes at a time (default HEADER_READ_SIZE) until the
+    whole header has been read, so only the start of each file is ever
+    decompressed.
+
+    Raises dicom.filereader.InvalidDicomError if the stream does not hold
+    a dicom.
+    """
+    if read_size is None:
+        read_size = HEADER_READ_SIZE
+    data = b''
+    while True:
+        more = stream.read(read_size)
+        data += more
+        at_end = len(more) < read_size
+        buffer = io.BytesIO(data)
+        try:
+            header = dcm.read_file(buffer, stop_before_pixels=True)
+        except dcm.filereader.InvalidDicomError:
+            raise
+        except Exception:
+            # The header was cut off part way through an element
+            if at_end:
+                raise
+        else:
+            # Reading stops before the pixel data, so if all of the buffer
+            # was used there may be more header left in the stream
+            if at_end or buffer.tell() < len(data):
+                return header
+        # Double the amount read each time
+        read_size = len(data)
+
+def has_dicom_magic(stream):
+    """
+    Returns True if an open file starts with a dicom preamble and magic
+    number. Only the first 132 bytes are read.
+    """
+    start = stream.read(DICOM_PREAMBLE_SIZE + len(DICOM_MAGIC))
+    return start[DICOM_PREAMBLE_SIZE:] == DICOM_MAGIC
+
+def is_dicom_file(path):
+    """
+    Returns True if path is a readable dicom file.
+
+    Files without the dicom magic number are turned away after reading 132
+    bytes. Otherwise only the header is parsed, never the pixel data.
+    """
+    try:
+        with open(path, 'rb') as stream:
+            if not has_dicom_magic(stream):
+                return False
+            stream.seek(0)
+            read_dicom_header(stream)
+    except IOError:
+        return False
+    except dcm.filereader.InvalidDicomError:
+        return False
+    except Exception as e:
+        # e.g. a header cut off part way through
+        logger.debug('Failed reading dicom header of {}: {}'.format(path, e))
+        return False
+    return True
+
+@datman.trace.traced(category='headers',
+        args=lambda path, *args, **kwargs: {'path': path})
 def get_folder_headers(path, stop_after_first = False):
     """
     Generate a dictionary of subfolders and dicom headers.
@@ -263,7 +507,7 @@ def get_folder_headers(path, stop_after_first = False):
             if os.path.isdir(filepath):
                 subdirs.append(filepath)
                 continue
-            manifest[path] = dcm.read_file(filepath)
+            manifest[path] = dcm.read_file(filepath, stop_before_pixels=True)
             break
         except dcm.filereader.InvalidDicomError as e:
             pass
@@ -289,7 +533,7 @@ def get_all_headers_in_folder(path, recurse = False):
             filepath = os.path.join(dirname,filename)
             headers = None
             try:
-                headers = dcm.read_file(filepath)
+                headers = dcm.read_file(filepath, stop_before_pixels=True)
             except dcm.filereader.InvalidDicomError as e:
                 continue
             manifest[filepath] = headers
@@ -387,8 +631,10 @@ def define_folder(path):
         try:
             os.makedirs(path)
         except OSError as e:
-            logger.error('failed to make directory {}'.format(path))
-            raise(e)
+            # it may have been made by another process or thread since
+            if e.errno != errno.EEXIST:
+                logger.error('failed to make directory {}'.format(path))
+                raise(e)
 
     if not has_permissions(path):
         raise OSError("User does not have permission to access {}".format(path))
@@ -433,11 +679,336 @@ def run_dummy_q(list_of_names):
     run(cmd)
     logger.info('... Done.')
 
+# The outcome of a command run by run_command. max_rss is in kilobytes, and
+# the times (and max_rss) are None where os.wait4 isn't available.
+CommandResult = collections.namedtuple('CommandResult', ['command',
+        'returncode', 'output', 'error', 'wall_time', 'user_time',
+        'system_time', 'max_rss', 'timed_out'])
+
+def run_command(cmd, shell=False, timeout=None, log_file=None, cwd=None,
+        env=None):
+    """
+    Runs a single command and returns a CommandResult.
+
+    cmd may be a list of arguments or a string. Unless shell is set it is run
+    directly, without a shell, so strings are split with shlex and shell
+    features (pipes, redirection, globs) are not available.
+
+    If timeout (in seconds) is given the command, and anything it started, is
+    killed once the timeout is reached and timed_out is set on the result.
+
+    If log_file is given, the command's stdout and stderr are written straight
+    to that file (it's appended to) instead of being kept in memory, and the
+    result's output and error are empty.
+    """
+    if shell and isinstance(cmd, (list, tuple)):
+        cmd = " ".join(cmd)
+    elif not shell and not isinstance(cmd, (list, tuple)):
+        cmd = shlex.split(cmd)
+
+    log = None
+    if log_file:
+        log = open(log_file, 'ab')
+        stdout, stderr = log, proc.STDOUT
+    else:
+        stdout, stderr = proc.PIPE, proc.PIPE
+
+    start = time.time()
+    try:
+        # A command with a timeout gets its own process group so that
+        # everything it starts can be killed with it
+        p = _popen(cmd, bool(timeout), shell=shell, stdout=stdout,
+                stderr=stderr, cwd=cwd, env=env)
+    except:
+        if log:
+            log.close()
+        raise
+
+    readers = []
+    output, error = [], []
+    if not log:
+        readers = [_start_reader(p.stdout, output),
+                   _start_reader(p.stderr, error)]
+
+    timed_out = threading.Event()
+    finished = threading.Event()
+    kill_lock = threading.Lock()
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, _kill_command, [p, timed_out,
+                finished, kill_lock])
+        timer.daemon = True
+        timer.start()
+
+    try:
+        returncode, usage = _wait_for(p)
+        # Once the command has been reaped its process group id may belong
+        # to someone else, so the timer must not kill it any more
+        with kill_lock:
+            finished.set()
+    finally:
+        if timer:
+            timer.cancel()
+        deadline = start + timeout if timeout else None
+        _join_readers(readers, p, deadline, timed_out)
+        if log:
+            log.close()
+    wall_time = time.time() - start
+
+    if usage is None:
+        user_time = system_time = max_rss = None
+    else:
+        user_time, system_time = usage.ru_utime, usage.ru_stime
+        max_rss = usage.ru_maxrss
+
+    datman.trace.record(_get_program_name(cmd, shell), start,
+            start + wall_time, category='command', command=cmd,
+            returncode=returncode, user_time=user_time,
+            system_time=system_time, max_rss=max_rss)
+
+    result = CommandResult(cmd, returncode, b''.join(output),
+            b''.join(error), wall_time, user_time, system_time, max_rss,
+            timed_out.is_set())
+    if timed_out.is_set():
+        logger.error("Command {} killed after timeout of {}s".format(cmd,
+                timeout))
+    logger.debug("Command {} finished with returncode {} in {:.2f}s "
+            "(user {}s, system {}s, max rss {} kB)".format(cmd, returncode,
+            wall_time, user_time, system_time, max_rss))
+    return result
+
+def _get_program_name(cmd, shell):
+    if shell:
+        try:
+            cmd = shlex.split(cmd)
+        except ValueError:
+            return 'sh'
+    if not cmd:
+        return 'sh'
+    return os.path.basename(cmd[0])
+
+# preexec_fn isn't safe to use while other threads are running on python 2,
+# so commands that need it are started one at a time
+_popen_lock = threading.Lock()
+
+def _popen(cmd, new_session, **kwargs):
+    """
+    Starts cmd with Popen, in a new session (and process group) if
+    new_session is set.
+    """
+    if not new_session:
+        return proc.Popen(cmd, **kwargs)
+    if sys.version_info >= (3, 2):
+        return proc.Popen(cmd, start_new_session=True, **kwargs)
+    with _popen_lock:
+        return proc.Popen(cmd, preexec_fn=os.setsid, **kwargs)
+
+def _join_readers(readers, process, deadline, timed_out):
+    """
+    Waits for the output readers to finish. Anything the command started in
+    the background can hold its pipes open after it exits, so if the readers
+    are still going at the deadline the command's process group is killed.
+    (The group id can't have been reused while those processes are in it.)
+    """
+    for reader in readers:
+        if deadline is not None:
+            reader.join(max(deadline - time.time(), 0))
+            if reader.is_alive():
+                _kill_group(process, timed_out)
+        reader.join()
+
+def _start_reader(pipe, chunks):
+    def read():
+        for chunk in iter(lambda: pipe.read(65536), b''):
+            chunks.append(chunk)
+        pipe.close()
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    return reader
+
+def _wait_for(process):
+    """
+    Waits for a process started by Popen to finish. Returns its returncode,
+    and its resource usage if os.wait4 is available (None otherwise).
+    """
+    if not hasattr(os, 'wait4'):
+        return process.wait(), None
+    while True:
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    # Let Popen know the process has already been waited for
+    process.returncode = returncode
+    return returncode, usage
+
+def _kill_command(process, timed_out, finished, lock):
+    with lock:
+        if finished.is_set():
+            return
+        _kill_group(process, timed_out)
+
+def _kill_group(process, timed_out):
+    timed_out.set()
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+class CommandRunner(object):
+    """
+    Runs commands (see run_command) up to 'jobs' at a time.
+
+        with CommandRunner(jobs=4) as runner:
+            for nifti in niftis:
+                runner.submit(['slicer', nifti, '-a', pic], timeout=600)
+            results = runner.wait()
+
+    Any keyword arguments given to the runner are used as defaults for each
+    command submitted.
+    """
+
+    def __init__(self, jobs=1, **defaults):
+        self.jobs = jobs
+        self.defaults = defaults
+        self._pool = ThreadPool(jobs)
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def submit(self, cmd, **kwargs):
+        """
+        Queues a command to run, with the same arguments as run_command.
+        """
+        options = dict(self.defaults)
+        options.update(kwargs)
+        self._pending.append(self._pool.apply_async(run_command, (cmd,),
+                options))
+
+    def wait(self):
+        """
+        Waits for every command submitted so far and returns their
+        CommandResults, in the order they were submitted. Raises the first
+        exception any of them raised (e.g. OSError for a missing program).
+        """
+        pending, self._pending = self._pending, []
+        return [result.get() for result in pending]
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+def run_many(commands, jobs=1, **kwargs):
+    """
+    Runs a list of commands, up to 'jobs' at a time, and returns a list of
+    their CommandResults in the same order. Keyword arguments are passed on
+    to run_command for every command.
+    """
+    with CommandRunner(jobs=jobs, **kwargs) as runner:
+        for cmd in commands:
+            runner.submit(cmd)
+        return runner.wait()
+
+def prefetch(items, fetch, depth=1, release=None):
+    """
+    Yields (item, fetch(item)) for each of items, calling fetch on a
+    background thread up to 'depth' items ahead of the caller. Fetching the
+    next items (e.g. downloading them) then overlaps with whatever the caller
+    does with the current one (e.g. converting it).
+
+    No more than 'depth' fetched results wait for the caller at a time, so
+    at most depth + 2 results exist at once (counting the one being fetched
+    and the one the caller holds). If release is given it's called with each
+    result once the caller has moved on from it, or the generator is closed
+    before the caller got to it, e.g. to delete temporary files.
+
+    An exception raised by fetch is raised to the caller when it reaches
+    that item. With a depth of 0 nothing is fetched in the background.
+    """
+    if depth < 1:
+        for item in items:
+            result = fetch(item)
+            try:
+                yield item, result
+            finally:
+                if release:
+                    release(result)
+        return
+
+    fetched = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                fetched.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch_all():
+        for item in items:
+            if stop.is_set():
+                return
+            try:
+                entry = (item, fetch(item), None)
+            except Exception as e:
+                entry = (item, None, e)
+            if not put(entry):
+                if release and entry[2] is None:
+                    release(entry[1])
+                return
+        put(done)
+
+    fetcher = threading.Thread(target=fetch_all)
+    fetcher.daemon = True
+    fetcher.start()
+    try:
+        while True:
+            entry = fetched.get()
+            if entry is done:
+                break
+            item, result, error = entry
+            if error is not None:
+                raise error
+            try:
+                yield item, result
+            finally:
+                if release:
+                    release(result)
+    finally:
+        stop.set()
+        # Releases anything fetched that the caller never got to
+        while fetcher.is_alive() or not fetched.empty():
+            try:
+                entry = fetched.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if entry is not done and entry[2] is None and release:
+                release(entry[1])
+        fetcher.join()
+
 def run(cmd, dryrun=False, specialquote=True, verbose=True):
     """
     Runs the command in default shell, returning STDOUT and a return code.
     The return code uses the python convention of 0 for success, non-zero for
     failure
+
+    New code should use run_command, which can run commands without a shell
+    and with a timeout.
     """
     # Popen needs a string command.
     if isinstance(cmd, list):
@@ -453,14 +1024,13 @@ def run(cmd, dryrun=False, specialquote=True, verbose=True):
 
     logger.debug("Executing command: {}".format(cmd))
 
-    p = proc.Popen(cmd, shell=True, stdout=proc.PIPE, stderr=proc.PIPE)
-    out, err = p.communicate()
+    result = run_command(cmd, shell=True)
 
-    if p.returncode and verbose:
+    if result.returncode and verbose:
         logger.error('run({}) failed with returncode {}. STDERR: {}'
-                     .format(cmd, p.returncode, err))
+                     .format(cmd, result.returncode, result.error))
 
-    return p.returncode, out
+    return result.returncode, result.output
 
 
 def _escape_shell_chars(arg):
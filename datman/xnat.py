@@ -5,23 +5,50 @@ import requests
 import time
 import tempfile
 import os
+import re
 import urllib
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
 from exceptions import XnatException
+import datman.trace
 from xml.etree import ElementTree
 
 logger = logging.getLogger(__name__)
 
+# The default number of connections kept open to the server
+POOL_SIZE = 10
+
+# The default number of bytes read at a time when downloading files
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Downloads are written to <filename><PART_SUFFIX> until they're complete
+PART_SUFFIX = '.part'
+
+# The outcome of one download made by xnat.get_dicoms_many. filename is None
+# (and error is set) if the download failed. throughput is in bytes/second.
+Download = collections.namedtuple('Download', ['scan', 'filename', 'size',
+                                               'seconds', 'throughput',
+                                               'error'])
+
 class xnat(object):
     server = None
     auth = None
     headers = None
     session = None
 
-    def __init__(self, server, username, password):
+    def __init__(self, server, username, password, pool_size=POOL_SIZE,
+                 chunk_size=CHUNK_SIZE, max_connections=None):
         if server.endswith('/'):
             server = server[:-1]
         self.server = server
         self.auth = (username, password)
+        # If max_connections is set no more than that many requests are made
+        # at once, however many threads share the connection
+        self.max_connections = max_connections
+        self.pool_size = max_connections or pool_size
+        self.chunk_size = chunk_size
+        self._session_lock = threading.Lock()
         try:
             self.get_xnat_session()
         except Exception as e:
@@ -33,6 +60,7 @@ class xnat(object):
         url = '{}/data/JSESSION'.format(self.server)
 
         s = requests.Session()
+        self._mount_adapter(s)
 
         response = s.post(url, auth=self.auth)
 
@@ -47,6 +75,27 @@ class xnat(object):
                                                         response.content})
         self.session = s
 
+    def _mount_adapter(self, session):
+        """Gives session a connection pool large enough for pool_size
+        concurrent requests. When max_connections is set requests wait for
+        a free connection instead of opening more"""
+        adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.pool_size,
+                pool_block=self.max_connections is not None)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+    def _refresh_session(self, expired):
+        """Replaces an expired session and returns the new one.
+
+        When many threads find the session has expired at once only the
+        first logs in again, the rest get the session it made."""
+        with self._session_lock:
+            if self.session is expired:
+                logger.info('Session may have expired, resetting')
+                self.get_xnat_session()
+            return self.session
+
     def get_projects(self):
         """Queries the xnat server for a list of projects"""
         logger.debug('Querying xnat server for projects')
@@ -102,6 +151,25 @@ class xnat(object):
 
         return(result['ResultSet']['Result'])
 
+    def get_project_experiments(self, study):
+        """Lists every experiment in a project in a single query, with the
+        subject label and the dates it was added and last changed"""
+        logger.debug('Querying xnat server for experiments in study:{}'
+                     .format(study))
+        url = '{}/data/archive/projects/{}/experiments/?format=json' \
+              '&columns=ID,label,subject_label,date,insert_date,' \
+              'last_modified'.format(self.server, study)
+        try:
+            result = self._make_xnat_query(url)
+        except:
+            raise XnatException("Failed getting experiments with url:{}"
+                                .format(url))
+
+        if not result:
+            raise XnatException('Project:{} not found'.format(study))
+
+        return(result['ResultSet']['Result'])
+
     def get_session(self, study, session, create=False):
         """Checks to see if session exists in xnat,
         if create and study doesnt exist will try to create it
@@ -235,6 +303,13 @@ class xnat(object):
 
         return(result['items'][0])
 
+    def get_scans(self, study, session, experiment):
+        """Returns info about every scan in an experiment from a single
+        query. Each scan is in the format returned by get_scan_info, including
+        the catalog of its files"""
+        experiment = self.get_experiment(study, session, experiment)
+        return get_experiment_scans(experiment)
+
     def get_resource_ids(self, study, session, experiment, folderName=None, create=True):
         """
         Return a list of resource id's (subfolders) from an experiment
@@ -398,10 +473,7 @@ class xnat(object):
         If filename is not specified creates a temporary file
         and returns the path to that, user needs to be responsible
         for cleaning up any created tempfiles"""
-        url = '{}/data/archive/projects/{}/' \
-              'subjects/{}/experiments/{}/' \
-              'scans/{}/resources/DICOM/files?format=zip' \
-              .format(self.server, project, session, experiment, scan)
+        url = self._get_dicom_url(project, session, experiment, scan)
 
         if not filename:
             filename = tempfile.mkstemp(prefix="dm2_xnat_extract_")
@@ -422,6 +494,78 @@ class xnat(object):
             err.session = session
             raise err
 
+    def get_dicoms_many(self, scans, dest_dir, max_workers=4, retries=3):
+        """Downloads the dicoms for many scans at once
+
+        scans is a list of (project, session, experiment, scan) tuples. Up
+        to max_workers downloads (but no more than max_connections) run at a
+        time, sharing one connection pool and xnat session. Each scan's zip
+        is saved in dest_dir as <session>_<experiment>_<scan>.zip. A
+        download that fails part way leaves a .part file, which a later call
+        resumes from.
+
+        Returns a list of Download tuples in the same order as scans. A
+        failed download doesn't stop the others, its Download has the
+        error instead of a filename."""
+        if max_workers > self.pool_size and not self.max_connections:
+            self.pool_size = max_workers
+            self._mount_adapter(self.session)
+
+        def download(scan):
+            return self._download_dicom(scan, dest_dir, retries)
+
+        start = time.time()
+        pool = ThreadPool(max_workers)
+        try:
+            results = pool.map(download, scans)
+        finally:
+            pool.close()
+            pool.join()
+
+        elapsed = time.time() - start
+        total = sum(result.size for result in results)
+        logger.info('Downloaded {} of {} scans, {:.1f} MB in {:.1f}s '
+                    '({:.1f} MB/s)'.format(
+                        len([r for r in results if r.filename]),
+                        len(scans), total / 1e6, elapsed,
+                        total / 1e6 / elapsed if elapsed else 0))
+        return results
+
+    def _download_dicom(self, scan, dest_dir, retries):
+        project, session, experiment, scan_id = scan
+        url = self._get_dicom_url(project, session, experiment, scan_id)
+        filename = os.path.join(dest_dir, '{}_{}_{}.zip'.format(session,
+                                                                experiment,
+                                                                scan_id))
+        start = time.time()
+        try:
+            self._get_xnat_stream(url, (None, filename), retries,
+                                  keep_partial=True)
+            if not os.path.exists(filename):
+                raise XnatException('Scan not found')
+        except Exception as e:
+            logger.error('Failed getting dicom with url:{}. Reason: {}'
+                         .format(url, e))
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            return Download(scan, None, 0, time.time() - start, 0, str(e))
+
+        seconds = time.time() - start
+        size = os.path.getsize(filename)
+        throughput = size / seconds if seconds else 0
+        logger.debug('Downloaded {} ({:.1f} MB in {:.2f}s, {:.1f} MB/s)'
+                     .format(filename, size / 1e6, seconds,
+                             throughput / 1e6))
+        return Download(scan, filename, size, seconds, throughput, None)
+
+    def _get_dicom_url(self, project, session, experiment, scan):
+        return '{}/data/archive/projects/{}/' \
+               'subjects/{}/experiments/{}/' \
+               'scans/{}/resources/DICOM/files?format=zip' \
+               .format(self.server, project, session, experiment, scan)
+
     def put_resource(self, project, session, experiment, filename, data, folder,
                      retries=3):
         """POST a resource file to the xnat server
@@ -546,55 +690,139 @@ class xnat(object):
             raise XnatException('Failed deleting resource with url:{}'
                                 .format(url))
 
-    def _get_xnat_stream(self, url, filename, retries=3, timeout=120):
-        logger.info('Getting data from xnat')
-        try:
-            response = self.session.get(url, stream=True, timeout=timeout)
-        except requests.exceptions.Timeout as e:
-            if retries > 0:
-                return(self._get_xnat_stream(url, filename, retries=retries-1,
-                                             timeout=timeout*2))
-            else:
-                raise e
+    @datman.trace.traced('xnat.stream', category='xnat',
+            args=lambda self, url, *args, **kwargs: {'url': url})
+    def _get_xnat_stream(self, url, filename, retries=3, timeout=120,
+                         keep_partial=False):
+        """Downloads url to filename[1]
+
+        The data is written to <filename>.part and only renamed to filename
+        once all of it has arrived. If the connection fails part way the
+        download picks up where it left off (when the server supports range
+        requests) instead of starting again. If keep_partial is set a
+        .part file left by a download that gave up is kept, so that a later
+        download to the same filename can resume it."""
+        path = filename[1]
+        part = path + PART_SUFFIX
+        while True:
+            try:
+                complete = self._download_part(url, part, timeout)
+            except requests.exceptions.HTTPError:
+                raise
+            except (requests.exceptions.RequestException, IOError,
+                    XnatException) as e:
+                if not retries:
+                    logger.error('Failed downloading {}: {}'.format(url, e))
+                    if not keep_partial:
+                        _remove(part)
+                    raise e
+                logger.warning('Download of {} interrupted, retrying: {}'
+                               .format(url, e))
+                retries -= 1
+                timeout *= 2
+                continue
+            if complete is None:
+                # Gateway timeout, give the server some time to recover
+                if not retries:
+                    logger.error('xnat server timed out, giving up')
+                    raise XnatException('xnat server timed out getting {}'
+                                        .format(url))
+                logger.warning('xnat server timed out, retrying')
+                retries -= 1
+                timeout *= 2
+                time.sleep(30)
+                continue
+            break
 
+        if complete:
+            os.rename(part, path)
+
+    def _download_part(self, url, part, timeout):
+        """Makes one attempt at downloading url to the file part, resuming
+        from the end of anything already in part.
+
+        Returns True once part holds the whole file, False if the server
+        has no such file and None if the server timed out. Raises an
+        exception if the transfer fails part way."""
+        try:
+            offset = os.path.getsize(part)
+        except OSError:
+            offset = 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+
+        session = self.session
+        response = session.get(url, stream=True, timeout=timeout,
+                               headers=headers)
         if response.status_code == 401:
             # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.get(url, stream=True, timeout=timeout)
+            response.close()
+            session = self._refresh_session(session)
+            response = session.get(url, stream=True, timeout=timeout,
+                                   headers=headers)
+
+        if response.status_code == 416 and offset:
+            # The partial file doesn't fit the file on the server any more
+            logger.info('Discarding stale partial download {}'.format(part))
+            response.close()
+            os.remove(part)
+            return self._download_part(url, part, timeout)
 
         if response.status_code == 404:
             logger.info("No records returned from xnat server to query:{}"
                          .format(url))
-            return
-        elif response.status_code is 504:
-            if retries:
-                logger.warning('xnat server timed out, retrying')
-                time.sleep(30)
-                self._get_xnat_stream(url, filename, retries=retries - 1,
-                                      timeout=timeout * 2)
-            else:
-                logger.error('xnat server timed out, giving up')
-                response.raise_for_status()
-        elif response.status_code is not 200:
-            logger.error('xnat error:{} at data upload'
+            response.close()
+            return False
+        elif response.status_code == 504:
+            response.close()
+            return None
+        elif response.status_code not in (200, 206):
+            logger.error('xnat error:{} at data download'
                          .format(response.status_code))
-            response.raise_for_status()
-
-        with open(filename[1], 'wb') as f:
             try:
-                for chunk in response.iter_content(1024):
+                response.raise_for_status()
+            except requests.exceptions.HTTPError:
+                # Hand the connection back to the pool, with a blocking pool
+                # a leaked connection stalls every later request
+                response.close()
+                raise
+
+        if response.status_code == 206 and _range_start(response) == offset:
+            mode = 'ab'
+            expected = _range_total(response)
+        else:
+            # The server sent the whole file
+            if offset:
+                logger.info('Server ignored range request, downloading {} '
+                            'from the start'.format(url))
+            offset = 0
+            mode = 'wb'
+            expected = _content_length(response)
+
+        with open(part, mode) as f:
+            try:
+                for chunk in response.iter_content(self.chunk_size):
                     f.write(chunk)
             except requests.exceptions.RequestException as e:
                 logger.error('Failed reading from xnat')
-                raise(e)
+                raise e
             except IOError as e:
                 logger.error('Failed writing to file')
-                raise(e)
+                raise e
+            finally:
+                response.close()
+
+        size = os.path.getsize(part)
+        if expected is not None and size != expected:
+            raise XnatException('Incomplete download of {}, got {} of {} '
+                                'bytes'.format(url, size, expected))
+        return True
 
+    @datman.trace.traced('xnat.query', category='xnat',
+            args=lambda self, url, *args, **kwargs: {'url': url})
     def _make_xnat_query(self, url, retries=3):
+        session = self.session
         try:
-            response = self.session.get(url, timeout=30)
+            response = session.get(url, timeout=30)
         except requests.exceptions.Timeout as e:
             if retries > 0:
                 return(self._make_xnat_query(url, retries=retries-1))
@@ -605,9 +833,8 @@ class xnat(object):
 
         if response.status_code == 401:
             # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.get(url, timeout=30)
+            session = self._refresh_session(session)
+            response = session.get(url, timeout=30)
 
         if response.status_code == 404:
             logger.info("No records returned from xnat server to query:{}"
@@ -621,9 +848,12 @@ class xnat(object):
             response.raise_for_status()
         return(response.json())
 
+    @datman.trace.traced('xnat.xml_query', category='xnat',
+            args=lambda self, url, *args, **kwargs: {'url': url})
     def _make_xnat_xml_query(self, url, retries=3):
+        session = self.session
         try:
-            response = self.session.get(url, timeout=30)
+            response = session.get(url, timeout=30)
         except requests.exceptions.Timeout as e:
             if retries > 0:
                 return(self._make_xnat_xml_query(url, retries=retries-1))
@@ -632,9 +862,8 @@ class xnat(object):
 
         if response.status_code == 401:
             # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.get(url, timeout=30)
+            session = self._refresh_session(session)
+            response = session.get(url, timeout=30)
 
         if response.status_code == 404:
             logger.info("No records returned from xnat server to query:{}"
@@ -650,20 +879,20 @@ class xnat(object):
         return(root)
 
     def _make_xnat_put(self, url, retries=3):
+        session = self.session
         if retries == 0:
             logger.info('Timed out making xnat put:{}'.format(url))
             requests.exceptions.HTTPError()
 
         try:
-            response = self.session.put(url, timeout=30)
+            response = session.put(url, timeout=30)
         except requests.exceptions.Timeout:
             return(self._make_xnat_put(url, retries=retries-1))
 
         if response.status_code == 401:
             # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.put(url, timeout=30)
+            session = self._refresh_session(session)
+            response = session.put(url, timeout=30)
 
         if not response.status_code in [200, 201]:
             logger.warn("http client error at folder creation: {}"
@@ -671,19 +900,19 @@ class xnat(object):
             response.raise_for_status()
 
     def _make_xnat_post(self, url, data, retries=3, headers=None):
+        session = self.session
         logger.debug('POSTing data to xnat, {} retries left'.format(retries))
-        response = self.session.post(url,
-                                     headers=headers,
-                                     data=data,
-                                     timeout=60*60)
+        response = session.post(url,
+                                headers=headers,
+                                data=data,
+                                timeout=60*60)
 
         if response.status_code == 401:
             # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.post(url,
-                                         headers=headers,
-                                         data=data)
+            session = self._refresh_session(session)
+            response = session.post(url,
+                                    headers=headers,
+                                    data=data)
 
         if response.status_code is 504:
             if retries:
@@ -709,18 +938,76 @@ class xnat(object):
                                             response.content))
 
     def _make_xnat_delete(self, url, retries=3):
+        session = self.session
         try:
-            response = self.session.delete(url, timeout=30)
+            response = session.delete(url, timeout=30)
         except requests.exceptions.Timeout:
             return(self._make_xnat_delete(url, retries=retries-1))
 
         if response.status_code == 401:
             # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.delete(url, timeout=30)
+            session = self._refresh_session(session)
+            response = session.delete(url, timeout=30)
 
         if not response.status_code in [200, 201]:
             logger.warn("http client error deleting resource: {}"
                         .format(response.status_code))
             response.raise_for_status()
+
+
+def get_session_experiments(session):
+    """Returns the experiment documents held in a session's document, or None
+    if the document doesn't include them"""
+    for child in session.get('children', []):
+        if child['field'] == 'experiments/experiment':
+            return child['items']
+    return None
+
+def get_experiment_scans(experiment):
+    """Returns the scans held in an experiment's document, or None if the
+    document doesn't include them"""
+    for child in experiment.get('children', []):
+        if child['field'] == 'scans/scan':
+            return child['items']
+    return None
+
+def has_file_info(scan):
+    """Returns true if a scan's document includes the catalog of its files,
+    as the scans in an experiment's document do"""
+    return any(child['field'] == 'file' for child in scan.get('children', []))
+
+def _content_length(response):
+    """Returns the number of bytes the body of response should hold once
+    read, or None if it's unknown"""
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        # requests decodes the body, so it won't match Content-Length
+        return None
+    try:
+        return int(response.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None
+
+def _parse_content_range(response):
+    """Returns the start and total size from a partial response's
+    Content-Range header (e.g. 'bytes 100-199/1000'), either of which may be
+    None"""
+    match = re.match(r'bytes\s+(\d+)-\d+/(\d+|\*)',
+                     response.headers.get('Content-Range', ''))
+    if not match:
+        return None, None
+    total = match.group(2)
+    return int(match.group(1)), int(total) if total != '*' else None
+
+def _range_start(response):
+    return _parse_content_range(response)[0]
+
+def _range_total(response):
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    return _parse_content_range(response)[1]
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
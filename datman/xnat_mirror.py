@@ -0,0 +1,374 @@
+"""
+A local copy of the metadata datman reads from XNAT.
+
+XnatMirror wraps a datman.xnat.xnat connection and can be used in its place.
+It keeps the documents returned by XNAT's project, session, experiment, scan
+and resource queries, and sync() refreshes it by listing each project's
+experiments in one query and re-reading only the sessions that were added,
+changed or deleted since the last sync.
+
+get_sessions, get_session, get_experiments, get_experiment, get_scans,
+get_scan_info, get_resource_list, get_project_experiments and find_session are
+answered from the mirror when it holds the answer, and from the server
+(keeping a copy) otherwise. Everything else, including downloads, is passed
+through to the server. Uploading to or deleting from a session through the
+mirror drops its copy of that session, so the change is read back from the
+server.
+"""
+import json
+import time
+import logging
+
+import datman.xnat
+import datman.sqlite_store
+from datman.exceptions import XnatException
+
+logger = logging.getLogger(__name__)
+
+MIRROR_NAME = 'xnat_mirror.sqlite'
+
+# xnat methods that change a session. Each takes the project and session as
+# its first two arguments
+WRITE_METHODS = ['make_session', 'put_dicoms', 'put_resource',
+                 'delete_resource', 'create_resource_folder']
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS projects ("
+        "project TEXT PRIMARY KEY, "
+        "sessions TEXT NOT NULL, "
+        "experiments TEXT NOT NULL, "
+        "synced REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS sessions ("
+        "project TEXT NOT NULL, "
+        "session TEXT NOT NULL, "
+        "modified TEXT, "
+        "document TEXT, "
+        "experiments TEXT, "
+        "PRIMARY KEY (project, session))",
+    "CREATE TABLE IF NOT EXISTS experiments ("
+        "project TEXT NOT NULL, "
+        "session TEXT NOT NULL, "
+        "experiment TEXT NOT NULL, "
+        "document TEXT NOT NULL, "
+        "PRIMARY KEY (project, session, experiment))",
+    "CREATE TABLE IF NOT EXISTS scans ("
+        "project TEXT NOT NULL, "
+        "session TEXT NOT NULL, "
+        "experiment TEXT NOT NULL, "
+        "scan TEXT NOT NULL, "
+        "document TEXT NOT NULL, "
+        "PRIMARY KEY (project, session, experiment, scan))",
+    "CREATE TABLE IF NOT EXISTS resources ("
+        "project TEXT NOT NULL, "
+        "session TEXT NOT NULL, "
+        "experiment TEXT NOT NULL, "
+        "resource TEXT NOT NULL, "
+        "document TEXT NOT NULL, "
+        "PRIMARY KEY (project, session, experiment, resource))"]
+
+# The tables holding the parts of a session, cleared when it changes
+SESSION_TABLES = ['sessions', 'experiments', 'scans', 'resources']
+
+
+class XnatMirror(datman.sqlite_store.SQLiteStore):
+    """
+    A mirror of XNAT's metadata, to use in place of the xnat connection it
+    wraps.
+
+        db_path:    The path to the SQLite database to store the mirror in.
+                    It will be created if it doesn't exist.
+        xnat:       A datman.xnat.xnat connection, used to sync the mirror
+                    and to answer anything the mirror can't.
+    """
+
+    DB_NAME = MIRROR_NAME
+    SCHEMA = SCHEMA
+
+    def __init__(self, db_path, xnat, timeout=60):
+        # Set first, __getattr__ reads it for anything missing
+        self.xnat = xnat
+        super(XnatMirror, self).__init__(db_path, timeout=timeout)
+
+    @classmethod
+    def from_config(cls, config, xnat, db_path=None):
+        """
+        Opens the XNAT mirror for the study that config is set to.
+        """
+        if db_path is None:
+            db_path = cls.get_default_path(config)
+        return cls(db_path, xnat)
+
+    def __getattr__(self, name):
+        method = getattr(self.xnat, name)
+        if name not in WRITE_METHODS:
+            return method
+
+        def write(project, session, *args, **kwargs):
+            try:
+                return method(project, session, *args, **kwargs)
+            finally:
+                self.forget(project, session)
+        return write
+
+    def sync(self, projects):
+        """
+        Brings the mirror of each project up to date with the server.
+        Sessions are only re-read if their experiments have been added,
+        modified or deleted since the last sync.
+
+        Returns a list of the (project, session) pairs that were refreshed.
+        """
+        refreshed = []
+        for project in projects:
+            try:
+                refreshed.extend(self.sync_project(project))
+            except XnatException as e:
+                logger.error('Failed syncing xnat project:{} with reason:{}'
+                             .format(project, e))
+        return refreshed
+
+    def sync_project(self, project):
+        """
+        Syncs a single project. Returns the (project, session) pairs that
+        were refreshed.
+        """
+        start = time.time()
+        sessions = self.xnat.get_sessions(project)
+        experiments = self.xnat.get_project_experiments(project)
+
+        modified = dict((session['label'], '') for session in sessions)
+        for experiment in sorted(experiments, key=lambda e: e['label']):
+            subject = experiment.get('subject_label')
+            if subject not in modified:
+                continue
+            stamp = experiment.get('last_modified') or \
+                    experiment.get('insert_date') or ''
+            modified[subject] += '{}={};'.format(experiment['label'], stamp)
+
+        with self._lock:
+            mirrored = dict(self._connection.execute("SELECT session, "
+                    "modified FROM sessions WHERE project = ?",
+                    (project,)).fetchall())
+
+        changed = sorted(session for session, stamp in modified.items()
+                         if mirrored.get(session) != stamp)
+        removed = [session for session in mirrored if session not in modified]
+
+        refreshed = []
+        for session in changed:
+            if self.refresh_session(project, session, modified[session]):
+                refreshed.append((project, session))
+        for session in removed:
+            self.forget(project, session)
+
+        with self._lock, self._transaction() as connection:
+            connection.execute("INSERT OR REPLACE INTO projects VALUES "
+                    "(?, ?, ?, ?)", (project, _dump(sessions),
+                    _dump(experiments), time.time()))
+
+        logger.info('Synced xnat project:{} in {:.1f}s, {} of {} sessions '
+                    'changed, {} removed'.format(project, time.time() - start,
+                                                 len(changed), len(modified),
+                                                 len(removed)))
+        return refreshed
+
+    def refresh_session(self, project, session, modified=None):
+        """
+        Re-reads everything datman uses about a session from the server.
+        modified records the state of the session's experiments on the
+        server, and is compared against the experiment list by the next sync.
+
+        Returns False if the session couldn't be read, in which case the
+        mirror's copy is dropped and the session is retried on the next sync.
+        """
+        logger.debug('Refreshing mirror of session:{} in project:{}'
+                     .format(session, project))
+        try:
+            rows = self._read_session(project, session)
+        except Exception as e:
+            logger.error('Failed reading session:{} in project:{} from xnat '
+                         'with reason:{}'.format(session, project, e))
+            self.forget(project, session)
+            return False
+
+        with self._lock, self._transaction() as connection:
+            _delete_session(connection, project, session)
+            document, experiments = rows.pop('sessions')
+            connection.execute("INSERT INTO sessions VALUES (?, ?, ?, ?, ?)",
+                    (project, session, modified, document, experiments))
+            for table, table_rows in rows.items():
+                if not table_rows:
+                    continue
+                connection.executemany("INSERT INTO {} VALUES ({})".format(
+                        table, ', '.join(['?'] * (len(table_rows[0]) + 2))),
+                        [(project, session) + row for row in table_rows])
+        return True
+
+    def _read_session(self, project, session):
+        """
+        Reads a session's documents from the server, returning the rows to
+        store for each table.
+        """
+        document = _check(self.xnat.get_session(project, session))
+        experiments = self.xnat.get_experiments(project, session)
+        rows = {'sessions': (_dump(document), _dump(experiments)),
+                'experiments': [], 'scans': [], 'resources': []}
+        # The session's document normally holds its experiments' documents
+        nested = dict((item['data_fields']['label'], item) for item in
+                      datman.xnat.get_session_experiments(document) or []
+                      if item.get('children'))
+        for entry in experiments or []:
+            label = entry['label']
+            experiment = nested.get(label)
+            if experiment is None:
+                experiment = _check(self.xnat.get_experiment(project,
+                                                             session, label))
+            rows['experiments'].append((label, _dump(experiment)))
+            # The experiment's document holds its scans, so they aren't
+            # read separately
+            for child in experiment.get('children', []):
+                for item in child['items']:
+                    fields = item['data_fields']
+                    if child['field'] == 'resources/resource':
+                        resource = fields['xnat_abstractresource_id']
+                        files = _check(self.xnat.get_resource_list(project,
+                                session, label, resource))
+                        rows['resources'].append((label, str(resource),
+                                                  _dump(files)))
+        return rows
+
+    def forget(self, project, session):
+        """
+        Drops the mirror's copy of a session, so that it's read from the
+        server next time it's needed.
+        """
+        with self._lock, self._transaction() as connection:
+            _delete_session(connection, project, session)
+
+    def get_sessions(self, study):
+        record = self._get_project(study)
+        if record is None:
+            return self.xnat.get_sessions(study)
+        return record[0]
+
+    def get_project_experiments(self, study):
+        record = self._get_project(study)
+        if record is None:
+            return self.xnat.get_project_experiments(study)
+        return record[1]
+
+    def get_session(self, study, session, create=False):
+        found, document = self._get_document("SELECT document FROM sessions "
+                "WHERE project = ? AND session = ?", (study, session))
+        if found:
+            return document
+        document = self.xnat.get_session(study, session, create=create)
+        if isinstance(document, dict):
+            with self._lock:
+                # Updates the document without marking the session synced
+                self._connection.execute("INSERT OR IGNORE INTO sessions "
+                        "(project, session) VALUES (?, ?)", (study, session))
+                self._connection.execute("UPDATE sessions SET document = ? "
+                        "WHERE project = ? AND session = ?",
+                        (_dump(document), study, session))
+        return document
+
+    def get_experiments(self, study, session):
+        record = self._get_record("SELECT experiments FROM sessions WHERE "
+                "project = ? AND session = ? AND modified IS NOT NULL",
+                (study, session))
+        if record is None:
+            return self.xnat.get_experiments(study, session)
+        return _load(record[0])
+
+    def get_experiment(self, study, session, experiment):
+        return self._get_or_fetch("experiments", (study, session, experiment),
+                self.xnat.get_experiment)
+
+    def get_scan_info(self, study, session, experiment, scanid):
+        return self._get_or_fetch("scans", (study, session, experiment,
+                str(scanid)), self.xnat.get_scan_info)
+
+    def get_scans(self, study, session, experiment):
+        return datman.xnat.get_experiment_scans(self.get_experiment(study,
+                session, experiment))
+
+    def get_resource_list(self, study, session, experiment, resource_id):
+        return self._get_or_fetch("resources", (study, session, experiment,
+                str(resource_id)), self.xnat.get_resource_list)
+
+    def find_session(self, session, projects=None):
+        """Finds the project holding a session, as xnat.find_session does"""
+        if not projects:
+            projects = [p['ID'] for p in self.xnat.get_projects()]
+
+        for project in projects:
+            sessions = self.get_sessions(project)
+            if session in [s['label'] for s in sessions]:
+                logger.debug('Found session:{} in project:{}'
+                             .format(session, project))
+                return project
+
+    def _get_project(self, project):
+        record = self._get_record("SELECT sessions, experiments FROM "
+                "projects WHERE project = ?", (project,))
+        if record is None:
+            return None
+        return _load(record[0]), _load(record[1])
+
+    def _get_or_fetch(self, table, key, fetch):
+        """
+        Returns a document from one of the tables of session parts, fetching
+        (and keeping) it from the server if the mirror doesn't have it.
+        """
+        columns = ['project', 'session', 'experiment', 'scan'][:len(key)]
+        if table == 'resources':
+            columns[-1] = 'resource'
+        query = "SELECT document FROM {} WHERE {}".format(table,
+                ' AND '.join('{} = ?'.format(column) for column in columns))
+        found, document = self._get_document(query, key)
+        if found:
+            return document
+
+        document = fetch(*key)
+        if isinstance(document, Exception):
+            return document
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO {} VALUES "
+                    "({})".format(table, ', '.join(['?'] * (len(key) + 1))),
+                    key + (_dump(document),))
+        return document
+
+    def _get_document(self, query, args):
+        """
+        Returns whether the mirror holds the document selected by query, and
+        the document.
+        """
+        record = self._get_record(query, args)
+        if record is None or record[0] is None:
+            return False, None
+        return True, _load(record[0])
+
+    def _get_record(self, query, args):
+        with self._lock:
+            return self._connection.execute(query, args).fetchone()
+
+
+def _delete_session(connection, project, session):
+    for table in SESSION_TABLES:
+        connection.execute("DELETE FROM {} WHERE project = ? AND "
+                "session = ?".format(table), (project, session))
+
+def _check(result):
+    """
+    Raises the XnatException some xnat methods return instead of raising.
+    """
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def _dump(document):
+    return json.dumps(document, sort_keys=True)
+
+def _load(text):
+    return json.loads(text)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark comparing datman.config.get_key's lookup table against the
+recursive search it replaced.
+
+Usage:
+    python tests/benchmarks/bench_config.py [<iterations>]
+
+Run from the root of the datman repository, with datman installed or on the
+PYTHONPATH.
+"""
+import sys
+import timeit
+
+import datman.config
+
+SITE_CONFIG = 'tests/fixture_project_index/site_config.yaml'
+
+# (key, site) pairs resembling the lookups made by the pipelines
+LOOKUPS = [(['ExportSettings', 'T1', 'formats'], 'CMH'),
+           (['XNAT_Archive'], 'CMH'),
+           (['XNATPORT'], 'MRC'),
+           (['paths', 'nii'], None),
+           (['PROJECTDIR'], None)]
+
+def main():
+    try:
+        iterations = int(sys.argv[1])
+    except IndexError:
+        iterations = 100000
+
+    cfg = datman.config.config(filename=SITE_CONFIG, system='local',
+                               study='STUDY')
+    # The benchmark keys aren't all in the fixture, add them to the site
+    # config so both methods succeed.
+    cfg.site_config['ExportSettings'] = {'T1': {'formats': ['nii', 'dcm']}}
+    cfg._scope_tables = {}
+
+    print("{:<40} {:>12} {:>12} {:>8}".format("lookup", "search (us)",
+            "table (us)", "speed-up"))
+    total_walk = total_table = 0
+    for key, site in LOOKUPS:
+        walk_time = timeit.timeit(lambda: cfg._walk_key(key, site=site),
+                                  number=iterations)
+        table_time = timeit.timeit(lambda: cfg.get_key(key, site=site),
+                                   number=iterations)
+        total_walk += walk_time
+        total_table += table_time
+        name = "{} site={}".format("/".join(key), site)
+        print("{:<40} {:>12.2f} {:>12.2f} {:>7.1f}x".format(name,
+                walk_time / iterations * 1e6, table_time / iterations * 1e6,
+                walk_time / table_time))
+
+    print("{:<40} {:>12.3f} {:>12.3f} {:>7.1f}x".format("total (s)", total_walk,
+            total_table, total_walk / total_table))
+
+if __name__ == '__main__':
+    main()
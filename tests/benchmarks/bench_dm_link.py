@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Benchmark of dm_link's lookup table matching and already-linked scan against
+the dataframe filtering and os.path.realpath calls they replaced.
+
+A synthetic lookup table of <rows> rows (with a dicom_StudyID column) is
+matched against <archives> archive names, and a folder of <archives> links is
+scanned for their targets.
+
+Usage:
+    python tests/benchmarks/bench_dm_link.py [<rows> [<archives>]]
+
+Run from the root of the datman repository, with datman installed or on the
+PYTHONPATH.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import importlib
+
+import pandas as pd
+
+link = importlib.import_module('bin.dm_link')
+
+def make_lookup_table(n_rows):
+    return pd.DataFrame({
+        'source_name': ['2017_{:06d}_EXAM'.format(i) for i in range(n_rows)],
+        'target_name': ['STUDY_CMH_{:06d}_01_01'.format(i)
+                        for i in range(n_rows)],
+        'dicom_StudyID': [str(i) for i in range(n_rows)]},
+        columns=['source_name', 'target_name', 'dicom_StudyID'])
+
+def match_dataframe(lookup_table, source_names):
+    for source_name in source_names:
+        lookupinfo = lookup_table[lookup_table['source_name'] == source_name]
+        lookupinfo['target_name'].tolist()[0]
+
+def match_dict(lookup_table, source_names):
+    lookup = link.read_lookup_table(lookup_table)
+    for source_name in source_names:
+        lookup[source_name].target_name
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+def make_links(root, n_links):
+    zips = os.path.join(root, 'zips')
+    dicom = os.path.join(root, 'dicom')
+    os.makedirs(zips)
+    os.makedirs(dicom)
+    for i in range(n_links):
+        archive = os.path.join(zips, '2017_{:06d}_EXAM.zip'.format(i))
+        open(archive, 'w').close()
+        os.symlink(os.path.relpath(archive, dicom), os.path.join(dicom,
+                'STUDY_CMH_{:06d}_01_01.zip'.format(i)))
+    return dicom
+
+def realpath_links(dicom):
+    return {os.path.realpath(f): f
+            for f in [os.path.join(dicom, name) for name in os.listdir(dicom)]
+            if os.path.islink(f)}
+
+def main():
+    try:
+        n_rows = int(sys.argv[1])
+    except IndexError:
+        n_rows = 50000
+    try:
+        n_archives = int(sys.argv[2])
+    except IndexError:
+        n_archives = 2000
+
+    lookup_table = make_lookup_table(n_rows)
+    step = max(n_rows // n_archives, 1)
+    source_names = list(lookup_table['source_name'][::step][:n_archives])
+
+    print("{} lookup rows, {} archives".format(n_rows, len(source_names)))
+    print("{:<36} {:>10}".format("method", "time (s)"))
+
+    _, old = timed(match_dataframe, lookup_table, source_names)
+    print("{:<36} {:>10.3f}".format("lookup: dataframe filter", old))
+    _, new = timed(match_dict, lookup_table, source_names)
+    print("{:<36} {:>10.3f}".format("lookup: dict (incl. building it)", new))
+
+    tmp = tempfile.mkdtemp(prefix='bench_dm_link')
+    try:
+        dicom = make_links(tmp, len(source_names))
+        old_links, old = timed(realpath_links, dicom)
+        print("{:<36} {:>10.3f}".format("linked: realpath", old))
+        new_links, new = timed(link.get_linked_archives, dicom)
+        print("{:<36} {:>10.3f}".format("linked: scandir + readlink", new))
+        assert sorted(old_links) == sorted(new_links)
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Benchmark of overlapping series downloads with their conversion, as
+dm_xnat_extract.py --prefetch does with datman.utils.prefetch.
+
+<series> series of <size_mb> MB are downloaded from the fake XNAT server in
+tests/fake_xnat.py at <rate> MB/s, unzipped, and 'converted' by a command that
+takes <convert> seconds, first one after the other and then with downloads
+running ahead of the conversions.
+
+Usage:
+    python tests/benchmarks/bench_prefetch.py [<series> [<size_mb> [<rate>
+            [<convert>]]]]
+
+Run from the root of the datman repository, with datman installed or on the
+PYTHONPATH.
+"""
+import os
+import sys
+import time
+import shutil
+import zipfile
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import datman.xnat
+import datman.utils
+from fake_xnat import FakeXnat
+
+SCAN = ('BENCH', 'STUDY_CMH_0001_01', 'STUDY_CMH_0001_01_01')
+
+def get_arg(index, default, convert=int):
+    try:
+        return convert(sys.argv[index])
+    except IndexError:
+        return default
+
+def make_download(xnat):
+    def download(series):
+        temp_dir = tempfile.mkdtemp(prefix='bench_prefetch')
+        archive = xnat.get_dicom(*(SCAN + (series,)))
+        with zipfile.ZipFile(archive[1]) as contents:
+            contents.extractall(temp_dir)
+        os.remove(archive[1])
+        return temp_dir
+    return download
+
+def run(xnat, series, convert_time, depth):
+    start = time.time()
+    for _, temp_dir in datman.utils.prefetch(series, make_download(xnat),
+                                             depth=depth,
+                                             release=shutil.rmtree):
+        datman.utils.run_command(['sleep', str(convert_time)])
+    return time.time() - start
+
+def main():
+    n_series = get_arg(1, 10)
+    size = int(get_arg(2, 5, float) * 1e6)
+    rate = get_arg(3, 10, float) * 1e6
+    convert_time = get_arg(4, 0.5, float)
+
+    archive = {SCAN[0]: {SCAN[1]: {SCAN[2]: dict(
+            (str(i), {'description': 'Series{}'.format(i), 'size': size})
+            for i in range(1, n_series + 1))}}}
+    series = [str(i) for i in range(1, n_series + 1)]
+
+    print("{} series of {:.1f} MB at {:.1f} MB/s ({:.2f}s each), {:.2f}s "
+          "conversions".format(n_series, size / 1e6, rate / 1e6, size / rate,
+                               convert_time))
+    print("{:<28} {:>10}".format("method", "time (s)"))
+    with FakeXnat(archive, rate=rate) as server:
+        xnat = datman.xnat.xnat(server.url, 'user', 'password')
+        try:
+            for depth in [0, 1, 2]:
+                label = "prefetch {}".format(depth) if depth else "serial"
+                print("{:<28} {:>10.2f}".format(label, run(xnat, series,
+                        convert_time, depth)))
+        finally:
+            xnat.session.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Benchmark of datman.scanid parsing over a synthetic project listing.
+
+Compares parsing every name with the uncached regex path, with
+parse_filename() (cold and warm cache) and with parse_many(), and reports
+the memory held by the parsed results.
+
+Usage:
+    python tests/benchmarks/bench_scanid.py [<files>]
+
+Run from the root of the datman repository, with datman installed or on the
+PYTHONPATH.
+"""
+import sys
+import time
+import resource
+
+import datman.scanid as scanid
+
+TAGS = ['T1', 'T2', 'DTI60-1000', 'RST', 'FMAP-AP', 'FMAP-PA', 'SPRL-COMB']
+SITES = ['CMH', 'MRC', 'ZHH', 'UTO']
+EXTS = ['.nii.gz', '.json', '.bvec', '.bval', '.dcm']
+
+def make_listing(n_files):
+    names = []
+    subject = 0
+    while len(names) < n_files:
+        site = SITES[subject % len(SITES)]
+        for series, tag in enumerate(TAGS):
+            for ext in EXTS:
+                names.append("/archive/SPN01/data/nii/SPN01_{site}_{sub:04d}_01/"
+                        "SPN01_{site}_{sub:04d}_01_01_{tag}_{series:02d}_"
+                        "Description{ext}".format(site=site, sub=subject,
+                        tag=tag, series=series + 1, ext=ext))
+        subject += 1
+    return names[:n_files]
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+def parse_all_uncached(names):
+    return [scanid._parse_filename(name.rsplit('/', 1)[-1]) for name in names]
+
+def parse_all(names):
+    return [scanid.parse_filename(name) for name in names]
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def main():
+    try:
+        n_files = int(sys.argv[1])
+    except IndexError:
+        n_files = 200000
+
+    names = make_listing(n_files)
+    # Make the cache big enough for the whole listing so the warm run
+    # measures hits rather than evictions
+    scanid._FILENAME_CACHE.size = n_files
+
+    print("{} file names".format(len(names)))
+    print("{:<28} {:>10} {:>12}".format("method", "time (s)", "max rss (MB)"))
+
+    _, uncached = timed(parse_all_uncached, names)
+    print("{:<28} {:>10.3f} {:>12.1f}".format("regex, no cache", uncached,
+            max_rss_mb()))
+
+    scanid.clear_cache()
+    _, cold = timed(parse_all, names)
+    print("{:<28} {:>10.3f} {:>12.1f}".format("parse_filename, cold", cold,
+            max_rss_mb()))
+
+    _, warm = timed(parse_all, names)
+    print("{:<28} {:>10.3f} {:>12.1f}".format("parse_filename, warm", warm,
+            max_rss_mb()))
+
+    scanid.clear_cache()
+    _, bulk = timed(scanid.parse_many, names)
+    print("{:<28} {:>10.3f} {:>12.1f}".format("parse_many", bulk,
+            max_rss_mb()))
+
+    ident = scanid.parse('SPN01_CMH_0001_01_01')
+    print("Identifier instance size: {} bytes (no per-instance "
+          "__dict__)".format(sys.getsizeof(ident)))
+
+if __name__ == '__main__':
+    main()
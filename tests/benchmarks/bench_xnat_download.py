@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Benchmark of downloading scan dicoms one at a time with xnat.get_dicom against
+xnat.get_dicoms_many with a pool of workers.
+
+The downloads are served by the fake XNAT server in tests/fake_xnat.py, which
+limits each transfer to <rate> MB/s and adds a delay of <latency> seconds to
+every request, to stand in for a real server's per-connection throughput.
+
+Usage:
+    python tests/benchmarks/bench_xnat_download.py [<scans> [<workers>]]
+            [<size_mb> [<rate> [<latency>]]]
+
+Run from the root of the datman repository, with datman installed or on the
+PYTHONPATH.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import datman.xnat
+from fake_xnat import FakeXnat
+
+PROJECT = 'BENCH'
+SESSION = 'STUDY_CMH_0001_01'
+EXPERIMENT = 'STUDY_CMH_0001_01_01'
+
+def get_arg(index, default, convert=int):
+    try:
+        return convert(sys.argv[index])
+    except IndexError:
+        return default
+
+def make_archive(n_scans, size):
+    scans = dict((str(i), {'description': 'Series{}'.format(i),
+                           'size': size})
+                 for i in range(1, n_scans + 1))
+    return {PROJECT: {SESSION: {EXPERIMENT: scans}}}
+
+def download_serial(xnat, scans, dest_dir):
+    for scan in scans:
+        filename = os.path.join(dest_dir, '{}.zip'.format(scan[-1]))
+        xnat.get_dicom(*scan, filename=(None, filename))
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+def main():
+    n_scans = get_arg(1, 20)
+    workers = get_arg(2, 8)
+    size = int(get_arg(3, 2, float) * 1e6)
+    rate = get_arg(4, 5, float) * 1e6
+    latency = get_arg(5, 0.05, float)
+
+    archive = make_archive(n_scans, size)
+    scans = [(PROJECT, SESSION, EXPERIMENT, str(i))
+             for i in range(1, n_scans + 1)]
+    total = n_scans * size / 1e6
+
+    print("{} scans of {:.1f} MB, {:.1f} MB/s per transfer, {:.2f}s "
+          "latency".format(n_scans, size / 1e6, rate / 1e6, latency))
+    print("{:<28} {:>10} {:>10}".format("method", "time (s)", "MB/s"))
+
+    with FakeXnat(archive, latency=latency, rate=rate) as server:
+        xnat = datman.xnat.xnat(server.url, 'user', 'password')
+        tmp = tempfile.mkdtemp(prefix='bench_xnat_download')
+        try:
+            elapsed = timed(download_serial, xnat, scans, tmp)
+            print("{:<28} {:>10.2f} {:>10.1f}".format("get_dicom (serial)",
+                                                      elapsed,
+                                                      total / elapsed))
+            shutil.rmtree(tmp)
+            os.makedirs(tmp)
+            elapsed = timed(xnat.get_dicoms_many, scans, tmp,
+                            max_workers=workers)
+            print("{:<28} {:>10.2f} {:>10.1f}".format(
+                "get_dicoms_many ({} workers)".format(workers), elapsed,
+                total / elapsed))
+        finally:
+            xnat.session.close()
+            shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
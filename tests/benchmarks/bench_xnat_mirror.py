@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Benchmark of reading a project's session, experiment and scan metadata the
+way dm_xnat_extract.py does, straight from XNAT and from an XNAT mirror that
+is synced first.
+
+The project has <sessions> sessions of <scans> scans each and is served by the
+fake XNAT server in tests/fake_xnat.py, which adds <latency> seconds to every
+request. <changed> sessions are modified between the first (full) sync and
+the second.
+
+Usage:
+    python tests/benchmarks/bench_xnat_mirror.py [<sessions> [<scans>
+            [<changed> [<latency>]]]]
+
+Run from the root of the datman repository, with datman installed or on the
+PYTHONPATH.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import datman.xnat
+import datman.xnat_mirror
+from fake_xnat import FakeXnat
+
+PROJECT = 'BENCH'
+
+def get_arg(index, default, convert=int):
+    try:
+        return convert(sys.argv[index])
+    except IndexError:
+        return default
+
+def make_archive(n_sessions, n_scans):
+    archive = {}
+    for i in range(n_sessions):
+        session = 'STUDY_CMH_{:04d}_01'.format(i)
+        archive[session] = {session + '_01': dict(
+                (str(scan), {'description': 'Series{}'.format(scan)})
+                for scan in range(1, n_scans + 1))}
+    return {PROJECT: archive}
+
+def read_project(xnat):
+    """Reads everything dm_xnat_extract reads about each session"""
+    for session in xnat.get_sessions(PROJECT):
+        document = xnat.get_session(PROJECT, session['label'])
+        for experiment in datman.xnat.get_session_experiments(document):
+            for scan in datman.xnat.get_experiment_scans(experiment):
+                assert datman.xnat.has_file_info(scan)
+
+def timed(server, func, *args):
+    requests = len(server.requests)
+    start = time.time()
+    func(*args)
+    return time.time() - start, len(server.requests) - requests
+
+def sync_and_read(mirror):
+    mirror.sync([PROJECT])
+    read_project(mirror)
+
+def main():
+    n_sessions = get_arg(1, 100)
+    n_scans = get_arg(2, 10)
+    n_changed = get_arg(3, 2)
+    latency = get_arg(4, 0.01, float)
+
+    print("{} sessions of {} scans, {} changed, {:.3f}s latency".format(
+            n_sessions, n_scans, n_changed, latency))
+    print("{:<28} {:>10} {:>10}".format("method", "time (s)", "requests"))
+
+    archive = make_archive(n_sessions, n_scans)
+    tmp = tempfile.mkdtemp(prefix='bench_xnat_mirror')
+    with FakeXnat(archive, latency=latency) as server:
+        xnat = datman.xnat.xnat(server.url, 'user', 'password')
+        mirror = datman.xnat_mirror.XnatMirror(
+                os.path.join(tmp, 'mirror.sqlite'), xnat)
+        try:
+            row = "{:<28} {:>10.2f} {:>10}"
+            print(row.format("server", *timed(server, read_project, xnat)))
+            print(row.format("mirror: first sync + read",
+                             *timed(server, sync_and_read, mirror)))
+            for session in sorted(archive[PROJECT])[:n_changed]:
+                server.touch(PROJECT, session + '_01')
+            print(row.format("mirror: next sync + read",
+                             *timed(server, sync_and_read, mirror)))
+        finally:
+            mirror.close()
+            xnat.session.close()
+            shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
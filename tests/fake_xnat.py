@@ -0,0 +1,427 @@
+"""
+A stand-in for an XNAT server, for testing and benchmarking datman.xnat
+offline.
+
+It serves the subset of the XNAT REST API that datman uses, from an in-memory
+description of the archive:
+
+    archive = {'PROJECT': {
+                  'STUDY_CMH_0001_01_01': {
+                      'STUDY_CMH_0001_01_01': {
+                          '1': {'description': 'SagT1', 'size': 1024}}}}}
+
+    with FakeXnat(archive) as server:
+        connection = datman.xnat.xnat(server.url, 'user', 'password')
+
+i.e. projects -> subjects (datman sessions) -> experiments -> scans, where
+each scan has a series description and the size in bytes of the dicom zip
+served for it.
+
+Every request is recorded in FakeXnat.requests as a (method, path) tuple, the
+Range headers of download requests in FakeXnat.range_requests and the number
+of logins in FakeXnat.logins. FakeXnat.max_active is the most GET requests
+that were in progress at once. expire_sessions() makes the server
+reject existing session cookies, as XNAT does when a session times out, and
+touch() updates an experiment's last modified date.
+'latency' adds a delay to every request and 'rate' limits the bytes per
+second of each download, to make network effects visible in benchmarks.
+
+Downloads honour 'Range: bytes=<start>-' request headers unless ranges=False.
+interrupt_downloads() makes the server drop the connection part way through
+the next downloads, to test resuming them.
+"""
+import io
+import re
+import json
+import time
+import zipfile
+import threading
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+CHUNK_SIZE = 64 * 1024
+
+PROJECT = r'/data/archive/projects/(?P<project>[^/?]+)'
+SUBJECT = PROJECT + r'/subjects/(?P<subject>[^/?]+)'
+EXPERIMENT = SUBJECT + r'/experiments/(?P<experiment>[^/?]+)'
+SCAN = EXPERIMENT + r'/scans/(?P<scan>[^/?]+)'
+
+
+class FakeXnat(object):
+
+    def __init__(self, archive, latency=0, rate=None, ranges=True):
+        self.archive = archive
+        self.latency = latency
+        self.rate = rate
+        self.ranges = ranges
+        self.interrupt_after = None
+        self.interruptions = 0
+        self.range_requests = []
+        self._modified = {}
+        self.active = 0
+        self.max_active = 0
+        self.requests = []
+        self.logins = 0
+        self._sessions = set()
+        self._lock = threading.Lock()
+        self._zips = {}
+
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.xnat = self
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_port)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        args=(0.05,))
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def expire_sessions(self):
+        with self._lock:
+            self._sessions.clear()
+
+    def interrupt_downloads(self, after, times=1):
+        """
+        Makes the next 'times' downloads stop after sending 'after' bytes.
+        """
+        with self._lock:
+            self.interrupt_after = after
+            self.interruptions = times
+
+    def take_interruption(self):
+        """
+        Returns the number of bytes to send before dropping the current
+        download, or None to send all of it.
+        """
+        with self._lock:
+            if not self.interruptions:
+                return None
+            self.interruptions -= 1
+            return self.interrupt_after
+
+    def touch(self, project, experiment):
+        """
+        Updates the last modified date of an experiment, as a change to it
+        on XNAT would.
+        """
+        with self._lock:
+            self._modified[(project, experiment)] = \
+                    '2018-01-01 00:00:{:02d}.0'.format(len(self._modified))
+
+    def count(self, pattern):
+        """
+        Returns the number of GET requests made to paths matching a regex.
+        """
+        return len([path for method, path in self.requests
+                    if method == 'GET' and re.search(pattern, path)])
+
+    def start_request(self):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+    def end_request(self):
+        with self._lock:
+            self.active -= 1
+
+    def login(self):
+        with self._lock:
+            self.logins += 1
+            session_id = 'FAKESESSION{}'.format(self.logins)
+            self._sessions.add(session_id)
+        return session_id
+
+    def is_logged_in(self, cookie_header):
+        match = re.search(r'JSESSIONID=([^;\s]+)', cookie_header or '')
+        with self._lock:
+            return match is not None and match.group(1) in self._sessions
+
+    def get_zip(self, project, subject, experiment, scan):
+        """
+        Returns the bytes of the dicom zip for a scan, or None if there's no
+        such scan.
+        """
+        key = (project, subject, experiment, scan)
+        try:
+            info = self.archive[project][subject][experiment][scan]
+        except KeyError:
+            return None
+        with self._lock:
+            if key not in self._zips:
+                self._zips[key] = _make_zip(key, info.get('size', 1024))
+            return self._zips[key]
+
+    def get_json(self, path):
+        """
+        Returns the JSON document for a GET of path, or None if it doesn't
+        exist.
+        """
+        archive = self.archive
+        match = re.match(SCAN + r'/?$', path)
+        if match:
+            fields = match.groupdict()
+            try:
+                info = archive[fields['project']][fields['subject']][
+                        fields['experiment']][fields['scan']]
+            except KeyError:
+                return None
+            return _items([_scan_item(fields['scan'], info)])
+
+        match = re.match(EXPERIMENT + r'/scans/?$', path)
+        if match:
+            scans = self._find(match)
+            if scans is None:
+                return None
+            return _results([{'ID': scan, 'type': info['description'],
+                              'series_description': info['description']}
+                             for scan, info in sorted(scans.items())])
+
+        match = re.match(EXPERIMENT + r'/resources/?$', path)
+        if match:
+            if self._find(match) is None:
+                return None
+            return _results([])
+
+        match = re.match(EXPERIMENT + r'/?$', path)
+        if match:
+            scans = self._find(match)
+            if scans is None:
+                return None
+            return _items([_experiment_item(match.group('experiment'),
+                                            scans)])
+
+        match = re.match(PROJECT + r'/experiments/?$', path)
+        if match:
+            project = match.group('project')
+            subjects = self._find(match)
+            if subjects is None:
+                return None
+            return _results([{'ID': experiment, 'label': experiment,
+                              'subject_label': subject, 'date': '2017-01-01',
+                              'insert_date': '2017-01-01 00:00:00.0',
+                              'last_modified': self._modified.get(
+                                  (project, experiment),
+                                  '2017-01-01 00:00:00.0')}
+                             for subject in sorted(subjects)
+                             for experiment in sorted(subjects[subject])])
+
+        match = re.match(SUBJECT + r'/experiments/?$', path)
+        if match:
+            experiments = self._find(match)
+            if experiments is None:
+                return None
+            return _results([{'label': label, 'ID': label}
+                             for label in sorted(experiments)])
+
+        match = re.match(SUBJECT + r'/?$', path)
+        if match:
+            experiments = self._find(match)
+            if experiments is None:
+                return None
+            subject = match.group('subject')
+            return _items([{
+                'data_fields': {'label': subject, 'ID': subject},
+                'children': [{'field': 'experiments/experiment',
+                              'items': [_experiment_item(label, scans)
+                                        for label, scans in
+                                        sorted(experiments.items())]}]}])
+
+        match = re.match(PROJECT + r'/subjects/?$', path)
+        if match:
+            subjects = self._find(match)
+            if subjects is None:
+                return None
+            return _results([{'label': label, 'ID': label}
+                             for label in sorted(subjects)])
+
+        match = re.match(PROJECT + r'/?$', path)
+        if match:
+            if self._find(match) is None:
+                return None
+            return _items([{'data_fields': {'ID': match.group('project')}}])
+
+        if re.match(r'/data/archive/projects/?$', path):
+            return _results([{'ID': project} for project in sorted(archive)])
+        return None
+
+    def _find(self, match):
+        node = self.archive
+        for level in ['project', 'subject', 'experiment']:
+            try:
+                key = match.group(level)
+            except IndexError:
+                break
+            try:
+                node = node[key]
+            except KeyError:
+                return None
+        return node
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping connections is expected, e.g. at shutdown
+        pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    # Keep connections open between requests, as XNAT does
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        xnat = self.server.xnat
+        path = urlparse(self.path).path
+        xnat.requests.append(('POST', path))
+        self._discard_body()
+        if path.rstrip('/') == '/data/JSESSION':
+            self._send(200, xnat.login().encode('ascii'), 'text/plain')
+            return
+        self._send(404, b'')
+
+    def do_GET(self):
+        self.server.xnat.start_request()
+        try:
+            self._get()
+        finally:
+            self.server.xnat.end_request()
+
+    def _get(self):
+        xnat = self.server.xnat
+        url = urlparse(self.path)
+        xnat.requests.append(('GET', url.path))
+        if xnat.latency:
+            time.sleep(xnat.latency)
+        if not xnat.is_logged_in(self.headers.get('Cookie')):
+            self._send(401, b'')
+            return
+
+        match = re.match(SCAN + r'/resources/DICOM/files$', url.path)
+        if match:
+            data = xnat.get_zip(*[match.group(level) for level in
+                                  ['project', 'subject', 'experiment',
+                                   'scan']])
+            if data is None:
+                self._send(404, b'')
+            else:
+                self._send_file(data)
+            return
+
+        document = xnat.get_json(url.path)
+        if document is None:
+            self._send(404, b'')
+            return
+        self._send(200, json.dumps(document).encode('utf-8'),
+                   'application/json')
+
+    def _discard_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+    def _send_file(self, data):
+        xnat = self.server.xnat
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range') or '')
+        if not (match and xnat.ranges):
+            self._send(200, data, 'application/zip',
+                       limit=xnat.take_interruption())
+            return
+        xnat.range_requests.append(self.headers.get('Range'))
+        start = int(match.group(1))
+        if start >= len(data):
+            self._send(416, b'', headers={
+                'Content-Range': 'bytes */{}'.format(len(data))})
+            return
+        self._send(206, data[start:], 'application/zip', headers={
+                       'Content-Range': 'bytes {}-{}/{}'.format(
+                           start, len(data) - 1, len(data))},
+                   limit=xnat.take_interruption())
+
+    def _send(self, status, body, content_type='text/plain', headers=None,
+              limit=None):
+        """
+        Sends a response. If limit is set the connection is dropped after
+        that many bytes of the body.
+        """
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if limit is not None:
+            body = body[:limit]
+            self.close_connection = True
+        rate = self.server.xnat.rate
+        for start in range(0, len(body), CHUNK_SIZE):
+            chunk = body[start:start + CHUNK_SIZE]
+            self.wfile.write(chunk)
+            if rate:
+                time.sleep(float(len(chunk)) / rate)
+
+
+def _results(results):
+    return {'ResultSet': {'Result': results,
+                          'totalRecords': str(len(results))}}
+
+def _items(items):
+    return {'items': items}
+
+def _experiment_item(experiment, scans):
+    """
+    Makes the document for an experiment. As in XNAT, it holds the documents
+    for all of its scans.
+    """
+    return {'data_fields': {'label': experiment, 'ID': experiment,
+                            'UID': '1.2.3.' + experiment,
+                            'date': '2017-01-01'},
+            'children': [{'field': 'scans/scan',
+                          'items': [_scan_item(scan, info) for scan, info in
+                                    sorted(scans.items())]}]}
+
+def _scan_item(scan, info):
+    return {'data_fields': {'ID': scan, 'type': info['description'],
+                            'series_description': info['description'],
+                            'UID': '1.2.3.4.' + scan},
+            'children': [{'field': 'file', 'items': [{'data_fields': {
+                'label': 'DICOM', 'format': 'DICOM',
+                'content': info.get('content', 'RAW')}}]}]}
+
+def _make_zip(key, size):
+    """
+    Makes a zip holding one stored (uncompressed) member of about size bytes.
+    """
+    seed = '/'.join(key).encode('utf-8')
+    data = (seed * (size // len(seed) + 1))[:size]
+    contents = io.BytesIO()
+    with zipfile.ZipFile(contents, 'w', zipfile.ZIP_STORED) as archive:
+        archive.writestr('{}/scans/{}/DICOM/image1.dcm'.format(key[2],
+                                                               key[3]), data)
+    return contents.getvalue()
@@ -4,10 +4,13 @@ Tests for datman/config.py
 """
 
 import os
+import shutil
+import tempfile
 import unittest
 
 import nose.tools
 from nose.tools import raises
+from mock import patch
 
 import datman.config as config
 
@@ -17,3 +20,153 @@ def test_initialise_from_environ():
     os.environ['DM_CONFIG'] = os.path.join(FIXTURE_DIR, 'site_config.yml')
     os.environ['DM_SYSTEM'] = 'test'
     cfg = config.config()
+
+class TestProjectIndex(unittest.TestCase):
+    site_config = os.path.join("tests/fixture_project_index", "site_config.yaml")
+    system = 'local'
+
+    def setUp(self):
+        config._PROJECT_INDEX.clear()
+        self.cfg = config.config(filename=self.site_config, system=self.system)
+
+    def test_maps_study_tag_to_project(self):
+        project = self.cfg.map_xnat_archive_to_project('OTH01_CMH_0001_01_01')
+
+        assert project == 'OTHER'
+        assert self.cfg.study_name == 'OTHER'
+
+    def test_maps_site_tags_to_project(self):
+        assert self.cfg.map_xnat_archive_to_project('STUALT') == 'STUDY'
+        assert self.cfg.map_xnat_archive_to_project('STUMRC') == 'STUDY'
+
+    def test_index_only_built_once(self):
+        self.cfg.map_xnat_archive_to_project('STU01_CMH_0001_01_01')
+        other_cfg = config.config(filename=self.site_config, system=self.system)
+
+        with patch.object(other_cfg, 'load_yaml',
+                wraps=other_cfg.load_yaml) as mock_load:
+            other_cfg.map_xnat_archive_to_project('OTH01_CMH_0001_01_01')
+
+        # Only the matched project's settings should have been read
+        assert mock_load.call_count == 1
+
+    @raises(ValueError)
+    def test_raises_value_error_for_undefined_tag(self):
+        self.cfg.map_xnat_archive_to_project('NOPE_CMH_0001_01_01')
+
+class TestConfigSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.yaml_file = os.path.join(self.cache_dir, 'settings.yml')
+        with open(self.yaml_file, 'w') as settings:
+            settings.write('PROJECTDIR: STUDY\n')
+        self.old_cache = os.environ.get('DM_CONFIG_CACHE')
+        os.environ['DM_CONFIG_CACHE'] = os.path.join(self.cache_dir, 'cache')
+        self.cfg = config.config(filename=os.path.join(FIXTURE_DIR,
+                'site_config.yml'), system='test')
+
+    def tearDown(self):
+        if self.old_cache is None:
+            del os.environ['DM_CONFIG_CACHE']
+        else:
+            os.environ['DM_CONFIG_CACHE'] = self.old_cache
+        shutil.rmtree(self.cache_dir)
+
+    def test_snapshot_used_when_file_unchanged(self):
+        self.cfg.load_yaml(self.yaml_file)
+
+        with patch('datman.config.parse_yaml') as mock_parse:
+            contents = self.cfg.load_yaml(self.yaml_file)
+
+        assert not mock_parse.called
+        assert contents == {'PROJECTDIR': 'STUDY'}
+
+    def test_snapshot_ignored_when_file_changes(self):
+        self.cfg.load_yaml(self.yaml_file)
+        with open(self.yaml_file, 'w') as settings:
+            settings.write('PROJECTDIR: NEWSTUDY\n')
+        # Make sure the change is visible even on coarse mtime filesystems
+        os.utime(self.yaml_file, (0, 0))
+
+        contents = self.cfg.load_yaml(self.yaml_file)
+
+        assert contents == {'PROJECTDIR': 'NEWSTUDY'}
+
+    def test_snapshots_disabled_when_cache_dir_empty(self):
+        snapshot = config.get_snapshot_path(self.yaml_file)
+        os.environ['DM_CONFIG_CACHE'] = ''
+        self.cfg.load_yaml(self.yaml_file)
+
+        assert not os.path.exists(snapshot)
+
+class TestGetConfig(unittest.TestCase):
+    site_config = os.path.join("tests/fixture_project_index", "site_config.yaml")
+    system = 'local'
+
+    def setUp(self):
+        config._CONFIG_REGISTRY.clear()
+
+    def test_returns_same_instance_for_same_study(self):
+        by_name = config.get_config(self.site_config, self.system, 'STUDY')
+        by_session = config.get_config(self.site_config, self.system,
+                'STU01_CMH_0001_01_01')
+
+        assert by_name is by_session
+        assert by_name.study_name == 'STUDY'
+
+    def test_returns_different_instance_for_each_study(self):
+        study = config.get_config(self.site_config, self.system, 'STUDY')
+        other = config.get_config(self.site_config, self.system, 'OTHER')
+
+        assert study is not other
+        assert other.study_name == 'OTHER'
+
+    @raises(RuntimeError)
+    def test_shared_config_cant_change_study(self):
+        shared = config.get_config(self.site_config, self.system, 'STUDY')
+        shared.set_study('OTHER')
+
+    def test_copy_can_change_study_without_changing_shared_config(self):
+        shared = config.get_config(self.site_config, self.system, 'STUDY')
+        copied = shared.copy()
+        copied.set_study('OTHER')
+
+        assert copied.study_name == 'OTHER'
+        assert shared.study_name == 'STUDY'
+
+class TestGetKey(unittest.TestCase):
+    site_config = os.path.join("tests/fixture_project_index", "site_config.yaml")
+    system = 'local'
+
+    def setUp(self):
+        self.cfg = config.config(filename=self.site_config, system=self.system,
+                study='STUDY')
+
+    def test_site_settings_override_study_settings(self):
+        assert self.cfg.get_key('XNATPORT', site='CMH') == '33'
+
+    def test_study_settings_override_site_config(self):
+        assert self.cfg.get_key('XNATPORT') == '22'
+        assert self.cfg.get_key('XNATPORT', site='MRC') == '22'
+
+    def test_site_config_used_when_study_not_set(self):
+        cfg = config.config(filename=self.site_config, system=self.system)
+        assert cfg.get_key('XNATPORT') == '11'
+
+    def test_nested_keys_found(self):
+        assert self.cfg.get_key(['Sites', 'MRC', 'SITE_TAGS']) == 'STUMRC'
+
+    @raises(KeyError)
+    def test_raises_key_error_for_undefined_key(self):
+        self.cfg.get_key(['paths', 'undefined'])
+
+    def test_table_matches_recursive_search(self):
+        for site in [None, 'CMH', 'MRC']:
+            for path in self.cfg._get_scope_table(site):
+                assert (self.cfg.get_key(list(path), site=site) ==
+                        self.cfg._walk_key(list(path), site=site))
+
+    def test_get_path_uses_study_override(self):
+        assert self.cfg.get_path('nii') == 'tests/STUDY/data/study_nii/'
+        assert self.cfg.get_path('meta') == 'tests/STUDY/metadata/'
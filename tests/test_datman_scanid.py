@@ -95,4 +95,42 @@ def test_parse_filename_with_path():
     eq_(series, '02')
     eq_(description, 'description')
 
+@raises(AttributeError)
+def test_identifier_is_immutable():
+    ident = scanid.parse("DTI_CMH_H001_01_02")
+    ident.session = '01'
+
+def test_identifier_replace_makes_modified_copy():
+    ident = scanid.parse("DTI_CMH_H001_01")
+    new_ident = ident.replace(session='01')
+    eq_(ident.session, '')
+    eq_(str(new_ident), 'DTI_CMH_H001_01_01')
+
+def test_repeated_parse_returns_cached_identifier():
+    scanid.clear_cache()
+    first = scanid.parse("DTI_CMH_H001_01_02")
+    ok_(scanid.parse("DTI_CMH_H001_01_02") is first)
+    eq_(first, scanid.Identifier("DTI", "CMH", "H001", "01", "02"))
+
+@raises(scanid.ParseException)
+def test_cached_parse_failure_still_raises():
+    scanid.clear_cache()
+    try:
+        scanid.parse_filename("not_a_datman_name.nii")
+    except scanid.ParseException:
+        pass
+    scanid.parse_filename("not_a_datman_name.nii")
+
+def test_parse_many_returns_columns():
+    columns = scanid.parse_many([
+            '/data/DTI_CMH_H001_01_01_T1_02_description.nii.gz',
+            'garbage.txt',
+            'SPN01_MRC_PHA_FBN0013_RST_04_EPI-3x3x4xTR2.nii.gz'])
+    eq_(columns['study'], ['DTI', None, 'SPN01'])
+    eq_(columns['subject'], ['H001', None, 'PHA_FBN0013'])
+    eq_(columns['tag'], ['T1', None, 'RST'])
+    eq_(columns['series'], ['02', None, '04'])
+    eq_(columns['session'], ['01', None, ''])
+    eq_(columns['path'][1], 'garbage.txt')
+
 # vim: ts=4 sw=4:
@@ -96,6 +96,12 @@ class PrepareScan(unittest.TestCase):
     def test_exits_gracefully_with_bad_subject_id(self):
         qc.prepare_scan("STUDYSITE_ID", config)
 
+    @nose.tools.raises(SystemExit)
+    @patch('datman.scan.list_dir')
+    def test_exits_gracefully_with_misnamed_file(self, mock_list):
+        mock_list.return_value = ['some_misnamed_file.nii']
+        qc.prepare_scan("STUDY_SITE_ID_01", config)
+
     @patch('bin.dm-qc-report.verify_input_paths')
     @patch('datman.utils')
     def test_checks_input_paths(self, mock_utils, mock_verify):
@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 import unittest
 import importlib
 
@@ -65,41 +67,99 @@ class GetSearchPaths(unittest.TestCase):
 
         assert sorted(search_paths) == sorted(expected)
 
+class PrefixMatcher(unittest.TestCase):
+
+    def test_matches_names_starting_with_any_entry(self):
+        matcher = remove.PrefixMatcher(['STUDY_SITE_0001_01_01_T1_02_SagT1',
+                'STUDY_SITE_0002_01_01_DTI_05_Ax'])
+
+        assert matcher.match('STUDY_SITE_0001_01_01_T1_02_SagT1.nii.gz')
+        assert matcher.match('STUDY_SITE_0002_01_01_DTI_05_Ax.bvec')
+        assert not matcher.match('STUDY_SITE_0001_01_01_T1_03_SagT1.nii.gz')
+        assert not matcher.match('AAA')
+        assert not matcher.match('ZZZ')
+
+    def test_shorter_entry_still_matches_when_longer_entry_sorts_between(
+            self):
+        matcher = remove.PrefixMatcher(['STUDY_SITE_0001',
+                'STUDY_SITE_0001_01_01_T1_02_SagT1'])
+
+        assert matcher.match('STUDY_SITE_0001_01_01_T2_03_Ax.nii.gz') == \
+                'STUDY_SITE_0001'
+
 class FindFiles(unittest.TestCase):
-    search_path = '/some/path/some/where'
-    item = 'STUDY_SITE_ID_01_01_TAG_NUM_DESCR'
+    item = 'STUDY_SITE_0001_01_01_TAG_02_DESCR'
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='dm_blacklist_rm_test')
+        self.matcher = remove.PrefixMatcher([self.item])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_file(self, *path):
+        full_path = os.path.join(self.root, *path)
+        if not os.path.exists(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        open(full_path, 'w').close()
+        return full_path
+
+    def test_returns_empty_list_when_no_results(self):
+        self.make_file('subject', 'STUDY_SITE_0001_01_01_TAG_03_DESCR.nii')
+
+        found, visited = remove.find_files(self.root, self.matcher)
+
+        assert found == []
+        assert visited == 1
+
+    def test_finds_matches_in_nested_folders(self):
+        expected = [self.make_file('a', '{}.nii'.format(self.item)),
+                    self.make_file('a', 'b', '{}.bvec'.format(self.item)),
+                    self.make_file('{}.bval'.format(self.item))]
+        self.make_file('a', 'b', 'unrelated.txt')
+
+        found, visited = remove.find_files(self.root, self.matcher)
+
+        assert sorted(found) == sorted(expected)
+        assert visited == 4
 
-    @patch('datman.utils.run')
-    def test_returns_empty_list_when_no_results(self, mock_find):
-        mock_find.return_value = (0, '')
+    def test_doesnt_follow_symlinked_folders(self):
+        outside = tempfile.mkdtemp(prefix='dm_blacklist_rm_test')
+        try:
+            open(os.path.join(outside, '{}.nii'.format(self.item)), 'w').close()
+            os.symlink(outside, os.path.join(self.root, 'link'))
 
-        actual_result = remove.find_files(self.search_path, self.item)
-        expected_result = []
+            found, _ = remove.find_files(self.root, self.matcher)
+        finally:
+            shutil.rmtree(outside)
 
-        assert actual_result == expected_result
+        assert found == []
 
-    @patch('datman.utils.run')
-    def test_doesnt_include_empty_string_in_result_list(self, mock_find):
-        # Without the .strip() argument, the empty string will always appear as
-        # as the last item in the returned list. This test should fail if it is
-        # removed for any reason, to guard against this problem.
-        mock_find.return_value = (0, '{}/{}.dcm\n'.format(self.search_path,
-                self.item))
+class RemoveBlacklistedItems(unittest.TestCase):
+    item = 'STUDY_SITE_0001_01_01_TAG_02_DESCR'
 
-        actual_result = remove.find_files(self.search_path, self.item)
-        expected_result = ['{}/{}.dcm'.format(self.search_path, self.item)]
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='dm_blacklist_rm_test')
+        self.nii = os.path.join(self.root, 'nii')
+        self.config = MagicMock()
+        self.config.get_key.return_value = {'nii': 'nii'}
+        self.config.get_path.return_value = self.nii
 
-        assert actual_result == expected_result
+    def tearDown(self):
+        shutil.rmtree(self.root)
 
-    @patch('datman.utils.run')
-    def test_correctly_splits_string_with_multiple_matches(self, mock_find):
-        mock_find.return_value = (0, '{path}/{item}.nii\n{path}/{item}.bval\n'
-                    '{path}/{item}.bvec\n'.format(path=self.search_path,
-                    item=self.item))
+    def test_removes_matches_and_prunes_empty_folders_bottom_up(self):
+        nested = os.path.join(self.nii, 'subject', 'inner')
+        os.makedirs(nested)
+        for ext in ['.nii', '.bvec', '.bval']:
+            open(os.path.join(nested, self.item + ext), 'w').close()
+        keep = os.path.join(self.nii, 'other', 'keep.nii')
+        os.makedirs(os.path.dirname(keep))
+        open(keep, 'w').close()
 
-        actual_result = remove.find_files(self.search_path, self.item)
-        expected_result = ['{}/{}.nii'.format(self.search_path, self.item),
-                           '{}/{}.bval'.format(self.search_path, self.item),
-                           '{}/{}.bvec'.format(self.search_path, self.item)]
+        remove.remove_blacklisted_items([self.item], self.config, [],
+                threads=2)
 
-        assert sorted(actual_result) == sorted(expected_result)
+        assert not os.path.exists(os.path.join(self.nii, 'subject'))
+        assert os.path.exists(keep)
+        assert os.path.exists(self.nii)
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+import importlib
+import logging
+
+import pandas as pd
+from mock import patch
+
+link = importlib.import_module('bin.dm_link')
+
+logging.disable(logging.CRITICAL)
+
+class ReadLookupTable(unittest.TestCase):
+    lookup_table = pd.DataFrame([
+            ['2014_0126_FB001', 'STUDY_CMH_FB001_01_01', '512'],
+            ['2014_0127_FB002', '<ignore>', None],
+            ['2014_0126_FB001', 'STUDY_CMH_FB999_01_01', '999']],
+            columns=['source_name', 'target_name', 'dicom_StudyID'])
+
+    def setUp(self):
+        link.lookup = link.read_lookup_table(self.lookup_table)
+
+    def test_first_row_for_a_source_name_is_used(self):
+        scanid, expected = link.get_scanid_from_lookup_table(
+                '/zips/2014_0126_FB001.zip')
+        assert scanid == 'STUDY_CMH_FB001_01_01'
+        assert expected == (('StudyID', '512'),)
+
+    def test_returns_None_for_missing_archive(self):
+        assert link.get_scanid_from_lookup_table('/zips/other.zip') is None
+
+    @patch('bin.dm_link.get_archive_headers')
+    def test_validate_headers_compares_dicom_fields(self, mock_headers):
+        mock_headers.return_value = {'StudyID': 512}
+        _, expected = link.get_scanid_from_lookup_table(
+                '/zips/2014_0126_FB001.zip')
+
+        assert link.validate_headers('2014_0126_FB001.zip', expected,
+                'PatientName')
+        mock_headers.return_value = {'StudyID': 511}
+        assert not link.validate_headers('2014_0126_FB001.zip', expected,
+                'PatientName')
+
+class GetLinkedArchives(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='dm_link_test')
+        self.zips = os.path.join(self.tmp, 'zips')
+        self.dicom = os.path.join(self.tmp, 'dicom')
+        os.makedirs(self.zips)
+        os.makedirs(self.dicom)
+        # Reach the zips through a link, like a mounted archive would
+        os.symlink(self.zips, os.path.join(self.tmp, 'zips_link'))
+        link.real_folders.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_finds_archives_linked_with_relative_paths(self):
+        archive = os.path.join(self.tmp, 'zips_link', 'exam.zip')
+        open(archive, 'w').close()
+        target = os.path.join(self.dicom, 'STUDY_CMH_0001_01_01.zip')
+        os.symlink(os.path.relpath(archive, self.dicom), target)
+        open(os.path.join(self.dicom, 'not_a_link.zip'), 'w').close()
+
+        linked = link.get_linked_archives(self.dicom)
+
+        assert linked == {link.get_real_path(archive): target}
+        assert link.get_real_path(os.path.join(self.zips, 'exam.zip')) in \
+                linked
@@ -0,0 +1,124 @@
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+from datman.export_ledger import ExportLedger, Source, OutputListing, \
+        is_current
+
+logging.disable(logging.CRITICAL)
+
+SESSION = 'STUDY_CMH_0001_01_01'
+SCAN = SESSION + '_T1_02_SagT1'
+SOURCE = Source('1.2.840.1234', 176, 92274688)
+
+class TestExportLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='datman_ledger_test')
+        self.db_path = os.path.join(self.tmp, 'ledger.sqlite')
+        self.ledger = ExportLedger(self.db_path)
+        self.outputs = [self.make_output('.nii.gz'), self.make_output('.json')]
+
+    def tearDown(self):
+        self.ledger.close()
+        shutil.rmtree(self.tmp)
+
+    def make_output(self, ext):
+        path = os.path.join(self.tmp, SCAN + ext)
+        with open(path, 'w') as output:
+            output.write('data')
+        return path
+
+    def get_export(self, format='nii'):
+        return self.ledger.get_session(SESSION).get((SCAN, format))
+
+    def test_unrecorded_series_is_not_current(self):
+        assert self.get_export() is None
+        assert not is_current(self.get_export(), SOURCE, 'dcm2niix/1')
+
+    def test_recorded_series_is_current(self):
+        self.ledger.record(SESSION, SCAN, 'nii', SOURCE, 'dcm2niix/1',
+                           self.outputs)
+
+        assert is_current(self.get_export(), SOURCE, 'dcm2niix/1')
+
+    def test_record_is_kept_after_reopening(self):
+        self.ledger.record(SESSION, SCAN, 'nii', SOURCE, 'dcm2niix/1',
+                           self.outputs)
+        self.ledger.close()
+        self.ledger = ExportLedger(self.db_path)
+
+        export = self.get_export()
+        assert export.source == SOURCE
+        assert export.outputs == sorted(self.outputs)
+        assert is_current(export, SOURCE, 'dcm2niix/1')
+
+    def test_series_changed_on_xnat_is_not_current(self):
+        self.ledger.record(SESSION, SCAN, 'nii', SOURCE, 'dcm2niix/1',
+                           self.outputs)
+
+        changed = SOURCE._replace(file_count=177)
+        assert not is_current(self.get_export(), changed, 'dcm2niix/1')
+
+    def test_new_exporter_version_is_not_current(self):
+        self.ledger.record(SESSION, SCAN, 'nii', SOURCE, 'dcm2niix/1',
+                           self.outputs)
+
+        assert not is_current(self.get_export(), SOURCE, 'dcm2niix/2')
+
+    def test_missing_output_is_not_current(self):
+        self.ledger.record(SESSION, SCAN, 'nii', SOURCE, 'dcm2niix/1',
+                           self.outputs)
+        os.remove(self.outputs[1])
+
+        assert not is_current(self.get_export(), SOURCE, 'dcm2niix/1')
+
+    def test_formats_are_recorded_separately(self):
+        self.ledger.record(SESSION, SCAN, 'nii', SOURCE, 'dcm2niix/1',
+                           self.outputs)
+
+        assert self.get_export('mnc') is None
+
+    def test_forget_removes_record(self):
+        self.ledger.record(SESSION, SCAN, 'nii', SOURCE, 'dcm2niix/1',
+                           self.outputs)
+        self.ledger.forget(SCAN, 'nii')
+
+        assert self.get_export() is None
+
+    def test_get_session_only_returns_that_session(self):
+        other = 'STUDY_CMH_0002_01_01'
+        self.ledger.record(other, other + '_T1_02_SagT1', 'nii', SOURCE,
+                           'dcm2niix/1', self.outputs)
+
+        assert self.ledger.get_session(SESSION) == {}
+
+
+class TestOutputListing(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='datman_ledger_test')
+        open(os.path.join(self.tmp, 'scan.nii.gz'), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_finds_existing_files(self):
+        listing = OutputListing()
+
+        assert listing.exists(os.path.join(self.tmp, 'scan.nii.gz'))
+        assert not listing.exists(os.path.join(self.tmp, 'scan.json'))
+
+    def test_missing_folder_has_no_files(self):
+        listing = OutputListing()
+
+        assert not listing.exists(os.path.join(self.tmp, 'missing', 'scan'))
+
+    def test_lists_each_folder_once(self):
+        listing = OutputListing()
+        listing.exists(os.path.join(self.tmp, 'scan.nii.gz'))
+        open(os.path.join(self.tmp, 'scan.json'), 'w').close()
+
+        assert not listing.exists(os.path.join(self.tmp, 'scan.json'))
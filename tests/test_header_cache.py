@@ -0,0 +1,127 @@
+import os
+import time
+import shutil
+import zipfile
+import tempfile
+import unittest
+import logging
+
+import dicom
+from dicom.dataset import Dataset, FileDataset
+from mock import patch
+
+import datman.utils
+import datman.header_cache as header_cache
+
+logging.disable(logging.CRITICAL)
+
+def make_dicom(path, series, description='SagT1'):
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = '1.2.3.' + series
+    meta.ImplementationClassUID = '1.2.3.4'
+    meta.TransferSyntaxUID = dicom.UID.ExplicitVRLittleEndian
+    dataset = FileDataset(path, {}, file_meta=meta, preamble=b'\0' * 128)
+    dataset.is_little_endian = True
+    dataset.is_implicit_VR = False
+    dataset.SeriesInstanceUID = '1.2.3.' + series
+    dataset.StudyInstanceUID = '1.2.3'
+    dataset.SeriesNumber = int(series)
+    dataset.SeriesDescription = description
+    dataset.PatientName = 'STUDY_CMH_0001_01_01'
+    dataset.ImageType = ['ORIGINAL', 'PRIMARY']
+    dataset.save_as(path)
+
+class TestHeaderCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='datman_header_cache_test')
+        self.archive = os.path.join(self.tmp, 'exam.zip')
+        self.make_archive(['01', '02'])
+        self.cache = header_cache.HeaderCache(os.path.join(self.tmp,
+                'cache.sqlite'))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmp)
+
+    def make_archive(self, series_nums, mtime=1000):
+        with zipfile.ZipFile(self.archive, 'w') as archive:
+            for series in series_nums:
+                path = os.path.join(self.tmp, series + '.dcm')
+                make_dicom(path, series)
+                archive.write(path, 'exam/series{}/image1.dcm'.format(series))
+        os.utime(self.archive, (mtime, mtime))
+
+    def get_headers(self, **kwargs):
+        return datman.utils.get_archive_headers(self.archive,
+                cache=self.cache, **kwargs)
+
+    def test_unchanged_archive_is_not_reread(self):
+        first = self.get_headers()
+
+        with patch('datman.utils.get_zipfile_headers') as mock_read:
+            second = self.get_headers()
+            assert not mock_read.called
+
+        assert sorted(second) == sorted(first)
+        header = second['exam/series02']
+        assert header.SeriesNumber == 2
+        assert header.SeriesInstanceUID == '1.2.3.02'
+        assert str(header.PatientName) == 'STUDY_CMH_0001_01_01'
+
+    def test_changed_archive_is_reread(self):
+        self.get_headers()
+        self.make_archive(['01', '02', '03'], mtime=2000)
+
+        headers = self.get_headers()
+
+        assert len(headers) == 3
+
+    def test_fields_not_in_cache_are_not_returned(self):
+        headers = self.get_headers()
+
+        assert 'ImageType' not in headers['exam/series01']
+
+    def test_extra_fields_cause_a_reread_until_cached(self):
+        self.get_headers()
+        extra = header_cache.HeaderCache(self.cache.db_path,
+                fields=header_cache.HEADER_FIELDS + ['ImageType'])
+
+        assert extra.get(self.archive) is None
+        headers = datman.utils.get_archive_headers(self.archive, cache=extra)
+        assert extra.get(self.archive)['exam/series01'].ImageType == \
+                headers['exam/series01'].ImageType
+        extra.close()
+
+    def test_single_header_not_used_for_whole_archive(self):
+        first = self.get_headers(stop_after_first=True)
+        assert len(first) == 1
+
+        with patch('datman.utils.get_zipfile_headers') as mock_read:
+            assert len(self.get_headers(stop_after_first=True)) == 1
+            assert not mock_read.called
+
+        assert self.cache.get(self.archive) is None
+        assert len(self.get_headers()) == 2
+
+    def test_whole_archive_answers_stop_after_first(self):
+        self.get_headers()
+
+        headers = self.cache.get(self.archive, stop_after_first=True)
+
+        assert len(headers) == 1
+
+    def test_only_uncached_archives_are_read_for_many(self):
+        other = os.path.join(self.tmp, 'other.zip')
+        shutil.copy(self.archive, other)
+        self.get_headers()
+
+        with patch('datman.utils._read_archive_headers') as mock_read:
+            mock_read.side_effect = lambda task: (task[0], {}, None)
+            headers = datman.utils.get_archive_headers_many(
+                    [self.archive, other], cache=self.cache)
+
+        assert mock_read.call_count == 1
+        assert len(headers[self.archive]) == 2
+        assert self.cache.get(other) == {}
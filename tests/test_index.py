@@ -0,0 +1,122 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import logging
+
+import datman.index
+import datman.proc
+
+logging.disable(logging.CRITICAL)
+
+class TestProjectIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.project = tempfile.mkdtemp(prefix='datman_index_test')
+        self.nii = os.path.join(self.project, 'nii')
+        self.qc = os.path.join(self.project, 'qc')
+        self.make_file(self.nii, 'STUDY_CMH_0001_01',
+                'STUDY_CMH_0001_01_01_T1_02_SagT1.nii.gz', mtime=100)
+        self.make_file(self.nii, 'STUDY_CMH_0001_01',
+                'STUDY_CMH_0001_01_01_DTI60-1000_05_Ax-DTI.nii.gz', mtime=100)
+        self.make_file(self.nii, 'STUDY_MRC_0002_01',
+                'STUDY_MRC_0002_01_01_T1_03_SagT1.nii.gz', mtime=100)
+        self.make_file(self.nii, 'STUDY_MRC_0002_01', 'notes.txt', mtime=100)
+        self.make_file(self.qc, 'STUDY_CMH_0001_01',
+                'qc_STUDY_CMH_0001_01.html', mtime=200)
+        self.make_file(self.qc, 'STUDY_MRC_0002_01',
+                'qc_STUDY_MRC_0002_01.html', mtime=50)
+        self.db_path = os.path.join(self.project, 'index.sqlite')
+        self.index = datman.index.ProjectIndex(self.db_path,
+                {'nii': self.nii, 'qc': self.qc})
+        self.index.refresh()
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.project)
+
+    def make_file(self, root, session, name, mtime=None):
+        folder = os.path.join(root, session)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        path = os.path.join(folder, name)
+        with open(path, 'w') as new_file:
+            new_file.write(name)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def touch_folder(self, folder):
+        # Guarantee the folder looks changed even with coarse timestamps
+        future = time.time() + 100
+        os.utime(folder, (future, future))
+
+    def test_finds_files_by_parsed_fields(self):
+        t1s = self.index.find('nii', tag='T1')
+        assert [item.name for item in t1s] == [
+                'STUDY_CMH_0001_01_01_T1_02_SagT1.nii.gz',
+                'STUDY_MRC_0002_01_01_T1_03_SagT1.nii.gz']
+
+        cmh_t1 = self.index.find('nii', tag='T1', site='CMH')
+        assert len(cmh_t1) == 1
+        assert cmh_t1[0].series == '02'
+        assert cmh_t1[0].ext == '.nii.gz'
+        assert cmh_t1[0].description == 'SagT1'
+
+    def test_files_not_following_convention_are_indexed_without_fields(self):
+        notes = self.index.find('nii', name='notes.txt')
+        assert len(notes) == 1
+        assert notes[0].tag is None
+
+    def test_listdir_returns_none_for_unindexed_folder(self):
+        assert self.index.listdir(self.project) is None
+        assert 'notes.txt' in self.index.listdir(
+                os.path.join(self.nii, 'STUDY_MRC_0002_01'))
+
+    def test_refresh_only_rereads_changed_folders(self):
+        assert self.index.refresh() == 0
+
+        session = os.path.join(self.nii, 'STUDY_CMH_0001_01')
+        self.make_file(self.nii, 'STUDY_CMH_0001_01',
+                'STUDY_CMH_0001_01_01_T2_03_Ax.nii.gz')
+        self.touch_folder(session)
+
+        assert self.index.refresh() == 1
+        assert len(self.index.find('nii', tag='T2')) == 1
+
+    def test_refresh_drops_removed_folders(self):
+        shutil.rmtree(os.path.join(self.nii, 'STUDY_MRC_0002_01'))
+
+        self.index.refresh()
+
+        assert self.index.get_sessions('nii') == ['STUDY_CMH_0001_01']
+        assert self.index.find('nii', site='MRC') == []
+
+    def test_index_persists_between_instances(self):
+        with datman.index.ProjectIndex(self.db_path,
+                {'nii': self.nii, 'qc': self.qc}) as index:
+            assert index.refresh() == 0
+            assert len(index.find('nii', tag='T1')) == 2
+
+    def test_finds_sessions_with_data_newer_than_qc(self):
+        # Folder mtimes also count as data changes, so pin them down
+        for session in ['STUDY_CMH_0001_01', 'STUDY_MRC_0002_01']:
+            os.utime(os.path.join(self.nii, session), (100, 100))
+        self.index.refresh()
+
+        newer = self.index.get_newer_than_qc()
+
+        assert [session for session, _, _ in newer] == ['STUDY_MRC_0002_01']
+
+    def test_find_images_reads_folders_from_index(self):
+        import pandas as pd
+        checklist = pd.DataFrame({'id': ['STUDY_CMH_0001_01'], 'T1': [None]})
+        # Remove the file from disk so only the index can know about it
+        os.remove(os.path.join(self.nii, 'STUDY_CMH_0001_01',
+                'STUDY_CMH_0001_01_01_T1_02_SagT1.nii.gz'))
+
+        checklist = datman.proc.find_images(checklist, 'T1', self.nii, '_T1_',
+                index=self.index)
+
+        assert checklist['T1'][0] == 'STUDY_CMH_0001_01_01_T1_02_SagT1.nii.gz'
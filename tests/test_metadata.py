@@ -0,0 +1,235 @@
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import logging
+
+from nose.tools import raises
+
+import datman.metadata as metadata
+
+logging.disable(logging.CRITICAL)
+
+CHECKLIST = """qc_STUDY_CMH_0001_01.html signed off by someone
+qc_STUDY_CMH_0002_01.html
+
+qc_STUDY_CMH_0003_01.pdf  also signed off
+qc_STUDY_CMH_0001_01.html duplicate entry
+"""
+
+BLACKLIST = """series reason
+STUDY_CMH_0001_01_01_T1_02_SagT1 bad motion
+STUDY_CMH_0001_01_01_DTI60-1000_05_Ax-DTI-60,signal dropout
+
+STUDY_CMH_0002_01_01_RST_07_Resting
+not_a_datman_name_or_series STUDY_CMH_0004_01_01_T2_03 old style
+"""
+
+class MetadataTestCase(unittest.TestCase):
+
+    def setUp(self):
+        metadata.clear_cache()
+        self.tmp = tempfile.mkdtemp(prefix='datman_metadata_test')
+        self.checklist = os.path.join(self.tmp, 'checklist.csv')
+        self.blacklist = os.path.join(self.tmp, 'blacklist.csv')
+        self.write(self.checklist, CHECKLIST)
+        self.write(self.blacklist, BLACKLIST)
+
+    def tearDown(self):
+        metadata.clear_cache()
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, contents):
+        with open(path, 'w') as metadata_file:
+            metadata_file.write(contents)
+
+
+class TestChecklistIndex(MetadataTestCase):
+
+    def test_returns_comment_for_signed_off_session(self):
+        checklist = metadata.get_checklist(self.checklist)
+        assert checklist.get_comment('STUDY_CMH_0001_01') == \
+                'signed off by someone'
+
+    def test_returns_empty_string_for_session_without_comment(self):
+        checklist = metadata.get_checklist(self.checklist)
+        assert checklist.get_comment('STUDY_CMH_0002_01') == ''
+        assert not checklist.is_signed_off('STUDY_CMH_0002_01')
+
+    def test_returns_none_for_missing_session(self):
+        checklist = metadata.get_checklist(self.checklist)
+        assert checklist.get_comment('STUDY_CMH_0009_01') is None
+
+    def test_signed_off_lists_each_commented_subject_once(self):
+        checklist = metadata.get_checklist(self.checklist)
+        assert checklist.signed_off == ['STUDY_CMH_0001_01',
+                'STUDY_CMH_0003_01']
+
+    def test_index_is_reused_until_file_changes(self):
+        first = metadata.get_checklist(self.checklist)
+        assert metadata.get_checklist(self.checklist) is first
+
+        self.write(self.checklist, CHECKLIST +
+                'qc_STUDY_CMH_0009_01.html new sign off\n')
+        # Make sure the change is visible even on coarse mtime filesystems
+        future = time.time() + 10
+        os.utime(self.checklist, (future, future))
+
+        second = metadata.get_checklist(self.checklist)
+        assert second is not first
+        assert second.get_comment('STUDY_CMH_0009_01') == 'new sign off'
+
+    @raises(IOError)
+    def test_raises_IOError_when_file_missing(self):
+        metadata.get_checklist(os.path.join(self.tmp, 'nonexistent.csv'))
+
+
+class TestBlacklistIndex(MetadataTestCase):
+
+    def test_finds_comment_for_blacklisted_file(self):
+        blacklist = metadata.get_blacklist(self.blacklist)
+        comment = blacklist.get_comment(
+                'STUDY_CMH_0001_01_01_T1_02_SagT1.nii.gz')
+        assert comment == 'bad motion'
+
+    def test_matches_scan_regardless_of_description(self):
+        blacklist = metadata.get_blacklist(self.blacklist)
+        assert blacklist.get_comment(
+                '/some/path/STUDY_CMH_0001_01_01_DTI60-1000_05_Other.bvec') \
+                == 'signal dropout'
+
+    def test_entry_without_reason_has_empty_comment(self):
+        blacklist = metadata.get_blacklist(self.blacklist)
+        assert blacklist.is_blacklisted(
+                'STUDY_CMH_0002_01_01_RST_07_Resting')
+        assert blacklist.get_comment(
+                'STUDY_CMH_0002_01_01_RST_07_Resting') == ''
+
+    def test_returns_none_for_scan_not_in_blacklist(self):
+        blacklist = metadata.get_blacklist(self.blacklist)
+        assert blacklist.get_comment(
+                'STUDY_CMH_0001_01_01_T1_03_SagT1') is None
+
+    def test_header_is_ignored(self):
+        blacklist = metadata.get_blacklist(self.blacklist)
+        assert 'series' not in blacklist.series
+
+    def test_groups_entries_by_subject(self):
+        blacklist = metadata.get_blacklist(self.blacklist)
+        assert blacklist.get_subject_entries('STUDY_CMH_0001_01') == [
+                'STUDY_CMH_0001_01_01_T1_02_SagT1',
+                'STUDY_CMH_0001_01_01_DTI60-1000_05_Ax-DTI-60']
+        assert blacklist.get_subject_entries('STUDY_CMH_0009_01') == []
+
+    def test_unparseable_entries_are_kept_aside(self):
+        blacklist = metadata.get_blacklist(self.blacklist)
+        assert blacklist.unparsed == ['not_a_datman_name_or_series']
+
+
+class TestMetadataDatabase(MetadataTestCase):
+
+    def setUp(self):
+        super(TestMetadataDatabase, self).setUp()
+        self.db_path = os.path.join(self.tmp, metadata.DATABASE_NAME)
+
+    def test_new_database_is_seeded_from_existing_csvs(self):
+        with metadata.MetadataDatabase(self.db_path):
+            pass
+        checklist = metadata.get_checklist(self.db_path)
+        assert checklist.get_comment('STUDY_CMH_0001_01') == \
+                'signed off by someone'
+        blacklist = metadata.get_blacklist(self.db_path)
+        assert blacklist.get_comment(
+                'STUDY_CMH_0001_01_01_T1_02_SagT1') == 'bad motion'
+
+    def test_duplicate_checklist_entries_are_ignored(self):
+        with metadata.MetadataDatabase(self.db_path) as database:
+            assert database.add_checklist_entry('qc_STUDY_CMH_0005_01.html')
+            assert not database.add_checklist_entry(
+                    'qc_STUDY_CMH_0005_01.pdf')
+            lines = list(database.get_lines('checklist'))
+        assert lines.count('qc_STUDY_CMH_0005_01.html\n') == 1
+        assert 'qc_STUDY_CMH_0005_01.pdf\n' not in lines
+
+    def test_index_sees_new_entries(self):
+        metadata.MetadataDatabase(self.db_path).close()
+        assert metadata.get_checklist(self.db_path).get_comment(
+                'STUDY_CMH_0005_01') is None
+        with metadata.MetadataDatabase(self.db_path) as database:
+            database.sign_off('qc_STUDY_CMH_0005_01.html', 'looks good')
+        assert metadata.get_checklist(self.db_path).get_comment(
+                'STUDY_CMH_0005_01') == 'looks good'
+
+    def test_blacklist_entry_reason_is_updated(self):
+        with metadata.MetadataDatabase(self.db_path) as database:
+            database.add_blacklist_entry('STUDY_CMH_0001_01_01_T1_02_SagT1',
+                    'new reason')
+        blacklist = metadata.get_blacklist(self.db_path)
+        assert blacklist.get_comment(
+                'STUDY_CMH_0001_01_01_T1_02_SagT1') == 'new reason'
+        assert blacklist.entries.count('STUDY_CMH_0001_01_01_T1_02_SagT1') == 1
+
+    def test_concurrent_writers_dont_duplicate_entries(self):
+        import threading
+        pages = ['qc_STUDY_ABC_{:04d}_01.html'.format(i) for i in range(20)]
+
+        def add_all():
+            with metadata.MetadataDatabase(self.db_path) as database:
+                for page in pages:
+                    database.add_checklist_entry(page)
+
+        # Create the database first so only one thread imports the csvs
+        metadata.MetadataDatabase(self.db_path).close()
+        threads = [threading.Thread(target=add_all) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with metadata.MetadataDatabase(self.db_path) as database:
+            lines = list(database.get_lines('checklist'))
+        for page in pages:
+            assert len([l for l in lines if l.startswith(page)]) == 1
+
+    def test_database_not_switched_to_wal_by_default(self):
+        with metadata.MetadataDatabase(self.db_path) as database:
+            mode = database._connection.execute(
+                    'PRAGMA journal_mode').fetchone()[0]
+        assert mode.lower() != 'wal'
+
+        with metadata.MetadataDatabase(self.db_path, wal=True) as database:
+            mode = database._connection.execute(
+                    'PRAGMA journal_mode').fetchone()[0]
+        assert mode.lower() == 'wal'
+
+    def test_reading_index_doesnt_change_database(self):
+        connection = sqlite3.connect(self.db_path)
+        connection.execute(metadata.MetadataDatabase.TABLES['checklist'])
+        connection.execute("INSERT INTO checklist VALUES (?, ?, ?)",
+                ('qc_STUDY_CMH_0005_01', 'qc_STUDY_CMH_0005_01.html', 'ok'))
+        connection.commit()
+        connection.close()
+
+        checklist = metadata.get_checklist(self.db_path)
+
+        assert checklist.get_comment('STUDY_CMH_0005_01') == 'ok'
+        connection = sqlite3.connect(self.db_path)
+        tables = [row[0] for row in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'")]
+        connection.close()
+        assert tables == ['checklist']
+
+    def test_export_regenerates_csv(self):
+        with metadata.MetadataDatabase(self.db_path) as database:
+            database.add_blacklist_entry('STUDY_CMH_0005_01_01_T1_02_SagT1',
+                    'truncated')
+            database.export('blacklist', self.blacklist)
+
+        with open(self.blacklist, 'r') as exported:
+            lines = exported.readlines()
+        assert lines[0] == 'series reason\n'
+        assert 'STUDY_CMH_0005_01_01_T1_02_SagT1 truncated\n' in lines
+        assert 'STUDY_CMH_0001_01_01_T1_02_SagT1 bad motion\n' in lines
+        assert not [f for f in os.listdir(self.tmp) if f.startswith('.')]
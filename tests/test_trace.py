@@ -0,0 +1,89 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import logging
+
+from nose.tools import raises
+
+import datman.trace as trace
+import datman.utils
+
+logging.disable(logging.CRITICAL)
+
+@trace.traced('double', category='test', args=lambda x: {'x': x})
+def double(x):
+    return x * 2
+
+@trace.traced()
+def fail():
+    raise ValueError("failed")
+
+class TestTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='datman_trace_test')
+        self.trace_file = os.path.join(self.tmp, 'trace.json')
+
+    def tearDown(self):
+        trace.disable()
+        shutil.rmtree(self.tmp)
+
+    def read_events(self):
+        with open(self.trace_file, 'r') as trace_file:
+            contents = trace_file.read()
+        # The closing bracket is left off while a trace is being written
+        return json.loads(contents.rstrip().rstrip(',') + ']')
+
+    def test_nothing_recorded_when_disabled(self):
+        with trace.span('unused'):
+            assert double(2) == 4
+        assert not os.path.exists(self.trace_file)
+
+    def test_spans_written_as_complete_events(self):
+        trace.enable(self.trace_file)
+
+        with trace.span('outer', category='test', step=1):
+            assert double(3) == 6
+
+        inner, outer = self.read_events()
+        assert inner['name'] == 'double'
+        assert inner['args'] == {'x': 3}
+        assert outer['name'] == 'outer'
+        assert outer['ph'] == 'X'
+        assert outer['args'] == {'step': 1}
+        assert outer['ts'] <= inner['ts']
+        assert outer['dur'] >= inner['dur']
+
+    @raises(ValueError)
+    def test_exceptions_recorded_and_reraised(self):
+        trace.enable(self.trace_file)
+        try:
+            fail()
+        finally:
+            event = self.read_events()[0]
+            assert event['name'] == 'test_trace.fail'
+            assert event['args'] == {'error': 'ValueError'}
+
+    def test_commands_traced_with_resource_usage(self):
+        trace.enable(self.trace_file)
+
+        datman.utils.run_command(['echo', 'traced'])
+
+        event = self.read_events()[0]
+        assert event['name'] == 'echo'
+        assert event['cat'] == 'command'
+        assert event['args']['returncode'] == 0
+        assert 'max_rss' in event['args']
+
+    def test_jsonl_files_hold_one_event_per_line(self):
+        self.trace_file = os.path.join(self.tmp, 'trace.jsonl')
+        trace.enable(self.trace_file)
+
+        double(1)
+        double(2)
+
+        with open(self.trace_file, 'r') as trace_file:
+            events = [json.loads(line) for line in trace_file]
+        assert [e['args']['x'] for e in events] == [1, 2]
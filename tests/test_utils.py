@@ -2,15 +2,21 @@
 
 
 import os
+import time
+import shutil
+import tempfile
+import threading
 
 
 import unittest
 import logging
 
+import dicom
 from nose.tools import raises
-from mock import patch
+from mock import patch, MagicMock
 
 import datman.utils as utils
+import datman.metadata
 
 logging.disable(logging.CRITICAL)
 
@@ -62,3 +68,299 @@ class TestCheckDependencyConfigured(unittest.TestCase):
 
     # def test_exception_contains_program_name(self):
     #     assert False
+
+
+@patch('datman.config.get_config')
+class TestMetadataBatchQueries(unittest.TestCase):
+
+    def setUp(self):
+        datman.metadata.clear_cache()
+        self.meta = tempfile.mkdtemp(prefix='datman_utils_test')
+        with open(os.path.join(self.meta, 'checklist.csv'), 'w') as checklist:
+            checklist.write("qc_STUDY_CMH_0001_01.html signed off\n"
+                    "qc_STUDY_CMH_0002_01.html\n")
+        with open(os.path.join(self.meta, 'blacklist.csv'), 'w') as blacklist:
+            blacklist.write("series reason\n"
+                    "STUDY_CMH_0001_01_01_T1_02_SagT1 bad motion\n"
+                    "STUDY_CMH_0001_01_01_RST_04_Resting\n")
+        self.config = MagicMock()
+        self.config.get_metadata_file.side_effect = lambda name: \
+                os.path.join(self.meta, '{}.csv'.format(name))
+
+    def tearDown(self):
+        datman.metadata.clear_cache()
+        shutil.rmtree(self.meta)
+
+    def test_qc_status_many_reports_every_session(self, mock_config):
+        mock_config.return_value = self.config
+        status = utils.qc_status_many(['STUDY_CMH_0001_01',
+                'STUDY_CMH_0002_01', 'STUDY_CMH_0003_01'])
+        assert status == {'STUDY_CMH_0001_01': 'signed off',
+                          'STUDY_CMH_0002_01': '',
+                          'STUDY_CMH_0003_01': None}
+
+    def test_check_blacklist_many_reports_every_scan(self, mock_config):
+        mock_config.return_value = self.config
+        blacklisted = utils.check_blacklist_many([
+                'STUDY_CMH_0001_01_01_T1_02_SagT1',
+                'STUDY_CMH_0001_01_01_RST_04_Resting',
+                'STUDY_CMH_0001_01_01_DTI60-1000_05_Ax-DTI-60'])
+        assert blacklisted == {
+                'STUDY_CMH_0001_01_01_T1_02_SagT1': 'bad motion',
+                'STUDY_CMH_0001_01_01_RST_04_Resting': '',
+                'STUDY_CMH_0001_01_01_DTI60-1000_05_Ax-DTI-60': None}
+
+    def test_config_is_only_resolved_once(self, mock_config):
+        mock_config.return_value = self.config
+        utils.check_blacklist_many(['STUDY_CMH_0001_01_01_T1_02_SagT1',
+                'STUDY_CMH_0001_01_01_RST_04_Resting'], study='STUDY')
+        mock_config.assert_called_once_with(study='STUDY')
+
+    def test_all_none_when_blacklist_missing(self, mock_config):
+        self.config.get_metadata_file.side_effect = lambda name: \
+                os.path.join(self.meta, 'missing', '{}.csv'.format(name))
+        mock_config.return_value = self.config
+        blacklisted = utils.check_blacklist_many(
+                ['STUDY_CMH_0001_01_01_T1_02_SagT1'])
+        assert blacklisted == {'STUDY_CMH_0001_01_01_T1_02_SagT1': None}
+
+class TestArchiveHeaders(unittest.TestCase):
+
+    pixel_size = 1024 * 1024
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='datman_headers_test')
+        self.dicoms = []
+        for series in ['01', '02']:
+            folder = os.path.join(self.tmp, 'exam', 'series' + series)
+            os.makedirs(folder)
+            self.dicoms.append(self.make_dicom(os.path.join(folder,
+                    'image1.dcm'), series))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_dicom(self, path, series, description='SagT1'):
+        from dicom.dataset import Dataset, FileDataset
+        meta = Dataset()
+        meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+        meta.MediaStorageSOPInstanceUID = '1.2.3.' + series
+        meta.ImplementationClassUID = '1.2.3.4'
+        meta.TransferSyntaxUID = dicom.UID.ExplicitVRLittleEndian
+        dataset = FileDataset(path, {}, file_meta=meta,
+                preamble=b'\0' * 128)
+        dataset.is_little_endian = True
+        dataset.is_implicit_VR = False
+        dataset.SeriesNumber = int(series)
+        dataset.SeriesDescription = description
+        dataset.PixelData = b'\0' * self.pixel_size
+        dataset[0x7fe00010].VR = 'OW'
+        dataset.save_as(path)
+        return path
+
+    def make_zip(self):
+        import zipfile
+        path = os.path.join(self.tmp, 'exam.zip')
+        with zipfile.ZipFile(path, 'w') as archive:
+            for dicom in self.dicoms:
+                archive.write(dicom, os.path.relpath(dicom, self.tmp))
+        return path
+
+    def make_tar(self):
+        import tarfile
+        path = os.path.join(self.tmp, 'exam.tar.gz')
+        with tarfile.open(path, 'w:gz') as archive:
+            archive.add(os.path.join(self.tmp, 'exam'), 'exam')
+        return path
+
+    def test_zip_headers_found_for_each_series(self):
+        headers = utils.get_archive_headers(self.make_zip())
+        assert sorted(headers) == ['exam/series01', 'exam/series02']
+        assert headers['exam/series02'].SeriesNumber == 2
+        assert 'PixelData' not in headers['exam/series02']
+
+    def test_tar_headers_found_for_each_series(self):
+        headers = utils.get_archive_headers(self.make_tar())
+        assert sorted(headers) == ['exam/series01', 'exam/series02']
+        assert headers['exam/series01'].SeriesDescription == 'SagT1'
+
+    def test_stop_after_first_returns_one_header(self):
+        headers = utils.get_archive_headers(self.make_tar(),
+                stop_after_first=True)
+        assert len(headers) == 1
+
+    def test_many_archives_read_in_parallel(self):
+        archives = [self.make_zip(), self.make_tar(),
+                os.path.join(self.tmp, 'missing.zip')]
+
+        headers = utils.get_archive_headers_many(archives, jobs=2)
+
+        assert sorted(headers) == sorted(archives[:2])
+        for archive in archives[:2]:
+            assert headers[archive]['exam/series01'].SeriesNumber == 1
+
+    def test_pixel_data_is_not_read(self):
+        with open(self.dicoms[0], 'rb') as stream:
+            utils.read_dicom_header(stream)
+            assert stream.tell() < self.pixel_size
+
+    def test_header_larger_than_first_read_is_read_in_full(self):
+        long_description = 'x' * 1000
+        path = self.make_dicom(os.path.join(self.tmp, 'long.dcm'), '03',
+                description=long_description)
+        with open(path, 'rb') as stream:
+            header = utils.read_dicom_header(stream, read_size=256)
+        assert header.SeriesDescription == long_description
+
+    @raises(dicom.filereader.InvalidDicomError)
+    def test_raises_InvalidDicomError_for_other_files(self):
+        path = os.path.join(self.tmp, 'notes.txt')
+        with open(path, 'w') as notes:
+            notes.write('not a dicom' * 100)
+        with open(path, 'rb') as stream:
+            utils.read_dicom_header(stream)
+
+    def test_is_dicom_file_accepts_dicom(self):
+        assert utils.is_dicom_file(self.dicoms[0])
+
+    def test_is_dicom_file_rejects_other_files(self):
+        path = os.path.join(self.tmp, 'notes.txt')
+        with open(path, 'w') as notes:
+            notes.write('not a dicom' * 100)
+        assert not utils.is_dicom_file(path)
+        assert not utils.is_dicom_file(os.path.join(self.tmp, 'missing.dcm'))
+
+    def test_is_dicom_file_rejects_magic_without_header(self):
+        path = os.path.join(self.tmp, 'fake.dcm')
+        with open(path, 'wb') as fake:
+            fake.write(b'\0' * 128 + b'DICM')
+        assert not utils.is_dicom_file(path)
+
+class TestRunCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='datman_run_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_arguments_are_not_interpreted_by_a_shell(self):
+        result = utils.run_command(['echo', 'a (; $HOME b'])
+        assert result.returncode == 0
+        assert result.output == b'a (; $HOME b\n'
+
+    def test_records_resource_usage(self):
+        result = utils.run_command('sh -c "echo error >&2; exit 3"')
+        assert result.returncode == 3
+        assert result.error == b'error\n'
+        assert result.wall_time >= 0
+        assert result.max_rss > 0
+        assert result.user_time is not None
+
+    def test_command_killed_after_timeout(self):
+        result = utils.run_command('sh -c "sleep 30"', timeout=0.5)
+        assert result.timed_out
+        assert result.returncode < 0
+        assert result.wall_time < 10
+
+    def test_timeout_kills_background_processes_holding_output(self):
+        result = utils.run_command(['sh', '-c', 'sleep 30 & echo started'],
+                timeout=1)
+        assert result.timed_out
+        assert result.output == b'started\n'
+        assert result.wall_time < 10
+
+    @patch('os.killpg')
+    def test_timer_leaves_command_that_already_finished(self, mock_killpg):
+        timed_out, finished = threading.Event(), threading.Event()
+        finished.set()
+
+        utils._kill_command(MagicMock(pid=12345), timed_out, finished,
+                threading.Lock())
+
+        assert not timed_out.is_set()
+        assert mock_killpg.call_count == 0
+
+    def test_output_written_to_log_file(self):
+        log_file = os.path.join(self.tmp, 'command.log')
+        result = utils.run_command('echo logged', log_file=log_file)
+        assert result.output == b''
+        with open(log_file, 'r') as log:
+            assert log.read() == 'logged\n'
+
+    def test_run_many_returns_results_in_order(self):
+        commands = [['sh', '-c', 'sleep 0.{}; echo {}'.format(3 - i, i)]
+                    for i in range(3)]
+        results = utils.run_many(commands, jobs=3)
+        assert [r.output for r in results] == [b'0\n', b'1\n', b'2\n']
+
+    def test_run_still_uses_a_shell(self):
+        returncode, output = utils.run('echo one | tr o 0')
+        assert returncode == 0
+        assert output == b'0ne\n'
+
+class TestPrefetch(unittest.TestCase):
+
+    def test_results_yielded_in_order(self):
+        results = list(utils.prefetch(range(5), lambda item: item * 2))
+        assert results == [(item, item * 2) for item in range(5)]
+
+    def test_next_item_fetched_while_caller_works(self):
+        started = [threading.Event() for _ in range(3)]
+
+        def fetch(item):
+            started[item].set()
+            return item
+
+        for item, _ in utils.prefetch(range(3), fetch, depth=1):
+            if item < 2:
+                # Would time out if the next fetch waited for this item
+                assert started[item + 1].wait(5)
+
+    def test_fetching_stays_within_depth_of_caller(self):
+        fetched = []
+        lead = []
+
+        for item, _ in utils.prefetch(range(10), fetched.append, depth=2):
+            time.sleep(0.01)
+            lead.append(len(fetched) - item)
+
+        # The held item, two waiting and one waiting to be queued
+        assert max(lead) <= 4
+
+    def test_every_result_released_when_closed_early(self):
+        fetched = []
+        released = []
+
+        def fetch(item):
+            fetched.append(item)
+            return item
+
+        results = utils.prefetch(range(10), fetch, depth=3,
+                                 release=released.append)
+        for item, _ in results:
+            if item == 2:
+                break
+        results.close()
+
+        assert sorted(released) == fetched
+        assert len(fetched) < 10
+
+    def test_fetch_error_raised_at_its_item(self):
+        def fetch(item):
+            if item == 2:
+                raise ValueError(item)
+            return item
+
+        seen = []
+        with self.assertRaises(ValueError):
+            for item, _ in utils.prefetch(range(5), fetch):
+                seen.append(item)
+        assert seen == [0, 1]
+
+    def test_depth_zero_fetches_on_demand(self):
+        released = []
+        results = list(utils.prefetch(range(3), lambda item: item, depth=0,
+                                      release=released.append))
+        assert results == [(0, 0), (1, 1), (2, 2)]
+        assert released == [0, 1, 2]
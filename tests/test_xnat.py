@@ -0,0 +1,215 @@
+import os
+import shutil
+import zipfile
+import tempfile
+import unittest
+import logging
+import threading
+
+import datman.xnat
+
+from fake_xnat import FakeXnat
+
+logging.disable(logging.CRITICAL)
+
+def make_archive(n_scans, size=200000):
+    scans = dict((str(num), {'description': 'Series{}'.format(num),
+                             'size': size})
+                 for num in range(1, n_scans + 1))
+    return {'STUDY': {'STUDY_CMH_0001_01': {'STUDY_CMH_0001_01_01': scans}}}
+
+class TestGetDicomsMany(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='datman_xnat_test')
+        self.server = FakeXnat(make_archive(8))
+        self.server.start()
+        self.xnat = datman.xnat.xnat(self.server.url, 'user', 'password')
+        self.scans = [('STUDY', 'STUDY_CMH_0001_01', 'STUDY_CMH_0001_01_01',
+                       str(num)) for num in range(1, 9)]
+
+    def tearDown(self):
+        self.xnat.session.close()
+        self.server.stop()
+        shutil.rmtree(self.tmp)
+
+    def test_downloads_returned_in_order(self):
+        results = self.xnat.get_dicoms_many(self.scans, self.tmp,
+                                            max_workers=4)
+
+        assert [r.scan for r in results] == self.scans
+        for result in results:
+            assert result.error is None
+            assert result.size == os.path.getsize(result.filename)
+            assert result.throughput > 0
+            with zipfile.ZipFile(result.filename) as archive:
+                assert archive.testzip() is None
+
+    def test_connection_pool_grows_to_fit_workers(self):
+        self.xnat.get_dicoms_many(self.scans[:2], self.tmp, max_workers=16)
+
+        adapter = self.xnat.session.get_adapter(self.server.url)
+        assert adapter._pool_maxsize == 16
+
+    def test_max_connections_caps_concurrent_requests(self):
+        self.server.rate = 2e6
+        xnat = datman.xnat.xnat(self.server.url, 'user', 'password',
+                                max_connections=2)
+
+        results = xnat.get_dicoms_many(self.scans, self.tmp, max_workers=8)
+        xnat.session.close()
+
+        assert all(r.filename for r in results)
+        assert self.server.max_active == 2
+
+    def test_expired_session_renewed_once_for_all_workers(self):
+        self.server.expire_sessions()
+
+        results = self.xnat.get_dicoms_many(self.scans, self.tmp,
+                                            max_workers=8)
+
+        assert all(r.filename for r in results)
+        # One login when connecting and one after the session expired
+        assert self.server.logins == 2
+
+    def test_failed_download_does_not_stop_others(self):
+        scans = self.scans[:2] + [('STUDY', 'STUDY_CMH_0001_01',
+                                   'STUDY_CMH_0001_01_01', '99')]
+
+        results = self.xnat.get_dicoms_many(scans, self.tmp, max_workers=2)
+
+        assert results[0].filename and results[1].filename
+        assert results[2].filename is None
+        assert results[2].error
+        assert not os.path.exists(os.path.join(self.tmp,
+                'STUDY_CMH_0001_01_STUDY_CMH_0001_01_01_99.zip'))
+
+    def test_missing_scans_do_not_use_up_capped_connections(self):
+        xnat = datman.xnat.xnat(self.server.url, 'user', 'password',
+                                max_connections=2)
+        missing = [('STUDY', 'STUDY_CMH_0001_01', 'STUDY_CMH_0001_01_01',
+                    str(num)) for num in range(90, 95)]
+
+        results = []
+        worker = threading.Thread(target=lambda: results.extend(
+                xnat.get_dicoms_many(missing + self.scans[:1], self.tmp,
+                                     max_workers=1)))
+        worker.daemon = True
+        worker.start()
+        worker.join(30)
+        xnat.session.close()
+
+        assert not worker.is_alive()
+        assert all(r.filename is None for r in results[:-1])
+        assert results[-1].filename
+
+class TestGetXnatStream(unittest.TestCase):
+
+    scan = ('STUDY', 'STUDY_CMH_0001_01', 'STUDY_CMH_0001_01_01', '1')
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='datman_xnat_test')
+        self.server = FakeXnat(make_archive(1, size=500000))
+        self.server.start()
+        self.xnat = datman.xnat.xnat(self.server.url, 'user', 'password',
+                                     chunk_size=64 * 1024)
+        self.url = self.xnat._get_dicom_url(*self.scan)
+        self.expected = self.server.get_zip(*self.scan)
+        self.dest = os.path.join(self.tmp, 'scan.zip')
+
+    def tearDown(self):
+        self.xnat.session.close()
+        self.server.stop()
+        shutil.rmtree(self.tmp)
+
+    def read_dest(self):
+        with open(self.dest, 'rb') as result:
+            return result.read()
+
+    def test_download_renamed_from_part_file_when_complete(self):
+        self.xnat._get_xnat_stream(self.url, (None, self.dest))
+
+        assert self.read_dest() == self.expected
+        assert not os.path.exists(self.dest + datman.xnat.PART_SUFFIX)
+
+    def test_interrupted_download_resumed_with_range(self):
+        self.server.interrupt_downloads(after=200000)
+
+        self.xnat._get_xnat_stream(self.url, (None, self.dest))
+
+        assert self.read_dest() == self.expected
+        assert self.server.range_requests == ['bytes=200000-']
+
+    def test_full_refetch_when_server_ignores_ranges(self):
+        self.server.ranges = False
+        self.server.interrupt_downloads(after=200000)
+
+        self.xnat._get_xnat_stream(self.url, (None, self.dest))
+
+        assert self.read_dest() == self.expected
+
+    def test_resumes_part_file_left_by_earlier_download(self):
+        part = self.dest + datman.xnat.PART_SUFFIX
+        with open(part, 'wb') as partial:
+            partial.write(self.expected[:100000])
+
+        self.xnat._get_xnat_stream(self.url, (None, self.dest))
+
+        assert self.read_dest() == self.expected
+        assert self.server.range_requests == ['bytes=100000-']
+
+    def test_stale_part_file_larger_than_download_discarded(self):
+        part = self.dest + datman.xnat.PART_SUFFIX
+        with open(part, 'wb') as partial:
+            partial.write(b'x' * (len(self.expected) + 10))
+
+        self.xnat._get_xnat_stream(self.url, (None, self.dest))
+
+        assert self.read_dest() == self.expected
+
+    def test_part_file_removed_when_retries_run_out(self):
+        self.server.interrupt_downloads(after=1000, times=10)
+
+        with self.assertRaises(Exception):
+            self.xnat._get_xnat_stream(self.url, (None, self.dest),
+                                       retries=1)
+
+        assert not os.path.exists(self.dest)
+        assert not os.path.exists(self.dest + datman.xnat.PART_SUFFIX)
+
+class TestGetScans(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeXnat(make_archive(5))
+        self.server.start()
+        self.xnat = datman.xnat.xnat(self.server.url, 'user', 'password')
+
+    def tearDown(self):
+        self.xnat.session.close()
+        self.server.stop()
+
+    def test_all_scans_and_their_files_read_in_one_request(self):
+        before = len(self.server.requests)
+
+        scans = self.xnat.get_scans('STUDY', 'STUDY_CMH_0001_01',
+                                    'STUDY_CMH_0001_01_01')
+
+        assert len(self.server.requests) == before + 1
+        assert [scan['data_fields']['ID'] for scan in scans] == \
+                sorted(str(num) for num in range(1, 6))
+        assert all(datman.xnat.has_file_info(scan) for scan in scans)
+
+    def test_session_document_holds_experiments_and_scans(self):
+        session = self.xnat.get_session('STUDY', 'STUDY_CMH_0001_01')
+
+        experiments = datman.xnat.get_session_experiments(session)
+        scans = datman.xnat.get_experiment_scans(experiments[0])
+
+        assert len(scans) == 5
+
+    def test_documents_without_children_have_no_scans_or_file_info(self):
+        document = {'data_fields': {'ID': '1'}}
+
+        assert datman.xnat.get_session_experiments(document) is None
+        assert datman.xnat.get_experiment_scans(document) is None
+        assert not datman.xnat.has_file_info(document)
@@ -0,0 +1,139 @@
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+import datman.xnat
+import datman.xnat_mirror
+
+from fake_xnat import FakeXnat
+
+logging.disable(logging.CRITICAL)
+
+PROJECT = 'STUDY_CMH'
+
+def make_archive(sessions):
+    archive = {}
+    for session in sessions:
+        experiment = session + '_01'
+        archive[session] = {experiment: {
+            '1': {'description': 'SagT1'},
+            '2': {'description': 'RestingState'}}}
+    return {PROJECT: archive}
+
+class TestXnatMirror(unittest.TestCase):
+
+    sessions = ['STUDY_CMH_000{}_01'.format(num) for num in range(1, 4)]
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='datman_mirror_test')
+        self.server = FakeXnat(make_archive(self.sessions))
+        self.server.start()
+        connection = datman.xnat.xnat(self.server.url, 'user', 'password')
+        self.mirror = datman.xnat_mirror.XnatMirror(
+                os.path.join(self.tmp, 'mirror.sqlite'), connection)
+
+    def tearDown(self):
+        self.mirror.close()
+        self.mirror.xnat.session.close()
+        self.server.stop()
+        shutil.rmtree(self.tmp)
+
+    def count_requests(self):
+        return len(self.server.requests)
+
+    def read_session(self, session):
+        experiments = self.mirror.get_experiments(PROJECT, session)
+        experiment = self.mirror.get_experiment(PROJECT, session,
+                                                experiments[0]['label'])
+        scans = self.mirror.get_scans(PROJECT, session,
+                                      experiments[0]['label'])
+        return experiment, scans
+
+    def test_first_sync_refreshes_every_session(self):
+        refreshed = self.mirror.sync([PROJECT])
+
+        assert refreshed == [(PROJECT, session) for session in self.sessions]
+
+    def test_reads_after_sync_dont_query_server(self):
+        self.mirror.sync([PROJECT])
+        before = self.count_requests()
+
+        sessions = self.mirror.get_sessions(PROJECT)
+        assert self.mirror.find_session(self.sessions[1], [PROJECT]) == \
+                PROJECT
+        for session in sessions:
+            self.mirror.get_session(PROJECT, session['label'])
+            experiment, scans = self.read_session(session['label'])
+            assert [scan['data_fields']['series_description']
+                    for scan in scans] == ['SagT1', 'RestingState']
+
+        assert self.count_requests() == before
+
+    def test_sync_without_changes_only_lists_project(self):
+        self.mirror.sync([PROJECT])
+        before = self.count_requests()
+
+        refreshed = self.mirror.sync([PROJECT])
+
+        assert refreshed == []
+        paths = [path for _, path in self.server.requests[before:]]
+        assert not [path for path in paths if '/subjects/STUDY' in path]
+
+    def test_sync_refreshes_only_modified_sessions(self):
+        self.mirror.sync([PROJECT])
+        self.server.archive[PROJECT][self.sessions[2]][
+                self.sessions[2] + '_01']['3'] = {'description': 'DTI'}
+        self.server.touch(PROJECT, self.sessions[2] + '_01')
+
+        refreshed = self.mirror.sync([PROJECT])
+
+        assert refreshed == [(PROJECT, self.sessions[2])]
+        experiment, scans = self.read_session(self.sessions[2])
+        assert len(scans) == 3
+
+    def test_sync_picks_up_new_and_deleted_sessions(self):
+        self.mirror.sync([PROJECT])
+        archive = self.server.archive[PROJECT]
+        del archive[self.sessions[0]]
+        archive['STUDY_CMH_0009_01'] = make_archive(
+                ['STUDY_CMH_0009_01'])[PROJECT]['STUDY_CMH_0009_01']
+
+        refreshed = self.mirror.sync([PROJECT])
+
+        assert refreshed == [(PROJECT, 'STUDY_CMH_0009_01')]
+        labels = [s['label'] for s in self.mirror.get_sessions(PROJECT)]
+        assert self.sessions[0] not in labels
+        assert self.mirror.find_session(self.sessions[0], [PROJECT]) is None
+
+    def test_unsynced_reads_go_to_server_once(self):
+        experiment, scans = self.read_session(self.sessions[0])
+
+        assert len(scans) == 2
+        assert self.server.count('/experiments/{}_01/?$'.format(
+                self.sessions[0])) == 1
+
+    def test_scan_info_kept_after_first_read(self):
+        self.mirror.sync([PROJECT])
+        args = (PROJECT, self.sessions[0], self.sessions[0] + '_01', '1')
+
+        first = self.mirror.get_scan_info(*args)
+        second = self.mirror.get_scan_info(*args)
+
+        assert first == second
+        assert self.server.count('/scans/1/?$') == 1
+
+    def test_writes_drop_mirrored_session(self):
+        self.mirror.sync([PROJECT])
+        self.mirror.xnat.put_resource = lambda *args, **kwargs: None
+
+        self.mirror.put_resource(PROJECT, self.sessions[0],
+                                 self.sessions[0] + '_01', 'notes.txt', '',
+                                 'misc')
+
+        before = self.server.count('/experiments/{}_01/?$'.format(
+                self.sessions[0]))
+        self.read_session(self.sessions[0])
+        assert self.server.count('/experiments/{}_01/?$'.format(
+                self.sessions[0])) == before + 1